@@ -1,52 +1,228 @@
 import preprocess_utils as pu
 import data_utils as du
+import sample_utils as su
 import pandas as pd
+import numpy as np
+import argparse
+import joblib
+import os
+import statistics
+import time
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import accuracy_score, classification_report
 from sklearn.impute import SimpleImputer
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
 
-def main():
-    datasets = du.import_data()
-    datasets = pu.preprocess_datasets(datasets)
+# 'LAW_CAT_CD' is the target variable to predict
+TARGET_VARIABLE = 'Crime Category'
+
+# Columns that are not used as features
+DROP_FEATURES = [TARGET_VARIABLE, 'Lat_Lon', 'Latitude', 'Longitude', 'Phone', 'Address']
+
+# Categorical columns with more categories than this are ordinal encoded instead of one-hot encoded
+MAX_ONE_HOT_CATEGORIES = 16
+
+MODEL_PATH = os.path.join('data', 'Models', 'crime_category.joblib')
+
+def prepare_features(dataset):
+    '''
+    Selects the feature columns of the preprocessed Drug_Crime dataset, regular or compact form.
+    `Time` becomes the second of the day and `Date` the day of the month, since the year and month already are features of their own.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset.
+
+    Returns:
+        pd.DataFrame of the features.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    features = dataset.drop(columns=DROP_FEATURES, errors='ignore')
+    if 'Time' in features.columns and not pd.api.types.is_integer_dtype(features['Time']):
+        features['Time'] = du.time_to_seconds(features['Time'])
+    if 'Date' in features.columns:
+        # Only the distinct dates are parsed
+        codes, dates = pd.factorize(features['Date'])
+        features['Date'] = pu.parse_date_parts(pd.Series(np.asarray(dates, dtype=str)))['Day'].to_numpy()[codes]
+    if 'Completed?' in features.columns:
+        features['Completed?'] = features['Completed?'].astype('float64')
+
+    return features
+
+def build_encoder(features, max_one_hot = MAX_ONE_HOT_CATEGORIES):
+    '''
+    Builds the (unfitted) transformer that encodes the features. Missing values are imputed, numeric columns with the mean and categorical columns with the most frequent value.
+    Categorical columns with few categories, e.g. `BORO_NM`, are one-hot encoded into a sparse matrix, while high-cardinality ones, e.g. `Crime` or `PARKS_NM`, are ordinal encoded, which the forest splits on just as well.
+    Categories unseen while fitting are encoded as all zeros (one-hot) or -1 (ordinal), so new complaints can be scored without refitting.
+
+    Parameters:
+        features (pd.DataFrame):    Features from `prepare_features`, used to pick the encoding of every column.
+        max_one_hot (int):          Optional. Most categories of a one-hot encoded column. Defaults to `MAX_ONE_HOT_CATEGORIES`.
+
+    Returns:
+        sklearn.compose.ColumnTransformer
+    '''
+    assert isinstance(features, pd.DataFrame) and isinstance(max_one_hot, int)
+
+    numeric = [col for col in features.columns if pd.api.types.is_numeric_dtype(features[col])]
+    categorical = [col for col in features.columns if col not in numeric]
+    one_hot = [col for col in categorical if features[col].nunique() <= max_one_hot]
+    ordinal = [col for col in categorical if col not in one_hot]
+
+    return ColumnTransformer([('numeric', SimpleImputer(strategy='mean'), numeric),
+                              ('one_hot', make_pipeline(SimpleImputer(strategy='most_frequent'),
+                                                        OneHotEncoder(handle_unknown='ignore', sparse_output=True)), one_hot),
+                              ('ordinal', make_pipeline(SimpleImputer(strategy='most_frequent'),
+                                                        OrdinalEncoder(handle_unknown='use_encoded_value', unknown_value=-1)), ordinal)],
+                             sparse_threshold=0.3)
+
+def build_model(features, n_estimators = 100, n_jobs = -1, random_state = 42):
+    '''
+    Builds the (unfitted) pipeline of the feature encoder and the random forest.
+
+    Parameters:
+        features (pd.DataFrame):    Features from `prepare_features`.
+        n_estimators (int):         Optional. Number of trees. Defaults to 100.
+        n_jobs (int):               Optional. Number of parallel jobs to fit and predict with, -1 for all cores. Defaults to -1.
+        random_state (int):         Optional. Seed of the forest. Defaults to 42.
 
-    # 'LAW_CAT_CD' is the target variable to predict
-    target_variable = 'Crime Category'
+    Returns:
+        sklearn.pipeline.Pipeline
+    '''
+    return Pipeline([('encoder', build_encoder(features)),
+                     ('forest', RandomForestClassifier(n_estimators=n_estimators, n_jobs=n_jobs, random_state=random_state))])
 
-    # Selecting features and target variable
-    features = datasets['Drug_Crime'].drop(columns=[target_variable, 'Lat_Lon', 'Phone', 'Address'])
-    target = datasets['Drug_Crime'][target_variable]
+def train(dataset, n_estimators = 100, n_jobs = -1, test_size = 0.2, random_state = 42, fraction = None, confidence = 0.95):
+    '''
+    Trains the crime category classifier on the preprocessed Drug_Crime dataset and evaluates it on a held-out split.
+    Given a `sample_utils.StratifiedSample` instead, it trains on the sampled complaints, each weighted by the complaints of its stratum it stands for, for a quick approximate fit.
 
-    # Handling missing values
-    numeric_features = features.select_dtypes(include=['float64']).columns
-    categorical_features = features.select_dtypes(include=['object']).columns
+    Parameters:
+        dataset (pd.DataFrame|StratifiedSample):    Preprocessed Drug_Crime dataset, or a stratified sample of it.
+        n_estimators (int):                         Optional. Number of trees. Defaults to 100.
+        n_jobs (int):                               Optional. Number of parallel jobs, -1 for all cores. Defaults to -1.
+        test_size (float):                          Optional. Share of the rows held out for evaluation. Defaults to 0.2.
+        random_state (int):                         Optional. Seed of the split and the forest. Defaults to 42.
+        fraction (float):                           Optional. With a sample, share of the rows of every stratum to use, at most the fraction of the sample. Defaults to `None` (the whole sample).
+        confidence (float):                         Optional. Confidence level of the accuracy interval. Defaults to 0.95.
 
-    imputer_numeric = SimpleImputer(strategy='mean')
-    features[numeric_features] = imputer_numeric.fit_transform(features[numeric_features])
+    Returns:
+        tuple of the fitted sklearn.pipeline.Pipeline and a dict of the accuracy and its confidence interval, the classification report and the training and scoring throughput in rows per second.
+    '''
+    assert isinstance(dataset, (pd.DataFrame, su.StratifiedSample)) and 0 < confidence < 1
 
-    imputer_categorical = SimpleImputer(strategy='most_frequent')
-    features[categorical_features] = imputer_categorical.fit_transform(features[categorical_features])
+    weights = None
+    if isinstance(dataset, su.StratifiedSample):
+        sample = dataset.at(fraction) if fraction is not None else dataset
+        dataset, weights = sample.rows, sample.weights()
 
-    # Handling categorical variables
-    features = pd.get_dummies(features)
+    features = prepare_features(dataset)
+    target = dataset[TARGET_VARIABLE].astype(str)
 
     # Splitting the data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(features, target, test_size=0.2, random_state=42)
+    X_train, X_test, y_train, y_test, w_train, w_test = train_test_split(features, target, np.ones(len(features)) if weights is None else weights,
+                                                                         test_size=test_size, random_state=random_state)
+
+    model = build_model(X_train, n_estimators, n_jobs, random_state)
+    start = time.perf_counter()
+    model.fit(X_train, y_train, **({} if weights is None else {'forest__sample_weight': w_train}))
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = model.predict(X_test)
+    predict_seconds = time.perf_counter() - start
+
+    # Normal interval of the accuracy over the effective number of held-out rows, which is smaller than their number when they are weighted unevenly
+    accuracy = accuracy_score(y_test, y_pred, sample_weight=w_test)
+    effective_rows = w_test.sum() ** 2 / (w_test ** 2).sum()
+    margin = statistics.NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(accuracy * (1 - accuracy) / effective_rows)
+
+    report = {'accuracy': accuracy,
+              'accuracy_interval': (max(accuracy - margin, 0.0), min(accuracy + margin, 1.0)),
+              'classification_report': classification_report(y_test, y_pred, sample_weight=None if weights is None else w_test),
+              'train_rows': len(X_train),
+              'train_rows_per_second': len(X_train) / fit_seconds,
+              'score_rows': len(X_test),
+              'score_rows_per_second': len(X_test) / predict_seconds}
+    return model, report
+
+def save_model(model, path = MODEL_PATH):
+    '''
+    Writes the fitted pipeline, encoder included, to a file.
+
+    Parameters:
+        model (sklearn.pipeline.Pipeline):  Fitted pipeline from `train`.
+        path (str):                         Optional. File name. Defaults to `data/Models/crime_category.joblib`.
+    '''
+    assert isinstance(model, Pipeline) and isinstance(path, str)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    joblib.dump(model, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def load_model(path = MODEL_PATH):
+    '''
+    Reads a pipeline written by `save_model`.
+    '''
+    assert isinstance(path, str)
+
+    return joblib.load(path)
+
+def score(model, dataset, batch_size = 100000):
+    '''
+    Predicts the crime category of new preprocessed complaints with a fitted pipeline, in batches so the encoded features of only one batch are in memory at a time.
+
+    Parameters:
+        model (sklearn.pipeline.Pipeline):  Fitted pipeline from `train` or `load_model`.
+        dataset (pd.DataFrame):             Preprocessed Drug_Crime dataset. The target column is not needed.
+        batch_size (int):                   Optional. Number of rows predicted at a time. Defaults to 100000.
+
+    Returns:
+        tuple of the pd.Series of the predicted category of every row and the throughput in rows per second.
+    '''
+    assert isinstance(model, Pipeline) and isinstance(dataset, pd.DataFrame)
+    assert isinstance(batch_size, int) and batch_size > 0
+
+    start = time.perf_counter()
+    features = prepare_features(dataset)
+    predictions = [model.predict(features.iloc[i:i + batch_size]) for i in range(0, len(features), batch_size)]
+    predictions = pd.Series(np.concatenate(predictions) if predictions else [], index=dataset.index, name=TARGET_VARIABLE)
+    seconds = time.perf_counter() - start
+
+    return predictions, len(dataset) / seconds if seconds > 0 else float('inf')
+
+def main():
+    parser = argparse.ArgumentParser(description='Train or apply the crime category classifier')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='Number of parallel jobs, -1 for all cores')
+    parser.add_argument('--n-estimators', type=int, default=100, help='Number of trees of the forest')
+    parser.add_argument('--model', default=MODEL_PATH, help='File name of the saved model')
+    parser.add_argument('--score', metavar='CSV', help='Score the complaints of a raw Drug_Crime CSV with the saved model instead of training')
+    parser.add_argument('--fraction', type=float, help='Train on a stratified sample of this share of the complaints for a quick approximate fit, see sample_utils')
+    args = parser.parse_args()
 
-    # Initializing and training a Random Forest Classifier
-    clf = RandomForestClassifier(n_estimators=100, random_state=42)
-    clf.fit(X_train, y_train)
+    if args.score:
+        dataset = pu.preprocess_drug_crime(pd.read_csv(args.score))
+        predictions, rows_per_second = score(load_model(args.model), dataset)
+        print(predictions.value_counts().to_string())
+        print(f"Scored {len(predictions)} complaints at {rows_per_second:,.0f} rows/s")
+        return
 
-    # Making predictions on the test set
-    y_pred = clf.predict(X_test)
+    if args.fraction is not None:
+        dataset = su.load_sample(fraction=args.fraction)
+    else:
+        datasets = du.import_csv_data()
+        dataset = pu.preprocess_datasets(datasets)['Drug_Crime']
 
-    # Evaluating the model
-    accuracy = accuracy_score(y_test, y_pred)
-    classification_report_result = classification_report(y_test, y_pred)
+    model, report = train(dataset, args.n_estimators, args.n_jobs)
+    save_model(model, args.model)
 
     # Printing results
-    print(f"Accuracy: {accuracy:.2f}")
-    print("Classification Report:\n", classification_report_result)
+    print(f"Accuracy: {report['accuracy']:.2f} ({report['accuracy_interval'][0]:.2f} to {report['accuracy_interval'][1]:.2f})")
+    print("Classification Report:\n", report['classification_report'])
+    print(f"Trained on {report['train_rows']} rows at {report['train_rows_per_second']:,.0f} rows/s, scored {report['score_rows']} rows at {report['score_rows_per_second']:,.0f} rows/s")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
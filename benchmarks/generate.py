@@ -0,0 +1,317 @@
+'''
+Seeded generator of synthetic raw datasets with the schema of the real ones, so the preprocessing and analysis code can be benchmarked without the real Drug_Crime CSV.
+
+    python benchmarks/generate.py --rows 10000 100000 --out benchmarks/data
+
+writes benchmarks/data/<rows>/Drug_Crime_synthetic.csv, the 5 census CSVs in benchmarks/data/<rows>/2020_Census/ and a precinct table in benchmarks/data/<rows>/Precincts/.
+The same seed and row count always give the same files.
+'''
+import pandas as pd
+import numpy as np
+import argparse
+import datetime
+import os
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SCALES = [10000, 100000, 1000000, 10000000]
+
+# Raw Drug_Crime columns in the order of the NYC Open Data export
+RAW_COLUMNS = ['CMPLNT_NUM', 'CMPLNT_FR_DT', 'CMPLNT_FR_TM', 'CMPLNT_TO_DT', 'CMPLNT_TO_TM', 'ADDR_PCT_CD', 'RPT_DT', 'KY_CD', 'OFNS_DESC',
+               'PD_CD', 'PD_DESC', 'CRM_ATPT_CPTD_CD', 'LAW_CAT_CD', 'BORO_NM', 'LOC_OF_OCCUR_DESC', 'PREM_TYP_DESC', 'PARKS_NM', 'HADEVELOPT',
+               'Latitude', 'Longitude', 'Lat_Lon']
+
+# Share of `(null)` values of the raw columns
+NULL_RATES = {'CMPLNT_FR_TM': 0.0005,
+              'CMPLNT_TO_DT': 0.25,
+              'CMPLNT_TO_TM': 0.25,
+              'BORO_NM': 0.002,
+              'LOC_OF_OCCUR_DESC': 0.2,
+              'PREM_TYP_DESC': 0.005}
+
+# Share of rows with missing values (empty fields) and of exact duplicate rows
+MISSING_LAT_LON_RATE = 0.002
+MISSING_PD_CD_RATE = 0.001
+DUPLICATE_RATE = 0.005
+
+# Precinct numbers of each borough and the approximate bounding box (lat, lon) of the borough
+BOROUGHS = {'MANHATTAN': (list(range(1, 35)), (40.70, 40.88, -74.02, -73.91)),
+            'BRONX': (list(range(40, 53)), (40.80, 40.91, -73.93, -73.77)),
+            'BROOKLYN': (list(range(60, 95)), (40.57, 40.74, -74.04, -73.86)),
+            'QUEENS': (list(range(100, 116)), (40.54, 40.80, -73.96, -73.70)),
+            'STATEN ISLAND': (list(range(120, 124)), (40.50, 40.65, -74.25, -74.05))}
+BOROUGH_WEIGHTS = {'MANHATTAN': 0.3, 'BRONX': 0.3, 'BROOKLYN': 0.25, 'QUEENS': 0.12, 'STATEN ISLAND': 0.03}
+
+# Raw PD_DESC crimes with their PD_CD, KY_CD, LAW_CAT_CD and relative frequency
+CRIMES = [('CONTROLLED SUBSTANCE,INTENT TO', 500, 117, 'FELONY', 0.10),
+          ('CONTROLLED SUBSTANCE, INTENT T', 501, 117, 'FELONY', 0.03),
+          ('CONTROLLED SUBSTANCE, POSSESSI', 567, 235, 'MISDEMEANOR', 0.30),
+          ('CONTROLLED SUBSTANCE,POSSESS.', 502, 117, 'FELONY', 0.10),
+          ('CONTROLLED SUBSTANCE,POSSESS.-', 503, 117, 'FELONY', 0.02),
+          ('CONTROLLED SUBSTANCE, SALE 5', 510, 117, 'FELONY', 0.02),
+          ('CONTROLLED SUBSTANCE, SALE 4', 511, 117, 'FELONY', 0.01),
+          ('CONTROLLED SUBSTANCE,SALE 3', 512, 117, 'FELONY', 0.06),
+          ('CONTROLLED SUBSTANCE,SALE 2', 513, 117, 'FELONY', 0.005),
+          ('CONTROLLED SUBSTANCE,SALE 1', 514, 117, 'FELONY', 0.005),
+          ('MARIJUANA, POSSESSION 4 & 5', 570, 235, 'MISDEMEANOR', 0.20),
+          ('MARIJUANA, SALE 4 & 5', 520, 235, 'MISDEMEANOR', 0.04),
+          ('MARIJUANA, POSSESSION 1, 2 & 3', 569, 117, 'FELONY', 0.01),
+          ('MARIJUANA, SALE 1, 2 & 3', 521, 117, 'FELONY', 0.005),
+          ('DRUG PARAPHERNALIA,   POSSESSE', 578, 235, 'MISDEMEANOR', 0.05),
+          ('POSSESSION HYPODERMIC INSTRUME', 575, 235, 'MISDEMEANOR', 0.01),
+          ('SALE SCHOOL GROUNDS 4', 530, 117, 'FELONY', 0.005),
+          ('SALES OF PRESCRIPTION', 531, 117, 'FELONY', 0.002),
+          ('UNDER THE INFLUENCE OF DRUGS', 580, 235, 'VIOLATION', 0.01),
+          ('DRUG, INJECTION OF', 581, 235, 'MISDEMEANOR', 0.002),
+          ('LOITERING 1ST DEGREE FOR DRUG', 582, 235, 'MISDEMEANOR', 0.003),
+          ('USE CHILD TO COMMIT CONT SUB OFF', 532, 117, 'FELONY', 0.001),
+          ('POSS METH MANUFACT MATERIAL', 533, 117, 'FELONY', 0.001)]
+
+LOCATIONS = ['INSIDE', 'FRONT OF', 'OPPOSITE OF', 'REAR OF', 'OUTSIDE']
+LOCATION_WEIGHTS = [0.45, 0.45, 0.05, 0.04, 0.01]
+PREMISES = ['STREET', 'RESIDENCE - APT. HOUSE', 'RESIDENCE-HOUSE', 'PUBLIC HOUSING', 'TRANSIT - NYC SUBWAY', 'PARK/PLAYGROUND',
+            'GROCERY/BODEGA', 'COMMERCIAL BUILDING', 'HOTEL/MOTEL', 'OTHER']
+PREMISE_WEIGHTS = [0.55, 0.15, 0.05, 0.08, 0.05, 0.03, 0.03, 0.02, 0.01, 0.03]
+PARKS = ['CENTRAL PARK', 'RIVERSIDE PARK', "ST. MARY'S PARK BRONX", 'MARCUS GARVEY PARK', 'WASHINGTON SQUARE PARK', 'CROTONA PARK',
+         'CONEY ISLAND BEACH & BOARDWALK', 'FLUSHING MEADOWS CORONA PARK', 'PROSPECT PARK', 'THOMAS JEFFERSON PARK', 'HIGHBRIDGE PARK',
+         'TOMPKINS SQUARE PARK', 'HERBERT VON KING PARK', 'BRONX RIVER PARKWAY', 'UNNAMED PLAYGROUND']
+PARK_RATE = 0.01
+HOUSING_DEVELOPMENTS = ['MARCY', 'CASTLE HILL', 'JEFFERSON', 'WAGNER', 'PATTERSON', 'SOUNDVIEW', 'QUEENSBRIDGE NORTH', 'GRANT', 'LINCOLN', 'SEDGWICK']
+HOUSING_RATE = 0.08
+
+# First and last complaint date, most complaints are recent but some are decades old
+FIRST_DATE, LAST_DATE = datetime.date(2006, 1, 1), datetime.date(2022, 12, 31)
+OLD_DATE_RATE = 0.001
+
+CENSUS_RACES = ['All', 'Asian', 'Black', 'Hispanic', 'White']
+CENSUS_FILENAME = 'dcp-comps-of-chg-StoryMap-data-032023-Total-Population-{race}.csv'
+CENSUS_BOROUGHS = ['Manhattan', 'Bronx', 'Brooklyn', 'Queens', 'Staten Island']
+
+def _date_strings(first, last):
+    '''
+    Provides the `MM/DD/YYYY` string of every day from first to last, so dates are formatted with a single take.
+    '''
+    days = pd.date_range(first, last, freq='D')
+    return np.array(days.strftime('%m/%d/%Y'), dtype=object)
+
+def _time_strings():
+    '''
+    Provides the `HH:MM:SS` string of every second of a day.
+    '''
+    seconds = np.arange(86400)
+    return np.array([f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in seconds], dtype=object)
+
+def _with_nulls(rng, values, rate, null = '(null)'):
+    '''
+    Replaces a random share of the values with null.
+    '''
+    values = np.asarray(values, dtype=object)
+    values[rng.random(len(values)) < rate] = null
+    return values
+
+def generate_drug_crime(n, seed = 0, first_id = 0):
+    '''
+    Generates a raw Drug_Crime dataset with the columns, value formats and `(null)` rates of the NYC Open Data export.
+
+    Parameters:
+        n (int):        Number of complaints. Duplicate rows are added on top, see `DUPLICATE_RATE`.
+        seed (int):     Optional. Seed of the random generator. Defaults to 0.
+        first_id (int): Optional. Offset of the complaint numbers, so separately generated parts do not share IDs. Defaults to 0.
+
+    Returns:
+        pd.DataFrame of the raw dataset.
+    '''
+    assert isinstance(n, int) and n >= 0 and isinstance(seed, int)
+
+    rng = np.random.default_rng(seed)
+
+    # Borough, precinct and coordinates
+    boroughs = list(BOROUGHS)
+    borough_idx = rng.choice(len(boroughs), n, p=[BOROUGH_WEIGHTS[b] for b in boroughs])
+    precincts = np.zeros(n, dtype=np.int64)
+    lat, lon = np.zeros(n), np.zeros(n)
+    for i, borough in enumerate(boroughs):
+        rows = borough_idx == i
+        borough_precincts, (min_lat, max_lat, min_lon, max_lon) = BOROUGHS[borough]
+        precincts[rows] = rng.choice(borough_precincts, rows.sum())
+        lat[rows] = rng.uniform(min_lat, max_lat, rows.sum()).round(6)
+        lon[rows] = rng.uniform(min_lon, max_lon, rows.sum()).round(6)
+    borough_names = np.array(boroughs, dtype=object)[borough_idx]
+
+    # Dates and times
+    dates = _date_strings(FIRST_DATE, LAST_DATE)
+    old_dates = _date_strings(datetime.date(1990, 1, 1), FIRST_DATE - datetime.timedelta(days=1))
+    date_idx = rng.integers(0, len(dates), n)
+    from_dates = dates[date_idx]
+    old = rng.random(n) < OLD_DATE_RATE
+    from_dates[old] = old_dates[rng.integers(0, len(old_dates), old.sum())]
+    reported = dates[np.minimum(date_idx + rng.geometric(0.7, n) - 1, len(dates) - 1)]
+    to_dates = dates[np.minimum(date_idx + rng.integers(0, 2, n), len(dates) - 1)]
+    times = _time_strings()
+    from_times = times[rng.integers(0, 86400, n)]
+    to_times = times[rng.integers(0, 86400, n)]
+
+    # Crimes
+    crime_idx = rng.choice(len(CRIMES), n, p=np.array([c[4] for c in CRIMES]) / sum(c[4] for c in CRIMES))
+    crimes = np.array([c[0] for c in CRIMES], dtype=object)[crime_idx]
+    pd_codes = np.array([c[1] for c in CRIMES], dtype=np.float64)[crime_idx]
+    pd_codes[rng.random(n) < MISSING_PD_CD_RATE] = np.nan
+    ky_codes = np.array([c[2] for c in CRIMES])[crime_idx]
+    categories = np.array([c[3] for c in CRIMES], dtype=object)[crime_idx]
+
+    lat_lon = np.array([f'({a}, {b})' for a, b in zip(lat.tolist(), lon.tolist())], dtype=object)
+    missing = rng.random(n) < MISSING_LAT_LON_RATE
+    lat[missing], lon[missing], lat_lon[missing] = np.nan, np.nan, np.nan
+
+    parks = np.full(n, '(null)', dtype=object)
+    in_park = rng.random(n) < PARK_RATE
+    parks[in_park] = np.array(PARKS, dtype=object)[rng.integers(0, len(PARKS), in_park.sum())]
+    housing = np.full(n, '(null)', dtype=object)
+    in_housing = rng.random(n) < HOUSING_RATE
+    housing[in_housing] = np.array(HOUSING_DEVELOPMENTS, dtype=object)[rng.integers(0, len(HOUSING_DEVELOPMENTS), in_housing.sum())]
+
+    dataset = pd.DataFrame({'CMPLNT_NUM': first_id + rng.permutation(n) * 7 + 100000000,
+                            'CMPLNT_FR_DT': from_dates,
+                            'CMPLNT_FR_TM': _with_nulls(rng, from_times, NULL_RATES['CMPLNT_FR_TM']),
+                            'CMPLNT_TO_DT': _with_nulls(rng, to_dates, NULL_RATES['CMPLNT_TO_DT']),
+                            'CMPLNT_TO_TM': _with_nulls(rng, to_times, NULL_RATES['CMPLNT_TO_TM']),
+                            'ADDR_PCT_CD': precincts,
+                            'RPT_DT': reported,
+                            'KY_CD': ky_codes,
+                            'OFNS_DESC': 'DANGEROUS DRUGS',
+                            'PD_CD': pd_codes,
+                            'PD_DESC': crimes,
+                            'CRM_ATPT_CPTD_CD': np.where(rng.random(n) < 0.99, 'COMPLETED', 'ATTEMPTED'),
+                            'LAW_CAT_CD': categories,
+                            'BORO_NM': _with_nulls(rng, borough_names, NULL_RATES['BORO_NM']),
+                            'LOC_OF_OCCUR_DESC': _with_nulls(rng, rng.choice(LOCATIONS, n, p=LOCATION_WEIGHTS), NULL_RATES['LOC_OF_OCCUR_DESC']),
+                            'PREM_TYP_DESC': _with_nulls(rng, rng.choice(PREMISES, n, p=PREMISE_WEIGHTS), NULL_RATES['PREM_TYP_DESC']),
+                            'PARKS_NM': parks,
+                            'HADEVELOPT': housing,
+                            'Latitude': lat,
+                            'Longitude': lon,
+                            'Lat_Lon': lat_lon})[RAW_COLUMNS]
+
+    # Exact duplicates of random rows, at random positions
+    duplicates = dataset.iloc[rng.integers(0, max(n, 1), int(n * DUPLICATE_RATE))] if n > 0 else dataset.iloc[:0]
+    dataset = pd.concat([dataset, duplicates], ignore_index=True)
+    return dataset.iloc[rng.permutation(len(dataset))].reset_index(drop=True)
+
+def write_drug_crime(n, filename, seed = 0, chunk_rows = 1000000):
+    '''
+    Writes a raw Drug_Crime CSV of about n complaints, generated in chunks of chunk_rows so memory stays bounded at any n.
+    Every chunk has its own seed derived from seed, so the file only depends on seed, n and chunk_rows.
+    '''
+    assert isinstance(n, int) and isinstance(filename, str) and isinstance(chunk_rows, int) and chunk_rows > 0
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename + '.tmp', 'w', newline='') as f:
+        for i, start in enumerate(range(0, max(n, 1), chunk_rows)):
+            chunk = generate_drug_crime(min(chunk_rows, n - start), seed=seed * 1000003 + i, first_id=start)
+            chunk.to_csv(f, index=False, header=(i == 0))
+    os.replace(filename + '.tmp', filename)
+
+def generate_census(n, seed = 0):
+    '''
+    Generates the 5 raw census race datasets with the schema of `data/2020_Census/`, including the thousands separators of the numbers.
+    The first rows are the city and the boroughs, the others are neighborhood tabulation areas spread over the boroughs.
+
+    Parameters:
+        n (int):    Number of geographies, at least 6.
+        seed (int): Optional. Seed of the random generator. Defaults to 0.
+
+    Returns:
+        dict of the race as the key and the raw pd.DataFrame as the value.
+    '''
+    assert isinstance(n, int) and n >= 6
+
+    rng = np.random.default_rng(seed)
+    areas = n - 6
+    geo_types = ['NYC'] + ['Boro'] * 5 + ['NTA2020'] * areas
+    boroughs = ['New York City'] + CENSUS_BOROUGHS + list(np.array(CENSUS_BOROUGHS)[np.sort(rng.integers(0, 5, areas))])
+    geo_ids = ['0'] + [str(i) for i in range(1, 6)] + [f'{["MN", "BX", "BK", "QN", "SI"][CENSUS_BOROUGHS.index(b)]}{i:05d}' for i, b in enumerate(boroughs[6:])]
+    names = ['NYC (adjusted for citywide total population in 2010)'] + CENSUS_BOROUGHS + [f'Neighborhood {i}' for i in range(areas)]
+
+    # Population of every area, scaled for the races and summed for the boroughs and the city
+    area_pop = rng.integers(100, 100000, areas)
+    datasets = {}
+    for race, share in zip(CENSUS_RACES, [1.0, 0.15, 0.22, 0.28, 0.32]):
+        pop_10 = (area_pop * share * rng.uniform(0.5, 1.5, areas)).astype(np.int64)
+        pop_20 = (pop_10 * rng.uniform(0.8, 1.3, areas)).astype(np.int64)
+        natural = ((pop_20 - pop_10) * rng.uniform(-1, 2, areas)).astype(np.int64)
+
+        pops = []
+        for values in [pop_10, pop_20, pop_20 - pop_10, natural, pop_20 - pop_10 - natural]:
+            boro_values = [values[np.array(boroughs[6:]) == b].sum() for b in CENSUS_BOROUGHS]
+            pops.append([f'{v:,}' for v in [sum(boro_values)] + boro_values + values.tolist()])
+
+        datasets[race] = pd.DataFrame({'Orig Order': np.arange(1, n + 1), 'GeoType': geo_types, 'Borough': boroughs, 'GeoID': geo_ids, 'Name': names,
+                                       'NTA Type': [''] * 6 + ['0'] * areas, 'Pop_10': pops[0], 'Pop_20': pops[1], 'Pop Change': pops[2],
+                                       'Natural Change': pops[3], 'Net Migration': pops[4]})
+
+    return datasets
+
+def write_census(n, census_dir, seed = 0):
+    '''
+    Writes the census CSVs of `generate_census` with the file names of `data/2020_Census/`, so `import_csv_data` labels them by race.
+    '''
+    os.makedirs(census_dir, exist_ok=True)
+    for race, dataset in generate_census(n, seed).items():
+        dataset.to_csv(os.path.join(census_dir, CENSUS_FILENAME.format(race=race)), index=False)
+
+def write_precinct_table(precinct_dir):
+    '''
+    Writes a local precinct table of every generated precinct, used instead of the one in `data/Precincts/` so the benchmarks do not depend on it.
+    '''
+    os.makedirs(precinct_dir, exist_ok=True)
+    precincts = sorted(p for precincts, _ in BOROUGHS.values() for p in precincts)
+    table = pd.DataFrame({'Precinct': precincts,
+                          'Precinct Name': [f'{p}th Precinct' for p in precincts],
+                          'Phone': [f'718-555-{p:04d}' for p in precincts],
+                          'Address': [f'{p} Precinct Street' for p in precincts]})
+    table.to_csv(os.path.join(precinct_dir, 'precincts_v1.csv'), index=False)
+
+def dataset_paths(rows, data_dir = DATA_DIR):
+    '''
+    Provides the paths of the synthetic datasets of a scale.
+
+    Returns:
+        dict of the `drug_crime` CSV, the `census` CSVs and the `precincts` directory.
+    '''
+    scale_dir = os.path.join(data_dir, str(rows))
+    return {'drug_crime': os.path.join(scale_dir, 'Drug_Crime_synthetic.csv'),
+            'census': [os.path.join(scale_dir, '2020_Census', CENSUS_FILENAME.format(race=race)) for race in CENSUS_RACES],
+            'precincts': os.path.join(scale_dir, 'Precincts')}
+
+def generate(rows, data_dir = DATA_DIR, seed = 0, force = False):
+    '''
+    Writes the synthetic datasets of a scale, unless they already exist. The census has one geography per 10 complaints, at least as many as the real one.
+
+    Parameters:
+        rows (int):     Number of complaints.
+        data_dir (str): Optional. Directory of the datasets of all scales. Defaults to `benchmarks/data`.
+        seed (int):     Optional. Seed of the random generator. Defaults to 0.
+        force (bool):   Optional. Write the datasets even if they exist. Defaults to `False`.
+
+    Returns:
+        dict of the paths, see `dataset_paths`.
+    '''
+    paths = dataset_paths(rows, data_dir)
+    if force or not os.path.isfile(paths['drug_crime']):
+        write_drug_crime(rows, paths['drug_crime'], seed)
+    if force or not all(os.path.isfile(path) for path in paths['census']):
+        write_census(max(rows // 10, 268), os.path.dirname(paths['census'][0]), seed)
+    if force or not os.path.isdir(paths['precincts']):
+        write_precinct_table(paths['precincts'])
+
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic raw datasets for the benchmarks')
+    parser.add_argument('--rows', type=int, nargs='+', default=SCALES[:2], help='Number of complaints of each scale')
+    parser.add_argument('--out', default=DATA_DIR, help='Directory to write the datasets to')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('--force', action='store_true', help='Write the datasets even if they exist')
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        print(generate(rows, args.out, args.seed, args.force)['drug_crime'])
@@ -0,0 +1,233 @@
+'''
+Benchmarks of the preprocessing and analysis hot paths on the synthetic datasets of `benchmarks/generate.py`.
+
+    python benchmarks/run.py --rows 10000 100000 --output results.json
+    python benchmarks/run.py --rows 10000 100000 --baseline results.json
+
+Every benchmark reports its wall time (best of --repeat runs), throughput in rows per second and peak memory, i.e. the most memory allocated
+by the run on top of its inputs as traced by `tracemalloc` (numpy and pandas allocations included). The results are written as JSON, and compared
+against a baseline JSON with --baseline, which exits with status 1 if any benchmark got slower or bigger than the tolerance.
+Runs offline, the precinct table is the local one written by the generator.
+'''
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_utils as du
+import preprocess_utils as pu
+import NYC_Analysis as na
+from cube_utils import CensusCube, CountCube
+
+import generate
+
+# Census feature used by the census benchmarks
+CENSUS_FEATURE = 'Pop_20'
+
+class Inputs:
+    '''
+    Lazily built inputs of the benchmarks of one scale, shared by all benchmarks of the scale. Building them is not part of any measurement.
+    '''
+    def __init__(self, paths):
+        self.paths = paths
+
+    @functools.cached_property
+    def raw(self):
+        return pd.read_csv(self.paths['drug_crime'])
+
+    @functools.cached_property
+    def raw_census(self):
+        return du.import_csv_data(self.paths['census'])
+
+    @functools.cached_property
+    def drug_crime(self):
+        return pu.preprocess_drug_crime(self.raw.copy(), 'vectorized')
+
+    @functools.cached_property
+    def census(self):
+        return pu.preprocess_census({race: dataset.copy() for race, dataset in self.raw_census.items()})
+
+    @functools.cached_property
+    def park_index(self):
+        return du.build_park_index(self.drug_crime['PARKS_NM'])
+
+# Benchmarks by name. Each takes the Inputs of a scale and returns the function to measure, so preparing its arguments, e.g. copying a dataset it modifies, is not measured.
+# They are called again before every run, so every run gets fresh arguments.
+BENCHMARKS = {
+    'import_csv_data': lambda inputs: lambda: du.import_csv_data([inputs.paths['drug_crime']]),
+    'preprocess_drug_crime[python]': lambda inputs: functools.partial(pu.preprocess_drug_crime, inputs.raw.copy(), 'python'),
+    'preprocess_drug_crime[vectorized]': lambda inputs: functools.partial(pu.preprocess_drug_crime, inputs.raw.copy(), 'vectorized'),
+    'stream_drug_crime[vectorized]': lambda inputs: functools.partial(pu.stream_drug_crime, inputs.paths['drug_crime'], engine='vectorized'),
+    'preprocess_census': lambda inputs: functools.partial(pu.preprocess_census, {race: dataset.copy() for race, dataset in inputs.raw_census.items()}),
+    'compact_drug_crime': lambda inputs: functools.partial(pu.compact_drug_crime, inputs.drug_crime),
+    'clean_missing_boroughs': lambda inputs: functools.partial(pu.clean_missing_boroughs, inputs.drug_crime.copy()),
+    'count_time_part': lambda inputs: functools.partial(du.count_time_part, inputs.drug_crime['Time'], ['hour', 'minute']),
+    'group_count_parks': lambda inputs: functools.partial(du.group_count_parks, inputs.drug_crime['PARKS_NM']),
+    'group_count_parks[indexed]': lambda inputs: functools.partial(du.group_count_parks, inputs.drug_crime['PARKS_NM'], index=inputs.park_index),
+    'normalize': lambda inputs: functools.partial(du.normalize, du.filter_by_boro_feature(inputs.census, '', CENSUS_FEATURE)),
+    'normalize[inplace]': lambda inputs: functools.partial(du.normalize, du.filter_by_boro_feature(inputs.census, '', CENSUS_FEATURE).astype('float64'), inplace=True),
+    'census_cube_normalize': lambda inputs: functools.partial(CensusCube.from_census(inputs.census).normalize, 'row'),
+    'count_cube': lambda inputs: lambda: CountCube.from_dataset(inputs.drug_crime).counts(['Year', 'BORO_NM'], {'Crime Category': 'FELONY'}),
+    'train': lambda inputs: functools.partial(na.train, inputs.drug_crime, n_estimators=20),
+    'end_to_end': lambda inputs: lambda: end_to_end(inputs.paths),
+}
+
+# Rows each benchmark is measured by, the census benchmarks count geographies instead of complaints
+CENSUS_BENCHMARKS = ['preprocess_census', 'normalize', 'normalize[inplace]', 'census_cube_normalize']
+
+def end_to_end(paths):
+    '''
+    Imports and preprocesses the datasets and runs the analysis steps of the visualization notebook on them.
+    '''
+    datasets = pu.preprocess_datasets(du.import_csv_data([paths['drug_crime']] + paths['census']), engine='vectorized')
+    drug_crime = pu.clean_missing_boroughs(datasets['Drug_Crime'])
+    du.count_time_part(drug_crime['Time'], ['hour', 'minute'])
+    du.group_count_parks(drug_crime['PARKS_NM'])
+    du.normalize(du.filter_by_boro_feature(datasets['Census'], '', CENSUS_FEATURE))
+    CountCube.from_dataset(drug_crime).counts(['Year', 'BORO_NM'])
+
+def use_precinct_table(precinct_dir):
+    '''
+    Makes the preprocessing use the precinct table of the synthetic datasets instead of the one in `data/Precincts/`.
+    '''
+    pu.PRECINCT_DIR = precinct_dir
+    pu.load_precinct_table.cache_clear()
+
+def measure(setup, repeat = 3, memory = True):
+    '''
+    Measures a function.
+
+    Parameters:
+        setup (callable):       Function without arguments that returns the function to measure, also without arguments. Only the returned function is measured.
+        repeat (int):           Optional. Number of timed runs. Defaults to 3.
+        memory (bool):          Optional. Also measure the peak memory with an extra run, which is slower under tracemalloc. Defaults to `True`.
+
+    Returns:
+        dict of the best and median seconds of the runs and the peak memory in bytes (None if not measured).
+    '''
+    seconds = []
+    for _ in range(repeat):
+        function = setup()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        function = setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds': min(seconds), 'median_seconds': float(np.median(seconds)), 'peak_memory_bytes': peak}
+
+def run(rows, names = list(BENCHMARKS), repeat = 3, memory = True, data_dir = generate.DATA_DIR, seed = 0):
+    '''
+    Runs the benchmarks on the synthetic datasets of every scale, generating the datasets first if they do not exist.
+
+    Parameters:
+        rows (list):        Number of complaints of each scale.
+        names (list):       Optional. Names of the benchmarks to run. Defaults to all of `BENCHMARKS`.
+        repeat (int):       Optional. Number of timed runs of each benchmark. Defaults to 3.
+        memory (bool):      Optional. Also measure the peak memory. Defaults to `True`.
+        data_dir (str):     Optional. Directory of the synthetic datasets. Defaults to `benchmarks/data`.
+        seed (int):         Optional. Seed of the synthetic datasets. Defaults to 0.
+
+    Returns:
+        dict of the run metadata and the list of results, one per benchmark and scale.
+    '''
+    assert isinstance(rows, list) and isinstance(names, list) and all(name in BENCHMARKS for name in names)
+
+    results = []
+    for n in rows:
+        paths = generate.generate(n, data_dir, seed)
+        use_precinct_table(paths['precincts'])
+        inputs = Inputs(paths)
+        for name in names:
+            result = measure(functools.partial(BENCHMARKS[name], inputs), repeat, memory)
+            measured_rows = len(inputs.raw_census['All']) if name in CENSUS_BENCHMARKS else n
+            result.update({'benchmark': name, 'rows': n, 'measured_rows': measured_rows,
+                           'rows_per_second': measured_rows / result['seconds'] if result['seconds'] > 0 else None})
+            results.append(result)
+            print(format_result(result), flush=True)
+        del inputs
+        gc.collect()
+
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed, 'repeat': repeat, 'python': platform.python_version(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+    return {'meta': meta, 'results': results}
+
+def format_result(result):
+    '''
+    Formats a result as a line of the report.
+    '''
+    memory = f"{result['peak_memory_bytes'] / 2**20:10.1f} MiB" if result['peak_memory_bytes'] is not None else ' ' * 14
+    return f"{result['benchmark']:36} {result['rows']:>10} rows {result['seconds']:10.4f} s {result['rows_per_second'] or 0:14,.0f} rows/s {memory}"
+
+def compare(results, baseline, tolerance = 0.25):
+    '''
+    Compares results against a baseline of the same benchmarks and scales.
+
+    Parameters:
+        results (dict):     Results of `run`.
+        baseline (dict):    Results of an earlier `run`, e.g. read from its JSON.
+        tolerance (float):  Optional. Allowed relative increase of the time and the peak memory. Defaults to 0.25 (25%).
+
+    Returns:
+        list of str of the regressions, empty if there are none.
+    '''
+    assert isinstance(results, dict) and isinstance(baseline, dict)
+
+    base = {(result['benchmark'], result['rows']): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        key = (result['benchmark'], result['rows'])
+        if key not in base:
+            continue
+        for metric in ['seconds', 'peak_memory_bytes']:
+            old, new = base[key][metric], result[metric]
+            if old is not None and new is not None and old > 0 and new > old * (1 + tolerance):
+                regressions.append(f'{key[0]} at {key[1]} rows: {metric} {old:.4g} -> {new:.4g} (+{(new / old - 1) * 100:.0f}%)')
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing and analysis functions on synthetic datasets')
+    parser.add_argument('--rows', type=int, nargs='+', default=generate.SCALES[:2], help='Number of complaints of each scale, e.g. 10000 100000 1000000 10000000')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS), metavar='NAME', help='Benchmarks to run, defaults to all')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory measurement')
+    parser.add_argument('--data', default=generate.DATA_DIR, help='Directory of the synthetic datasets')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets')
+    parser.add_argument('--output', help='File to write the results JSON to')
+    parser.add_argument('--baseline', help='Results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown or memory growth against the baseline')
+    args = parser.parse_args()
+
+    # Deprecation warnings of the measured code would be printed on every run
+    warnings.simplefilter('ignore', FutureWarning)
+    results = run(args.rows, args.benchmarks, args.repeat, not args.no_memory, args.data, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,248 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import glob
+import os
+import data_utils as du
+import preprocess_utils as pu
+from cube_utils import CountCube
+
+# Bump whenever the on-disk layout of the cache changes
+CACHE_VERSION = 2
+CACHE_DIR = os.path.join('data', '.cache')
+
+def fingerprint_files(filenames, block_size = 1 << 20):
+    '''
+    Hashes the contents of the given files. The file order does not matter, the files are hashed in sorted order of their basenames.
+
+    Parameters:
+        filenames (list):   List of file names as strings.
+        block_size (int):   Optional. Number of bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str of the hex digest of all of the files.
+    '''
+    assert isinstance(filenames, list) and isinstance(block_size, int)
+
+    digest = hashlib.blake2b(digest_size=20)
+    for filename in sorted(filenames, key=os.path.basename):
+        assert isinstance(filename, str)
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+# Source files of every module the cached datasets and cubes depend on: the import, the preprocessing and its stages, the district join and the cube.
+# spatial_utils is only imported by preprocessing with districts, so its source is hashed without importing it.
+PIPELINE_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py') 
+                    for name in ['data_utils', 'preprocess_utils', 'stage_utils', 'spatial_utils', 'cube_utils']]
+
+def code_version(modules = None):
+    '''
+    Provides a version string for the preprocessing code. Any edit to the source of the given modules or to `CACHE_VERSION` changes the version.
+
+    Parameters:
+        modules (list): Optional. List of modules whose source code the result depends on. If `None` (default), the modules of the preprocessing pipeline, see `PIPELINE_SOURCES`.
+
+    Returns:
+        str of the hex digest of the code version.
+    '''
+    assert modules is None or isinstance(modules, list)
+
+    filenames = PIPELINE_SOURCES if modules is None else [module.__file__ for module in modules]
+    digest = hashlib.blake2b(str(CACHE_VERSION).encode(), digest_size=20)
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+# Parameters of `preprocess_datasets` that change the preprocessed datasets, with their defaults.
+# The others, the number of workers and the stage report, do not change them and are not part of the cache key.
+CACHE_PARAMS = {'engine': 'python', 'compact': False, 'districts': False}
+
+def cache_key(filenames, params = {}):
+    '''
+    Builds the cache key of the preprocessed datasets from the input files, the preprocessing parameters of `CACHE_PARAMS` and the code version.
+
+    Parameters:
+        filenames (list):   List of the raw dataset file names as strings.
+        params (dict):      Optional. Keyword arguments passed to `preprocess_datasets`. Missing parameters of `CACHE_PARAMS` key the same as their defaults.
+
+    Returns:
+        str of the cache key.
+    '''
+    assert isinstance(filenames, list) and isinstance(params, dict)
+
+    keyed = {name: params.get(name, default) for name, default in CACHE_PARAMS.items()}
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(fingerprint_files(filenames).encode())
+    digest.update(json.dumps(keyed, sort_keys=True).encode())
+    digest.update(code_version().encode())
+
+    return digest.hexdigest()
+
+# Written last by `save_datasets`, so a directory without it holds no complete set of datasets
+DATASETS_MARKER = '_datasets.json'
+
+def save_datasets(datasets, path):
+    '''
+    Writes each dataset to a Parquet file in the given directory. Columns of tuples, i.e. `Lat_Lon`, are stored as one float column per tuple element.
+    The metadata of a dataset is written before its Parquet file, and `DATASETS_MARKER` with the dataset names after all of them, see `has_datasets`.
+
+    Parameters:
+        datasets (dict):    Dict of the dataset name as the key and the pd.DataFrame as the value.
+        path (str):         Directory to write the Parquet files to. Created if missing.
+    '''
+    assert isinstance(datasets, dict) and isinstance(path, str)
+
+    os.makedirs(path, exist_ok=True)
+    if os.path.isfile(os.path.join(path, DATASETS_MARKER)):
+        os.remove(os.path.join(path, DATASETS_MARKER))
+    for name, dataset in datasets.items():
+        assert isinstance(dataset, pd.DataFrame)
+
+        dataset = dataset.copy(deep=False)
+        tuple_cols = []
+        for col in dataset.columns[dataset.dtypes == object]:
+            if len(dataset) > 0 and isinstance(dataset[col].iloc[0], tuple):
+                parts = pd.DataFrame(dataset[col].tolist(), index=dataset.index)
+                for i in parts.columns:
+                    dataset[f'{col}.{i}'] = parts[i]
+                dataset.drop(columns=col, inplace=True)
+                tuple_cols.append(col)
+
+        with open(os.path.join(path, f'{name}.json'), 'w') as f:
+            json.dump({'tuple_cols': tuple_cols, 'columns': [str(col) for col in datasets[name].columns]}, f)
+        # Write to a temporary file first so an interrupted run never leaves a partial cache behind
+        filename = os.path.join(path, f'{name}.parquet')
+        dataset.to_parquet(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    with open(os.path.join(path, DATASETS_MARKER), 'w') as f:
+        json.dump(list(datasets), f)
+
+def has_datasets(path):
+    '''
+    Checks whether `save_datasets` finished writing the datasets of the given directory.
+
+    Parameters:
+        path (str): Directory of the Parquet files.
+
+    Returns:
+        bool, True if the directory holds a complete set of datasets.
+    '''
+    assert isinstance(path, str)
+
+    return os.path.isfile(os.path.join(path, DATASETS_MARKER))
+
+def load_datasets(path):
+    '''
+    Reads the datasets written by `save_datasets`.
+
+    Parameters:
+        path (str): Directory of the Parquet files.
+
+    Returns:
+        dict of datasets with the dataset name as the key and the pd.DataFrame as the value.
+    '''
+    assert isinstance(path, str)
+
+    datasets = {}
+    for filename in sorted(glob.glob(os.path.join(path, '*.parquet'))):
+        name = os.path.basename(filename)[:-len('.parquet')]
+        with open(os.path.join(path, f'{name}.json')) as f:
+            meta = json.load(f)
+
+        dataset = pd.read_parquet(filename)
+        # Parquet reads missing values of object columns back as None
+        for col in dataset.columns[dataset.dtypes == object]:
+            dataset[col] = dataset[col].where(dataset[col].notna(), np.nan)
+        for col in meta['tuple_cols']:
+            part_cols = [c for c in dataset.columns if c.startswith(f'{col}.')]
+            dataset[col] = list(zip(*[dataset[c].tolist() for c in part_cols]))
+            dataset.drop(columns=part_cols, inplace=True)
+        datasets[name] = dataset[meta['columns']]
+
+    return datasets
+
+def cache_path(filenames = [], cache_dir = CACHE_DIR, **params):
+    '''
+    Provides the cache directory of the preprocessed datasets of the given files and preprocessing parameters.
+
+    Parameters:
+        filenames (list):   Optional. List of CSV file names as strings. If empty (default), all relevant dataset CSVs located in data/ are used.
+        cache_dir (str):    Optional. Directory of the cache. Defaults to `data/.cache`.
+        params:             Optional. Keyword arguments passed to `preprocess_datasets`.
+
+    Returns:
+        str of the cache directory.
+    '''
+    assert isinstance(filenames, list) and isinstance(cache_dir, str)
+
+    if len(filenames) == 0:
+        filenames = du.default_csv_filenames()
+
+    # The precinct table is merged onto Drug_Crime, so it is an input as well, and so are the community district polygons if the districts are assigned
+    inputs = filenames + [pu.precinct_table_path()]
+    if params.get('districts', False):
+        import spatial_utils as su
+        inputs.append(su.COMMUNITY_DISTRICTS)
+    return os.path.join(cache_dir, cache_key(inputs, params))
+
+def load_preprocessed_datasets(filenames = [], cache_dir = CACHE_DIR, refresh = False, **params):
+    '''
+    Imports and preprocesses the datasets, reusing the cached result of a previous run when the input files, the preprocessing parameters and the code are unchanged.
+    A cache miss imports the datasets with `import_csv_data`, preprocesses them with `preprocess_datasets` and writes the result to `cache_dir`.
+
+    Parameters:
+        filenames (list):   Optional. List of CSV file names as strings. If empty (default), all relevant dataset CSVs located in data/ are used, same as `import_csv_data`.
+        cache_dir (str):    Optional. Directory of the cache. Defaults to `data/.cache`.
+        refresh (bool):     Optional. Ignore any cached result and preprocess again. Defaults to `False`.
+        params:             Optional. Keyword arguments passed to `preprocess_datasets`. The ones of `CACHE_PARAMS` are part of the cache key, e.g. `workers` and `report` are passed through.
+
+    Returns:
+        dict of preprocessed datasets, the same as `preprocess_datasets`.
+    '''
+    assert isinstance(filenames, list) and isinstance(cache_dir, str) and isinstance(refresh, bool)
+
+    if len(filenames) == 0:
+        filenames = du.default_csv_filenames()
+
+    path = cache_path(filenames, cache_dir, **params)
+    if not refresh and has_datasets(path):
+        return load_datasets(path)
+
+    datasets = pu.preprocess_datasets(du.import_csv_data(filenames), **params)
+    save_datasets(datasets, path)
+
+    return datasets
+
+def load_count_cube(filenames = [], cache_dir = CACHE_DIR, refresh = False, **params):
+    '''
+    Provides the `cube_utils.CountCube` of the preprocessed Drug_Crime dataset, stored next to the cached datasets.
+    Once the cube is cached, it is loaded without loading the datasets themselves.
+
+    Parameters:
+        filenames (list):   Optional. List of CSV file names as strings. If empty (default), all relevant dataset CSVs located in data/ are used.
+        cache_dir (str):    Optional. Directory of the cache. Defaults to `data/.cache`.
+        refresh (bool):     Optional. Ignore any cached cube and build it again. Defaults to `False`.
+        params:             Optional. Keyword arguments passed to `preprocess_datasets`.
+
+    Returns:
+        CountCube of the Drug_Crime dataset.
+    '''
+    assert isinstance(filenames, list) and isinstance(cache_dir, str) and isinstance(refresh, bool)
+
+    # Kept in a subdirectory so `load_datasets` does not pick it up as a dataset
+    filename = os.path.join(cache_path(filenames, cache_dir, **params), 'cubes', 'Drug_Crime_Counts.parquet')
+    if not refresh and os.path.isfile(filename):
+        return CountCube.load(filename)
+
+    cube = CountCube.from_dataset(load_preprocessed_datasets(filenames, cache_dir, **params)['Drug_Crime'])
+    cube.save(filename)
+
+    return cube
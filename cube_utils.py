@@ -0,0 +1,342 @@
+import pandas as pd
+import numpy as np
+import os
+import preprocess_utils as pu
+
+# Fixed race and feature axes of the census cube
+CENSUS_RACES = ['All', 'Asian', 'Black', 'Hispanic', 'White']
+CENSUS_FEATURES = ['Pop Change', 'Natural Change', 'Net Migration', 'Pop_10', 'Pop_20']
+
+# Columns that describe each geography of the census datasets
+CENSUS_GEO_COLUMNS = ['GeoType', 'Borough', 'Name']
+
+# Norms the values can be normalized by, and their order for np.linalg.norm
+NORM_ORDERS = {'l2': None, 'l1': 1, 'max': np.inf}
+
+def vector_norms(values, axis, norm = 'l2'):
+    '''
+    Computes the norm of every vector of an array along an axis in one pass, e.g. of every row of a 2-D array with axis 1.
+
+    Parameters:
+        values (np.ndarray):    Array of numbers.
+        axis (int):             Axis the vectors run along.
+        norm (str):             Optional. `'l2'` (euclidean, default), `'l1'` (sum of absolute values) or `'max'` (largest absolute value).
+
+    Returns:
+        np.ndarray of the norms, with the axis kept as length 1 so the values can be divided by it.
+    '''
+    assert norm in NORM_ORDERS
+
+    if values.shape[axis] == 0:
+        return np.zeros(values.shape[:axis] + (1,) + values.shape[axis + 1:])
+    return np.linalg.norm(values, ord=NORM_ORDERS[norm], axis=axis, keepdims=True)
+
+def combine_norms(norms, norm = 'l2'):
+    '''
+    Combines the norms of the parts of the same vectors, e.g. of the row chunks of the columns of a table, into the norms of the whole vectors.
+
+    Parameters:
+        norms (list):   np.ndarray of the norms of every part, all of the same shape, from `vector_norms`.
+        norm (str):     Optional. Norm the parts were computed with. Defaults to `'l2'`.
+
+    Returns:
+        np.ndarray of the norms.
+    '''
+    assert isinstance(norms, list) and len(norms) > 0 and norm in NORM_ORDERS
+
+    if norm == 'l2':
+        return np.sqrt(sum(np.square(part) for part in norms))
+    if norm == 'l1':
+        return sum(norms)
+    return np.maximum.reduce(norms)
+
+def nonzero_norms(norms):
+    '''
+    Replaces the zero norms by 1, so dividing by them leaves all zero vectors at zero instead of NaN.
+    '''
+    return np.where(norms == 0, 1, norms)
+
+class CensusCube:
+    '''
+    Census data held as a 3-D array indexed by (geography, race, feature), with a GeoID/Borough index, the races of `CENSUS_RACES` in the order they were given in and the `CENSUS_FEATURES` axis.
+    The geographies are grouped by borough, so slicing a borough and a feature is a view of the array instead of a copy. Their original order is kept in `positions`, so all geographies are given back in it.
+    Build it with `CensusCube.from_datasets` from the raw census datasets or with `CensusCube.from_census` from the preprocessed Census dataset.
+
+    Attributes:
+        values (np.ndarray):    3-D array of shape (geography, race, feature).
+        index (pd.DataFrame):   The `GeoType`, `Borough` and `Name` of each geography, indexed by GeoID.
+        races (list):           Race of each position of the race axis.
+        features (list):        Feature of each position of the feature axis.
+        positions (np.ndarray): Position of each geography in the order it was given in, e.g. its row of the Census dataset.
+    '''
+    def __init__(self, values, index, races = CENSUS_RACES, features = CENSUS_FEATURES, positions = None):
+        assert isinstance(values, np.ndarray) and values.ndim == 3 and isinstance(index, pd.DataFrame)
+        assert values.shape == (len(index), len(races), len(features))
+        assert positions is None or len(positions) == len(index)
+
+        # Group the geographies by borough, keeping their order within each borough
+        positions = np.arange(len(index)) if positions is None else np.asarray(positions)
+        boroughs = pd.unique(index['Borough'])
+        order = np.argsort(pd.Categorical(index['Borough'], categories=boroughs).codes, kind='stable')
+        if (order != np.arange(len(order))).any():
+            values, index, positions = values[order], index.iloc[order], positions[order]
+
+        self.values = values
+        self.index = index
+        self.races = list(races)
+        self.features = list(features)
+        self.positions = positions
+        # Rows of the cube in their original order, None if the geographies were given grouped by borough already
+        self._original_rows = None if (np.diff(positions) > 0).all() else np.argsort(positions, kind='stable')
+
+        codes = pd.Categorical(index['Borough'], categories=boroughs).codes
+        starts = np.searchsorted(codes, np.arange(len(boroughs)), side='left')
+        ends = np.searchsorted(codes, np.arange(len(boroughs)), side='right')
+        self._boro_slices = {boro: slice(start, end) for boro, start, end in zip(boroughs, starts, ends)}
+
+    @classmethod
+    def from_datasets(cls, datasets):
+        '''
+        Builds the cube from the raw census race datasets with a single concat of the races.
+
+        Parameters:
+            datasets (dict):    Dict of the race as the key and the raw census pd.DataFrame as the value, e.g. from `import_csv_data`. The datasets are modified like with `preprocess_census`.
+
+        Returns:
+            CensusCube of the races in `CENSUS_RACES` that are in datasets, in the order of datasets like the columns of `preprocess_census`.
+        '''
+        assert isinstance(datasets, dict)
+
+        races = [race for race in datasets if race in CENSUS_RACES]
+        assert len(races) > 0
+        index = datasets[races[0]].set_index('GeoID')[CENSUS_GEO_COLUMNS]
+        converted = [pu.convert_census_race(race, datasets[race]).set_index('GeoID') for race in races]
+        columns = [f'{race} {feature}' for race in races for feature in CENSUS_FEATURES]
+        values = pd.concat(converted, axis=1).reindex(index.index)[columns].to_numpy()
+
+        return cls(values.reshape(len(index), len(races), len(CENSUS_FEATURES)), index, races)
+
+    @classmethod
+    def from_census(cls, census):
+        '''
+        Builds the cube from the preprocessed Census dataset, i.e. `preprocess_datasets(...)['Census']`.
+
+        Parameters:
+            census (pd.DataFrame):  Preprocessed Census dataset with `{race} {feature}` columns, indexed by GeoID.
+
+        Returns:
+            CensusCube of the races in `CENSUS_RACES` that are in census, in the order of their columns.
+        '''
+        assert isinstance(census, pd.DataFrame)
+
+        races = [col[:-len(f' {CENSUS_FEATURES[0]}')] for col in census.columns if col.endswith(f' {CENSUS_FEATURES[0]}')]
+        races = [race for race in races if race in CENSUS_RACES]
+        assert len(races) > 0
+        columns = [f'{race} {feature}' for race in races for feature in CENSUS_FEATURES]
+        values = census[columns].to_numpy()
+
+        return cls(values.reshape(len(census), len(races), len(CENSUS_FEATURES)), census[CENSUS_GEO_COLUMNS], races)
+
+    def boro_slice(self, boro = ''):
+        '''
+        Provides the slice of the geography axis of a borough.
+
+        Parameters:
+            boro (str): Optional. The borough. If empty (default), all geographies.
+
+        Returns:
+            slice of the geography axis.
+        '''
+        assert isinstance(boro, str)
+
+        if boro == '':
+            return slice(0, len(self.index))
+        # Boroughs missing from the cube have no geographies, like filtering a DataFrame would give
+        return self._boro_slices.get(boro, slice(0, 0))
+
+    def filter(self, boro = '', feature = '', rename = True):
+        '''
+        Filters the cube by the borough and feature, same as `data_utils.filter_by_boro_feature` on the Census dataset, with the geographies and races in the same order.
+        The result is a view of the cube, not a copy, except for all boroughs of geographies that were not given grouped by borough, which are copied back into their original order.
+
+        Parameters:
+            boro (str):     Optional. The desired borough to filter by. If empty (default), all boroughs returned.
+            feature (str):  The desired feature to filter by, one of `CENSUS_FEATURES`.
+            rename (bool):  Optional. Whether to name the columns by only the race, e.g. "All Pop_10" -> "All". Defaults to `True`.
+
+        Returns:
+            pd.DataFrame with one row per geography and one column per race.
+        '''
+        assert isinstance(boro, str) and isinstance(feature, str) and isinstance(rename, bool)
+        assert feature in self.features
+
+        rows = self.boro_slice(boro) if boro != '' or self._original_rows is None else self._original_rows
+        columns = self.races if rename else [f'{race} {feature}' for race in self.races]
+
+        return pd.DataFrame(self.values[rows, :, self.features.index(feature)], index=self.index.index[rows], columns=columns, copy=False)
+
+    def normalize(self, axis = 'row', inplace = False, norm = 'l2'):
+        '''
+        Normalizes the cube to unit vectors, the same as `data_utils.normalize` on each feature of the filtered cube.
+        `'row'` normalizes each geography over the races, `'col'` normalizes each race over the geographies. All zero vectors stay zero.
+
+        Parameters:
+            axis (str):     Optional. `'row'` or `'col'`. Defaults to `'row'`.
+            inplace (bool): Optional. Normalize the values of this cube instead of a new one. The values must be a float array. Defaults to `False`.
+            norm (str):     Optional. `'l2'` (euclidean, default), `'l1'` or `'max'`, see `vector_norms`.
+
+        Returns:
+            CensusCube of the normalized values.
+        '''
+        assert isinstance(axis, str) and isinstance(inplace, bool)
+        assert axis in ['row', 'col'] and norm in NORM_ORDERS
+
+        norms = nonzero_norms(vector_norms(self.values, 1 if axis == 'row' else 0, norm))
+        if inplace:
+            assert np.issubdtype(self.values.dtype, np.floating)
+            np.divide(self.values, norms, out=self.values)
+            return self
+
+        return CensusCube(self.values / norms, self.index, self.races, self.features, self.positions)
+
+# Dimensions of the Drug_Crime count cube, the columns most reports group the complaints by
+COUNT_DIMENSIONS = ['Year', 'Month', 'BORO_NM', 'Precinct', 'Crime', 'Crime Category', 'Time of Day']
+
+class CountCube:
+    '''
+    Complaint counts of the Drug_Crime dataset over the `COUNT_DIMENSIONS`, built once with `CountCube.from_dataset` and queried with `counts`.
+    Only the non-empty cells are stored (a sparse cube), so its size is bounded by the number of distinct combinations instead of the product of the dimension sizes.
+
+    Attributes:
+        codes (np.ndarray):         2-D int array of shape (cell, dimension) of the position of each cell in the levels of every dimension.
+        cell_counts (np.ndarray):   Number of complaints of each cell.
+        levels (dict):              Dict of the dimension as the key and the pd.Index of its sorted values as the value.
+        dimensions (list):          Dimension of each column of codes.
+    '''
+    def __init__(self, codes, cell_counts, levels):
+        assert isinstance(codes, np.ndarray) and codes.ndim == 2 and isinstance(levels, dict)
+        assert codes.shape == (len(cell_counts), len(levels))
+
+        self.codes = codes
+        self.cell_counts = cell_counts
+        self.levels = levels
+        self.dimensions = list(levels)
+
+    @classmethod
+    def from_dataset(cls, dataset, dimensions = COUNT_DIMENSIONS):
+        '''
+        Builds the cube with a single pass over the preprocessed Drug_Crime dataset, regular or compact form. Missing values are kept as a level of their own, e.g. crimes not in `CRIME_NAMES`.
+
+        Parameters:
+            dataset (pd.DataFrame): Preprocessed Drug_Crime dataset.
+            dimensions (list):      Optional. Columns to count over. Defaults to `COUNT_DIMENSIONS`.
+
+        Returns:
+            CountCube of the dataset.
+        '''
+        assert isinstance(dataset, pd.DataFrame) and isinstance(dimensions, list)
+        assert all(col in dataset.columns for col in dimensions)
+
+        levels, codes = {}, []
+        for col in dimensions:
+            col_codes, col_levels = pd.factorize(dataset[col], sort=True, use_na_sentinel=False)
+            codes.append(col_codes)
+            levels[col] = pd.Index(col_levels, name=col)
+        codes = np.stack(codes, axis=1)
+
+        shape = tuple(len(levels[col]) for col in dimensions)
+        cells, cell_counts = np.unique(np.ravel_multi_index(codes.T, shape), return_counts=True)
+
+        return cls(np.stack(np.unravel_index(cells, shape), axis=1), cell_counts, levels)
+
+    def counts(self, by = [], where = {}):
+        '''
+        Counts the complaints grouped by some of the dimensions, optionally filtered, from the cube instead of the dataset.
+        The result is the same as `dataset[mask].groupby(by).size()`, so complaints with a missing value in a by dimension are not counted.
+
+        Parameters:
+            by (str|list):  Optional. Dimension(s) to group by. If empty (default), the total count is returned.
+            where (dict):   Optional. Dict of the dimension as the key and the value, or list of values, to keep as the value, e.g. `{'BORO_NM': 'BRONX', 'Year': [2019, 2020]}`.
+
+        Returns:
+            pd.Series of the counts indexed by the by dimensions, only for groups with complaints, or int of the total count if by is empty.
+        '''
+        by = [by] if isinstance(by, str) else by
+        assert isinstance(by, list) and isinstance(where, dict)
+        assert all(col in self.levels for col in by + list(where))
+
+        mask = np.ones(len(self.cell_counts), dtype=bool)
+        for col, values in where.items():
+            values = values if isinstance(values, (list, tuple, set, np.ndarray, pd.Index)) else [values]
+            positions = self.levels[col].get_indexer(list(values))
+            mask &= np.isin(self.codes[:, self.dimensions.index(col)], positions[positions >= 0])
+
+        if len(by) == 0:
+            return int(self.cell_counts[mask].sum())
+
+        for col in by:
+            mask &= ~self.levels[col].isna()[self.codes[:, self.dimensions.index(col)]]
+
+        codes = self.codes[mask][:, [self.dimensions.index(col) for col in by]]
+        shape = tuple(len(self.levels[col]) for col in by)
+        groups, inverse = np.unique(np.ravel_multi_index(codes.T, shape), return_inverse=True)
+        group_counts = np.bincount(inverse.ravel(), weights=self.cell_counts[mask], minlength=len(groups)).astype(np.int64)
+
+        group_codes = np.unravel_index(groups, shape)
+        if len(by) == 1:
+            index = self.levels[by[0]][group_codes[0]]
+        else:
+            index = pd.MultiIndex.from_arrays([self.levels[col][c] for col, c in zip(by, group_codes)], names=by)
+        return pd.Series(group_counts, index=index)
+
+    def to_frame(self):
+        '''
+        Provides the non-empty cells of the cube as a pd.DataFrame with one column per dimension and a `count` column.
+        '''
+        frame = pd.DataFrame({col: self.levels[col][self.codes[:, i]] for i, col in enumerate(self.dimensions)})
+        frame['count'] = self.cell_counts
+        return frame
+
+    @classmethod
+    def from_frame(cls, frame):
+        '''
+        Builds the cube from the pd.DataFrame of `to_frame`.
+        '''
+        assert isinstance(frame, pd.DataFrame) and 'count' in frame.columns
+
+        dimensions = [col for col in frame.columns if col != 'count']
+        levels, codes = {}, []
+        for col in dimensions:
+            col_codes, col_levels = pd.factorize(frame[col], sort=True, use_na_sentinel=False)
+            codes.append(col_codes)
+            levels[col] = pd.Index(col_levels, name=col)
+
+        return cls(np.stack(codes, axis=1), frame['count'].to_numpy(dtype=np.int64), levels)
+
+    def save(self, filename):
+        '''
+        Writes the cube to a Parquet file.
+
+        Parameters:
+            filename (str): File name of the Parquet file.
+        '''
+        assert isinstance(filename, str)
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.to_frame().to_parquet(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Reads a cube written by `save`.
+
+        Parameters:
+            filename (str): File name of the Parquet file.
+
+        Returns:
+            CountCube
+        '''
+        assert isinstance(filename, str)
+
+        return cls.from_frame(pd.read_parquet(filename))
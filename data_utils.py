@@ -1,13 +1,22 @@
 import pandas as pd
 import numpy as np
 import datetime
-import nltk
 import glob
 import os
 import re
-from nltk.tokenize import word_tokenize
-from nltk.probability import FreqDist
-from nltk.corpus import stopwords
+from nltk.tokenize import NLTKWordTokenizer
+from cube_utils import CensusCube, NORM_ORDERS, combine_norms, nonzero_norms, vector_norms
+
+def default_csv_filenames():
+    '''
+    Provides all relevant dataset CSVs located in data/, i.e. Drug_Crime and all 5 CSVs of 2020_Census/, which `import_csv_data` imports by default.
+
+    Returns:
+        list of CSV file names as strings.
+    '''
+    filenames = [os.getcwd() + '/data/Drug_Crime_20231111.csv']
+    filenames += glob.glob(os.getcwd() + '/data/2020_Census/*.csv')
+    return filenames
 
 def import_csv_data(filenames = []):
     '''
@@ -24,8 +33,7 @@ def import_csv_data(filenames = []):
     assert isinstance(filenames, list)
 
     if len(filenames) == 0:
-        filenames = [os.getcwd() + '/data/Drug_Crime_20231111.csv']
-        filenames += glob.glob(os.getcwd() + '/data/2020_Census/*.csv')
+        filenames = default_csv_filenames()
 
     # Open and store the datasets
     datasets = {}
@@ -44,12 +52,100 @@ def import_csv_data(filenames = []):
 
     return datasets
 
+# Number of values of each part of the time
+TIME_CAPS = {'hour': 24, 'minute': 60, 'second': 60}
+
+def _time_starts(times):
+    '''
+    Transforms the times parameter of `count_time_part` and `time_histogram` to a dict of the desired part of the time and its start time.
+    '''
+    assert isinstance(times, dict) or isinstance(times, list) or isinstance(times, str)
+
+    if isinstance(times, list):
+        times = {t: 0 for t in times}
+    elif isinstance(times, str):
+        times = {times: 0}
+
+    for t in times:
+        assert t in TIME_CAPS
+        assert 0 <= times[t] <= TIME_CAPS[t]
+
+    return {t: times[t] for t in TIME_CAPS if t in times}
+
+def time_to_seconds(time_col):
+    '''
+    Encodes a time column as the int second of the day. 
+    A column of `datetime.time` objects is factorized first, so only the distinct times (at most 86400) are converted in Python.
+
+    Parameters:
+        time_col (pd.Series):   Column of `datatime.time` objects, or of int seconds of the day as in the compact form of the dataset.
+
+    Returns:
+        np.ndarray of int64 seconds of the day.
+    '''
+    assert isinstance(time_col, pd.Series)
+
+    if pd.api.types.is_integer_dtype(time_col):
+        seconds = time_col.to_numpy(dtype=np.int64)
+        assert ((0 <= seconds) & (seconds < 86400)).all()
+        return seconds
+
+    codes, uniques = pd.factorize(time_col)
+    assert (codes >= 0).all()
+    unique_seconds = np.empty(len(uniques), dtype=np.int64)
+    for i, time_item in enumerate(uniques):
+        assert isinstance(time_item, datetime.time)
+        unique_seconds[i] = time_item.hour * 3600 + time_item.minute * 60 + time_item.second
+
+    return unique_seconds[codes]
+
+def time_histogram(time_col, times = {'hour': 0, 'minute': 0, 'second': 0}, by = None):
+    '''
+    Counts the hours, minutes and seconds of a time column, optionally per group such as per borough or per year. 
+    All parts and groups are counted with a single `np.bincount` over the second of the day, or with one per part if there are fewer rows than seconds of the day of all groups.
+
+    Parameters:
+        time_col (pd.Series):   Column of `datatime.time` objects, or of int seconds of the day as in the compact form of the dataset.
+        times (dict|list|int):  Optional. The desired parts of the time and their start time, same as `count_time_part`.
+        by (pd.Series):         Optional. Column to group by, aligned with time_col, e.g. `BORO_NM` or `Year`. Rows with a missing group are not counted. If `None` (default), there is a single group `'All'`.
+
+    Returns:
+        dict of pd.DataFrame of counts. Keys will be the desired part provided in `times`.
+        Each item has one row per group (sorted) and one column per time value, with the first column being the start time set by times. `.to_numpy()` gives the 2-D array of counts.
+    '''
+    assert by is None or (isinstance(by, pd.Series) and len(by) == len(time_col))
+    times = _time_starts(times)
+
+    seconds = time_to_seconds(time_col)
+    if by is None:
+        codes, groups = np.zeros(len(seconds), dtype=np.int64), pd.Index(['All'])
+    else:
+        codes, groups = pd.factorize(by, sort=True)
+        seconds = seconds[codes >= 0]
+        codes = codes[codes >= 0]
+
+    if len(groups) * 86400 <= len(seconds):
+        # Counts of every second of the day per group, summed up to each part of the time
+        day_counts = np.bincount(codes * 86400 + seconds, minlength=len(groups) * 86400).reshape(len(groups), 24, 60, 60)
+        part_counts = {'hour': day_counts.sum(axis=(2, 3)), 'minute': day_counts.sum(axis=(1, 3)), 'second': day_counts.sum(axis=(1, 2))}
+    else:
+        # Fewer rows than seconds of the day of all groups, e.g. a sample with many strata, so each part is counted on its own
+        part_values = {'hour': seconds // 3600, 'minute': seconds // 60 % 60, 'second': seconds % 60}
+        part_counts = {t: np.bincount(codes * TIME_CAPS[t] + part_values[t], minlength=len(groups) * TIME_CAPS[t]).reshape(len(groups), TIME_CAPS[t]) for t in times}
+
+    histograms = {}
+    for t, start in times.items():
+        order = [v % TIME_CAPS[t] for v in range(start, TIME_CAPS[t] + start)]
+        histograms[t] = pd.DataFrame(part_counts[t][:, order], index=groups, columns=order)
+
+    return histograms
+
 def count_time_part(time_col, times = {'hour': 0, 'minute': 0, 'second': 0}):
     '''
     Provides a count dict (similar to value_counts) of the provided individual relevant parts of the time column.
 
     Parameters:
-        time_col (pd.Series):   Column of `datatime.time` objects to parse through
+        time_col (pd.Series):   Column of `datatime.time` objects to parse through, or of int seconds of the day as in the compact form of the dataset
         times (dict|list|int):  Optional. Dictonary, list, or integer containing the desired part of the time. 
                                 As a dict object, the start time can be set as well for the desired part of the time, i.e. `{'hour': 2}`. This is the equivalent to rotating the time set. Default is 0.
                                 
@@ -61,69 +157,101 @@ def count_time_part(time_col, times = {'hour': 0, 'minute': 0, 'second': 0}):
         Each item is a dictonary of every time value and their counts, with the first element being the start time set by times.
     '''
     assert isinstance(time_col, pd.Series)
-    assert isinstance(times, dict) or isinstance(times, list) or isinstance(times, str)
 
-    # Set time_components and transform times paremeter to a dict if needed
-    time_components = {'hour': {}, 'minute': {}, 'second': {}}
-    if isinstance(times, list):
-        times = {t: 0 for t in times}
-    elif isinstance(times, str):
-        times = {times: 0}
+    histograms = time_histogram(time_col, times)
 
-    for t in times:
-        assert t in time_components.keys()
-        assert 0 <= times[t] <= (24 if t == 'hour' else 60)
+    return {t: {int(value): int(count) for value, count in histograms[t].iloc[0].items()} for t in histograms}
 
-    for comp in time_components:
-        start = 0
-        time_cap = 24 if comp == 'hour' else 60
-        if comp in times:
-            start = times[comp]
+# Common words of park names that say nothing about the type of park
+PARK_STOP_WORDS = ["'s", 'on', 'st.', 'avenue', 'south', 'street']
 
-        time_components[comp] = {t % time_cap: 0 for t in range(start, time_cap + start)}
+# Word tokenizer of nltk's word_tokenize, without its sentence splitting that needs the punkt download, e.g. "st. mary's park" -> ['st.', 'mary', "'s", 'park']
+_PARK_TOKENIZER = NLTKWordTokenizer()
 
-    for time_item in time_col:
-        assert isinstance(time_item, datetime.time)
-        for t in times:
-            time_part = getattr(time_item, t)
-            time_components[t][time_part] += 1
+def build_park_index(parks):
+    '''
+    Tokenizes the distinct park names once and indexes them for `group_count_parks`. 
+    The index can then answer keyword counts for the parks or any subset of them, e.g. one borough or year, without tokenizing again.
 
-    return {comp: time_components[comp] for comp in time_components if comp in times}
+    Parameter:
+        parks (pd.Series):  Column of str with the park names.
 
-def group_count_parks(parks):
+    Returns:
+        dict of the park index. It holds the token counts and the first token position of every name, and a token to names inverted index that is filled as tokens are queried.
+    '''
+    assert isinstance(parks, pd.Series)
+
+    names = [str(name) for name in parks.unique() if isinstance(name, str)]
+    name_tokens = [_PARK_TOKENIZER.tokenize(name.lower()) for name in names]
+    vocab = list(dict.fromkeys(token for tokens in name_tokens for token in tokens))
+    vocab_positions = {token: j for j, token in enumerate(vocab)}
+
+    token_counts = np.zeros((len(names), len(vocab)), dtype=np.int32)
+    first_pos = np.full((len(names), len(vocab)), np.iinfo(np.int32).max, dtype=np.int64)
+    for i, tokens in enumerate(name_tokens):
+        for pos, token in reversed(list(enumerate(tokens))):
+            token_counts[i, vocab_positions[token]] += 1
+            first_pos[i, vocab_positions[token]] = pos
+
+    return {'names': names,
+            'name_positions': {name: i for i, name in enumerate(names)},
+            'lower_names': [name.lower() for name in names],
+            'vocab': vocab,
+            'token_counts': token_counts,
+            'first_pos': first_pos,
+            'postings': {}}
+
+def _park_postings(index, token):
+    '''
+    Provides the bool array of which indexed park names contain the token, computing it on the first query of the token.
+    '''
+    if token not in index['postings']:
+        index['postings'][token] = np.array([token in name for name in index['lower_names']], dtype=bool)
+
+    return index['postings'][token]
+
+def group_count_parks(parks, k = 15, index = None, exclude = PARK_STOP_WORDS):
     '''
     Counts the number of reported instance on each type of park. Performs count on the occurence of the word in the park name.
+    The words are the k most common words of the distinct park names, without the words in exclude.
+
+    The park names are tokenized once into an index (see `build_park_index`). Pass the index of all parks to count subsets of them, e.g. one borough or year, without tokenizing again.
 
     Parameter:
         parks (pd.Series):  Column of str with the park names.
+        k (int):            Optional. Number of most common words to count, before removing the excluded words. Defaults to 15.
+        index (dict):       Optional. Index from `build_park_index` of the parks or a superset of them. If `None` (default), an index of the parks is built.
+        exclude (list):     Optional. Words to leave out of the result. Defaults to `PARK_STOP_WORDS`.
 
     Returns:
         dict of counts. Each key is one of the most common words used in the park names.
     '''
-    assert isinstance(parks, pd.Series)
+    assert isinstance(parks, pd.Series) and isinstance(k, int) and isinstance(exclude, list)
+    assert index is None or isinstance(index, dict)
 
-    nltk.download('punkt')
-    all_text = ' '.join(parks.unique())
+    park_loc_count = parks.value_counts(sort=False)
+    park_loc_count = park_loc_count[park_loc_count > 0]
+    names = [name for name in parks.unique() if isinstance(name, str)]
 
-    locs = word_tokenize(all_text.lower())  # Convert to lowercase for case-insensitivity
+    if index is None:
+        index = build_park_index(parks)
+    rows = np.array([index['name_positions'][name] for name in names], dtype=np.int64)
 
-    top_locs = FreqDist(locs).most_common(15)
-    park_loc_count = parks.value_counts().to_dict()
-    freq_loc_count = {word[0]: 0 for word in top_locs}
+    # Most common words of the distinct names, ties in the order they first appear like FreqDist.most_common
+    token_counts = index['token_counts'][rows]
+    freqs = token_counts.sum(axis=0)
+    ranks = np.arange(len(rows), dtype=np.int64)[:, None] * (np.iinfo(np.int32).max + 1) + index['first_pos'][rows]
+    first_seen = np.where(token_counts > 0, ranks, np.iinfo(np.int64).max).min(axis=0, initial=np.iinfo(np.int64).max)
+    top_tokens = [j for j in np.lexsort((first_seen, -freqs))[:k] if freqs[j] > 0]
 
     # Count of each most frequent word that was in a park name
-    for loc in park_loc_count:
-        assert isinstance(loc, str)
-        for freq_loc in freq_loc_count:
-            if freq_loc in loc.lower():
-                freq_loc_count[freq_loc] += park_loc_count[loc]
-
-    freq_loc_count.pop("'s")
-    freq_loc_count.pop('on')
-    freq_loc_count.pop('st.')
-    freq_loc_count.pop('avenue')
-    freq_loc_count.pop('south')
-    freq_loc_count.pop('street')
+    count_rows = np.array([index['name_positions'][name] for name in park_loc_count.index if isinstance(name, str)], dtype=np.int64)
+    counts = np.array([count for name, count in park_loc_count.items() if isinstance(name, str)], dtype=np.int64)
+    freq_loc_count = {}
+    for j in top_tokens:
+        token = index['vocab'][j]
+        if token not in exclude:
+            freq_loc_count[token] = int(counts[_park_postings(index, token)[count_rows]].sum())
 
     return freq_loc_count
 
@@ -132,7 +260,7 @@ def filter_by_boro_feature(dataset, boro = '', feature = '', rename = True):
     Filterest the dataset by the inputed borough and feature. Filter designed for the preprocessed Census dataset column and rows.
 
     Parameters:
-        dataset (pd.DataFrame): Complete dataframe of the dataset. 
+        dataset (pd.DataFrame|CensusCube): Complete dataframe of the dataset, or the census cube. Filtering the cube gives a view of it instead of a copy.
         boro (str):             Optional. The desired borough to fliter by. If empty (default), all boroughs returned.
         feature (str):          Optonal. The desired feature to filter by. If empty (default), all features returned.
         rename (bool):          Optional. Whether to rename the feature column. This renames the column to only the identifier if column had prepended identifiers, e.g. "All Pop_10" -> "All". Defaults to `True`.
@@ -140,6 +268,9 @@ def filter_by_boro_feature(dataset, boro = '', feature = '', rename = True):
     Returns:
         pd.DataFrame with the filtered boroughs and features.
     '''
+    if isinstance(dataset, CensusCube):
+        return dataset.filter(boro, feature, rename)
+
     assert isinstance(dataset, pd.DataFrame) and isinstance(boro, str) and isinstance(feature, str) and isinstance(rename, bool)
 
     feature_list = ['Pop Change', 'Natural Change', 'Net Migration', 'Pop_10', 'Pop_20']
@@ -160,30 +291,108 @@ def filter_by_boro_feature(dataset, boro = '', feature = '', rename = True):
     
     return filtered_dataset
 
-def normalize(dataset, axis='row', inplace=False):
+def where_mask(dataset, where):
     '''
-    Normalizes the provided dataset along the row or column axis of the table using Numpy's euclidean unit vector normalization.
+    Provides the bool mask of the rows of a dataset that match a filter.
 
     Parameters:
-        dataset (pd.DataFrame): Complete dataframe of the dataset to be normalized.
+        dataset (pd.DataFrame): Dataset to filter.
+        where (dict):           Dict of the column as the key and the value, or list of values, to keep as the value, e.g. `{'BORO_NM': 'BRONX', 'Year': [2019, 2020]}`, same as `CountCube.counts`.
+
+    Returns:
+        np.ndarray of bool, or None if there is no filter.
+    '''
+    assert isinstance(dataset, pd.DataFrame) and isinstance(where, dict)
+
+    if len(where) == 0:
+        return None
+    mask = np.ones(len(dataset), dtype=bool)
+    for col, values in where.items():
+        if col not in dataset.columns:
+            raise KeyError(f'Unknown column {col!r}')
+        values = values if isinstance(values, (list, tuple)) else [values]
+        mask &= dataset[col].isin(values).to_numpy()
+    return mask
+
+def _divide_rows(dataset, start, end, norms):
+    '''
+    Divides the rows start:end of a float dataset by the norms in place. 
+    The rows are divided right in the dataset's array when they are one float block, otherwise as a copy that is written back.
+    '''
+    rows = dataset.iloc[start:end]
+    values = rows.to_numpy(copy=False)
+    if not values.flags.writeable:
+        values = values.copy()
+    np.divide(values, norms, out=values)
+    if not np.shares_memory(values, rows.iloc[:, 0].to_numpy()):
+        dataset.iloc[start:end] = values
+
+def normalize(dataset, axis='row', inplace=False, norm='l2', chunksize=None):
+    '''
+    Normalizes the provided dataset along the row or column axis of the table to unit vectors, by default Numpy's euclidean unit vector normalization.
+    The norms are computed with one Numpy pass over the values and the values are divided in place, all zero rows or columns stay zero.
+    Works on any table of numbers, e.g. the filtered Census dataset or the per-district counts of `spatial_utils.district_counts(dataset, by='Crime')`.
+
+    Parameters:
+        dataset (pd.DataFrame|CensusCube): Complete dataframe of the dataset to be normalized, or the census cube (see `CensusCube.normalize`).
         axis (str):             Optional. Specify `'row'` or `'col'` axis to be normalized. Defaults to `'row'`.
-        inplace (bool):         Optional. Normalize the dataset inplace without creating a deep copy. Defaults to `False`.
+        inplace (bool):         Optional. Normalize the values of the dataset itself instead of a copy. Integer columns are converted to float first. Defaults to `False`.
+        norm (str):             Optional. `'l2'` (euclidean, default), `'l1'` (sum of absolute values) or `'max'` (largest absolute value).
+        chunksize (int):        Optional. Number of rows converted and divided at a time, so the temporary arrays of a large dataset stay small. 
+                                The column norms are then combined from the norms of every chunk. If `None` (default), all rows at once.
 
     Returns:
-        pd.DataFrame of the normalized dataset.
+        pd.DataFrame of the normalized dataset (the dataset itself if inplace), or CensusCube if a cube was provided.
     '''
+    if isinstance(dataset, CensusCube):
+        assert chunksize is None
+        return dataset.normalize(axis, inplace, norm)
+
     assert isinstance(dataset, pd.DataFrame) and isinstance(axis, str) and isinstance(inplace, bool)
-    assert axis in ['row', 'col']
+    assert axis in ['row', 'col'] and norm in NORM_ORDERS
+    assert chunksize is None or (isinstance(chunksize, int) and chunksize > 0)
+    assert all(pd.api.types.is_numeric_dtype(dtype) for dtype in dataset.dtypes)
 
-    norm_dataset = dataset.copy(deep=inplace)
-    
+    float_cols = [pd.api.types.is_float_dtype(dtype) for dtype in dataset.dtypes]
+    if not inplace:
+        norm_dataset = dataset.copy() if all(float_cols) else dataset.astype(np.float64)
+    else:
+        norm_dataset = dataset
+        for i in np.flatnonzero(~np.array(float_cols, dtype=bool)):
+            norm_dataset.isetitem(i, norm_dataset.iloc[:, i].astype(np.float64))
+    if norm_dataset.shape[1] == 0:
+        return norm_dataset
+
+    chunksize = chunksize or max(len(norm_dataset), 1)
+    starts = range(0, len(norm_dataset), chunksize)
     if axis == 'row':
-        for row in norm_dataset.index:
-            row_vals = norm_dataset.loc[row].to_numpy()
-            norm_dataset[row:row] = row_vals / np.linalg.norm(row_vals, axis=0)
+        for start in starts:
+            norms = vector_norms(norm_dataset.iloc[start:start + chunksize].to_numpy(copy=False), 1, norm)
+            _divide_rows(norm_dataset, start, start + chunksize, nonzero_norms(norms))
     else:
-        for col in norm_dataset.columns:
-            col_vals = norm_dataset.loc[:, col]
-            norm_dataset[col] = col_vals / np.linalg.norm(col_vals, axis=0)
+        norms = combine_norms([vector_norms(norm_dataset.iloc[start:start + chunksize].to_numpy(copy=False), 0, norm) for start in starts] or 
+                              [np.zeros((1, norm_dataset.shape[1]))], norm)
+        for start in starts:
+            _divide_rows(norm_dataset, start, start + chunksize, nonzero_norms(norms))
         
-    return norm_dataset
\ No newline at end of file
+    return norm_dataset
+
+def memory_report(before, after):
+    '''
+    Compares the memory used by each column of two forms of a dataset, e.g. the preprocessed Drug_Crime dataset and its compact form from `preprocess_utils.compact_drug_crime`.
+
+    Parameters:
+        before (pd.DataFrame):  Dataset before the conversion.
+        after (pd.DataFrame):   Dataset after the conversion.
+
+    Returns:
+        pd.DataFrame with the bytes of each column before and after, and their ratio. Columns missing from one of the datasets have 0 bytes there. The last row is the total including the index.
+    '''
+    assert isinstance(before, pd.DataFrame) and isinstance(after, pd.DataFrame)
+
+    report = pd.DataFrame({'Before': before.memory_usage(deep=True), 'After': after.memory_usage(deep=True)}).fillna(0).astype('int64')
+    report = report.reindex(list(dict.fromkeys(list(before.memory_usage().index) + list(after.memory_usage().index))))
+    report.loc['Total'] = report.sum()
+    report['Ratio'] = report['After'] / report['Before'].replace(0, np.nan)
+
+    return report
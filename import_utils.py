@@ -0,0 +1,217 @@
+import pandas as pd
+import numpy as np
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import warnings
+import cache_utils as cu
+
+# Converted datasets, one Parquet file per input file
+IMPORT_CACHE_DIR = os.path.join(cu.CACHE_DIR, 'import')
+
+# Sheet of the core geographies workbook with the data, and the row of its column codes (the rows above are grouped headers)
+CORE_GEOGRAPHIES_SHEET = '2010, 2020, and Change'
+CORE_GEOGRAPHIES_HEADER = 3
+
+# Row of the column names of the housing sales spreadsheets (the rows above describe the file)
+HOUSING_HEADER = 4
+
+# Borough codes of the housing sales and their names as in the census datasets
+BOROUGH_NAMES = {1: 'Manhattan', 2: 'Bronx', 3: 'Brooklyn', 4: 'Queens', 5: 'Staten Island'}
+
+def default_filenames(data_dir = 'data'):
+    '''
+    Lists every dataset file of the data directory: the Drug_Crime and 2020_Census CSVs, the Excel workbooks and the housing sales spreadsheets.
+    Of several Drug_Crime snapshots, e.g. Drug_Crime_20231111.csv and Drug_Crime_20240512.csv, only the latest one by its date is listed.
+    '''
+    assert isinstance(data_dir, str)
+
+    # Every snapshot holds all complaints up to its date, so importing more than one would count them several times
+    filenames = sorted(glob.glob(os.path.join(data_dir, 'Drug_Crime_*.csv')))[-1:]
+    filenames += sorted(glob.glob(os.path.join(data_dir, '2020_Census', '*.csv')))
+    filenames += sorted(glob.glob(os.path.join(data_dir, '*.xlsx')))
+    filenames += sorted(glob.glob(os.path.join(data_dir, 'Housing_Prices', '*.xls*')))
+    return filenames
+
+def dataset_label(filename):
+    '''
+    Provides the label of the dataset of a file, the same as `data_utils.import_csv_data` for the CSVs, e.g. `'Drug_Crime'` or `'Asian'`.
+    The housing sales files of all boroughs share the label `'Housing_Prices'`, and other files are labeled by their basename.
+    '''
+    assert isinstance(filename, str)
+
+    basename = os.path.basename(filename)
+    label_loc = basename.find('Total-Population-')
+    if 'Drug_Crime' in basename:
+        return 'Drug_Crime'
+    if label_loc != -1:
+        return os.path.splitext(basename[label_loc + len('Total-Population-'):])[0]
+    if 'core-geographies' in basename:
+        return 'Core_Geographies'
+    if os.path.basename(os.path.dirname(os.path.abspath(filename))) == 'Housing_Prices':
+        return 'Housing_Prices'
+    return os.path.splitext(basename)[0]
+
+def read_core_geographies(filename):
+    '''
+    Reads the decennial census workbook of all NYC geographies, e.g. `nyc_population_2010_2020_change-core-geographies.xlsx`.
+
+    Returns:
+        pd.DataFrame indexed by the str GeoID, with the `GeoType`, `Borough` and `Name` of every geography and its numeric census columns.
+    '''
+    dataset = pd.read_excel(filename, sheet_name=CORE_GEOGRAPHIES_SHEET, header=CORE_GEOGRAPHIES_HEADER)
+    dataset = dataset.drop(columns=['Orig Order'])
+    dataset['GeoID'] = dataset['GeoID'].astype(str)
+    return dataset.set_index('GeoID')
+
+def read_population_by_district(filename):
+    '''
+    Reads the population of every race per community district, i.e. `Population_by_District.xlsx`.
+
+    Returns:
+        pd.DataFrame indexed by the int District.
+    '''
+    dataset = pd.read_excel(filename).rename(columns={'GeoID': 'District'})
+    return dataset.set_index('District').astype('int64')
+
+def read_housing_prices(filename):
+    '''
+    Reads a yearly housing sales spreadsheet of one borough, e.g. `Housing_Prices/2015_bronx.xls`.
+    The column names lose their line breaks, the padded strings their spaces, and the borough code becomes its name.
+    Text columns hold only str, e.g. the tax class codes `1` and `'1A'` are both str.
+
+    Returns:
+        pd.DataFrame with a row per sale, the `BOROUGH` name of each and the typed sale columns, e.g. int `SALE PRICE` and datetime `SALE DATE`.
+    '''
+    dataset = pd.read_excel(filename, header=HOUSING_HEADER)
+    dataset.columns = [col.strip() for col in dataset.columns]
+    for col in dataset.columns[dataset.dtypes == object]:
+        text = dataset[col].astype(str).str.strip()
+        dataset[col] = text.where(dataset[col].notna() & (text != ''), np.nan)
+    dataset['BOROUGH'] = dataset['BOROUGH'].map(BOROUGH_NAMES)
+    return dataset
+
+def read_dataset(filename):
+    '''
+    Reads a dataset file of any of the formats of the data directory into a typed pd.DataFrame.
+    CSVs are read as `pd.read_csv` does, so they are the same as from `data_utils.import_csv_data`, and Excel files with their reader above.
+    '''
+    assert isinstance(filename, str)
+
+    label = dataset_label(filename)
+    if filename.endswith('.csv'):
+        return pd.read_csv(filename)
+    if label == 'Core_Geographies':
+        return read_core_geographies(filename)
+    if label == 'Population_by_District':
+        return read_population_by_district(filename)
+    if label == 'Housing_Prices':
+        return read_housing_prices(filename)
+    if filename.endswith(('.xlsx', '.xls')):
+        return pd.read_excel(filename)
+    raise Exception(f'Unsupported dataset file {filename}, please provide a CSV or Excel file!')
+
+def _restore_missing(dataset):
+    '''
+    Replaces the None that Parquet gives for missing strings by NaN, as pandas reads them from CSV and Excel.
+    '''
+    for i in np.flatnonzero((dataset.dtypes == object).to_numpy()):
+        column = dataset.iloc[:, i]
+        if column.isna().any():
+            dataset.isetitem(i, column.where(column.notna(), np.nan))
+    return dataset
+
+def _load_file(filename, content_hash, code_version, cache_dir, refresh):
+    '''
+    Loads the converted dataset of a file from the cache, converting and caching it first if it is not there.
+    Datasets Parquet cannot hold, e.g. a CSV column of mixed ints and strings, are converted every time instead.
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(content_hash.encode())
+    digest.update(code_version.encode())
+    path = os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(filename))[0]}-{digest.hexdigest()}.parquet')
+
+    if os.path.isfile(path) and not refresh:
+        return _restore_missing(pd.read_parquet(path))
+
+    dataset = read_dataset(filename)
+    try:
+        dataset.to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        warnings.warn(f'Could not cache {filename}: {e}')
+        if os.path.isfile(path + '.tmp'):
+            os.remove(path + '.tmp')
+    return dataset
+
+def import_data(filenames = [], workers = 1, cache_dir = IMPORT_CACHE_DIR, refresh = False):
+    '''
+    Imports the datasets of CSV and Excel files into typed pd.DataFrames, from a columnar (Parquet) cache of every file when it is unchanged.
+    A file is unchanged if its size and modification time are the ones it was cached with, or else if its content hash is, so a warm import only reads the Parquet files.
+    The Drug_Crime and census CSVs are the same as from `data_utils.import_csv_data`, so the result can be passed to `preprocess_utils.preprocess_datasets`.
+
+    Parameters:
+        filenames (list):   Optional. List of CSV and Excel file names as strings. If empty (default), every dataset file of data/, see `default_filenames`.
+        workers (int):      Optional. Number of processes that read the files. Defaults to 1.
+        cache_dir (str):    Optional. Directory of the cache. Defaults to `data/.cache/import`.
+        refresh (bool):     Optional. Ignore the cache and read every file again. Defaults to `False`.
+
+    Returns:
+        dict of the datasets by their label (see `dataset_label`), e.g. `'Drug_Crime'`, `'All'`, `'Core_Geographies'` (indexed by GeoID),
+        `'Population_by_District'` (indexed by district) and `'Housing_Prices'` (the sales of every borough, with its `BOROUGH`).
+    '''
+    assert isinstance(filenames, list) and isinstance(workers, int) and workers > 0
+    assert isinstance(cache_dir, str) and isinstance(refresh, bool)
+
+    if len(filenames) == 0:
+        filenames = default_filenames()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Content hashes of the files by their path, size and modification time, so unchanged files are not hashed again
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    hashes = []
+    for filename in filenames:
+        assert isinstance(filename, str)
+        stat = os.stat(filename)
+        entry = index.get(os.path.abspath(filename))
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': cu.fingerprint_files([filename])}
+            index[os.path.abspath(filename)] = entry
+        hashes.append(entry['hash'])
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + '.tmp', index_path)
+
+    args = [filenames, hashes, [cu.code_version([sys.modules[__name__]])] * len(filenames), [cache_dir] * len(filenames), [refresh] * len(filenames)]
+    if workers == 1:
+        loaded = list(map(_load_file, *args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as executor:
+            loaded = list(executor.map(_load_file, *args))
+
+    datasets = {}
+    for filename, dataset in zip(filenames, loaded):
+        datasets.setdefault(dataset_label(filename), []).append(dataset)
+    return {label: parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True) for label, parts in datasets.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the CSV and Excel datasets of data/ into the columnar cache')
+    parser.add_argument('filenames', nargs='*', help='Dataset files, defaults to every dataset file of data/')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes')
+    parser.add_argument('--refresh', action='store_true', help='Read every file again')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    datasets = import_data(args.filenames, args.workers, refresh=args.refresh)
+    for label, dataset in datasets.items():
+        print(f'{label:30} {dataset.shape[0]:>10} rows {dataset.shape[1]:>5} columns')
+    print(f'Imported in {time.perf_counter() - start:.2f} s')
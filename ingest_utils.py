@@ -0,0 +1,159 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import cache_utils as cu
+import preprocess_utils as pu
+import sample_utils as su
+
+# Store of the preprocessed Drug_Crime dataset that new snapshots are ingested into
+STORE_DIR = os.path.join(cu.CACHE_DIR, 'Drug_Crime_store')
+
+# Raw integer columns whose dtype depends on whether the whole snapshot holds NaN, and their preprocessed name
+SNAPSHOT_INT_COLUMNS = {'ADDR_PCT_CD': 'Precinct', 'PD_CD': 'NYC Penal Code'}
+
+def raw_row_hashes(dataset):
+    '''
+    Hashes every row of a raw Drug_Crime dataset over all of its columns, so two rows have the same hash only if they are duplicates.
+
+    Parameters:
+        dataset (pd.DataFrame): Raw Drug_Crime dataset.
+
+    Returns:
+        np.ndarray of the uint64 hash of every row.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    return pd.util.hash_pandas_object(dataset, index=False).to_numpy()
+
+def load_store(store_dir = STORE_DIR):
+    '''
+    Reads the store written by `ingest_snapshot`.
+
+    Parameters:
+        store_dir (str):    Optional. Directory of the store. Defaults to `data/.cache/Drug_Crime_store`.
+
+    Returns:
+        tuple of the preprocessed Drug_Crime pd.DataFrame, the np.ndarray of the raw row hash of each of its rows,
+        the np.ndarray of the hashes of all distinct raw rows of the last snapshot and their np.ndarray of IDs, and the dict of the store metadata.
+        None if there is no store.
+    '''
+    assert isinstance(store_dir, str)
+
+    if not os.path.isfile(os.path.join(store_dir, 'store.json')):
+        return None
+
+    with open(os.path.join(store_dir, 'store.json')) as f:
+        meta = json.load(f)
+    dataset = cu.load_datasets(store_dir)['Drug_Crime']
+    hashes = np.load(os.path.join(store_dir, 'hashes.npz'))
+
+    return dataset, hashes['row_hashes'], hashes['snapshot_hashes'], hashes['snapshot_ids'], meta
+
+def save_store(dataset, row_hashes, snapshot_hashes, snapshot_ids, meta, store_dir = STORE_DIR):
+    '''
+    Writes the store read by `load_store`. The metadata is written last, so an interrupted write leaves no valid store behind.
+    '''
+    assert isinstance(dataset, pd.DataFrame) and isinstance(meta, dict) and isinstance(store_dir, str)
+    assert len(dataset) == len(row_hashes) and len(snapshot_hashes) == len(snapshot_ids)
+
+    if os.path.isfile(os.path.join(store_dir, 'store.json')):
+        os.remove(os.path.join(store_dir, 'store.json'))
+    cu.save_datasets({'Drug_Crime': dataset}, store_dir)
+    np.savez(os.path.join(store_dir, 'hashes.tmp.npz'), row_hashes=row_hashes, snapshot_hashes=snapshot_hashes, snapshot_ids=snapshot_ids)
+    os.replace(os.path.join(store_dir, 'hashes.tmp.npz'), os.path.join(store_dir, 'hashes.npz'))
+    with open(os.path.join(store_dir, 'store.json'), 'w') as f:
+        json.dump(meta, f)
+
+def ingest_snapshot(filename, store_dir = STORE_DIR, engine = 'python', return_changes = False, sample_fraction = None):
+    '''
+    Brings the preprocessed Drug_Crime store up to date with a new snapshot CSV, preprocessing only the complaints that are new or changed since the last snapshot.
+    The result is the same as `preprocess_drug_crime(du.import_csv_data([filename])['Drug_Crime'])`.
+
+    Every preprocessing step of `preprocess_drug_crime` only looks at the rows of one complaint ID (duplicates share their ID and rows without a time are dropped by ID),
+    so a complaint whose raw rows are unchanged keeps its preprocessed rows. A complaint is changed if any of its raw rows is added or removed,
+    found by comparing the hashes of the raw rows with the ones of the last snapshot. Complaints that are no longer in the snapshot are deleted.
+    The first call, or any call after the preprocessing code or the precinct table changed, preprocesses the whole snapshot.
+    A stratified sample of the store (see `sample_utils`), kept in its `sample/` directory, is refreshed with every change. Its keys are drawn from the raw row hashes, so unchanged complaints stay in or out of it.
+
+    Parameters:
+        filename (str):         File name of the Drug_Crime snapshot CSV, e.g. `data/Drug_Crime_20231111.csv`.
+        store_dir (str):        Optional. Directory of the store. Defaults to `data/.cache/Drug_Crime_store`.
+        engine (str):           Optional. `'python'` (default) or `'vectorized'`, see `preprocess_drug_crime_rows`.
+        return_changes (bool):  Optional. Also return the counts of added, updated, deleted and unchanged complaints. Defaults to `False`.
+        sample_fraction (float): Optional. Build the sample of the store at this fraction. If `None` (default), a sample is only refreshed if the store already has one.
+
+    Returns:
+        pd.DataFrame of the preprocessed drug crime data, and dict of the counts of changed complaints if return_changes.
+    '''
+    assert isinstance(filename, str) and '.csv' in filename
+    assert isinstance(store_dir, str) and isinstance(return_changes, bool)
+
+    raw = pd.read_csv(filename)
+    if 'CMPLNT_NUM' not in raw.columns:
+        raise Exception('An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Drug_Crime dataset!')
+
+    hashes = raw_row_hashes(raw)
+    distinct = ~pd.Series(hashes).duplicated().to_numpy()
+    snapshot_hashes, snapshot_ids = hashes[distinct], raw['CMPLNT_NUM'].to_numpy()[distinct]
+
+    meta = {'code_version': cu.code_version(), 'precinct_table': os.path.basename(pu.precinct_table_path()), 'engine': engine}
+    store = load_store(store_dir)
+    if store is not None and all(store[4].get(key) == meta[key] for key in meta):
+        dataset, row_hashes, old_hashes, old_ids, _ = store
+    else:
+        dataset, row_hashes, old_hashes, old_ids = None, np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64), np.empty(0)
+
+    # Complaints with a raw row in only one of the snapshots
+    added_rows = ~np.isin(snapshot_hashes, old_hashes)
+    removed_rows = ~np.isin(old_hashes, snapshot_hashes)
+    changed_ids = pd.Index(np.concatenate([snapshot_ids[added_rows], old_ids[removed_rows]])).unique()
+    new_ids, old_id_index = pd.Index(snapshot_ids).unique(), pd.Index(old_ids).unique()
+
+    # Same distinct raw rows in the same order, so the store is already up to date
+    if dataset is not None and np.array_equal(snapshot_hashes, old_hashes):
+        changes = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': len(new_ids)}
+        meta.update({'snapshot': os.path.basename(filename), 'changes': changes})
+        with open(os.path.join(store_dir, 'store.json'), 'w') as f:
+            json.dump(meta, f)
+        if sample_fraction is not None:
+            su.refresh_sample(dataset, os.path.join(store_dir, 'sample'), sample_fraction, row_hashes)
+        return (dataset, changes) if return_changes else dataset
+
+    parts, part_hashes = [], []
+    if dataset is not None:
+        keep = ~dataset.index.isin(changed_ids)
+        parts.append(dataset[keep])
+        part_hashes.append(row_hashes[keep])
+
+    delta = raw[raw['CMPLNT_NUM'].isin(changed_ids)].copy()
+    if len(delta) > 0:
+        # The raw row hash goes through preprocessing as a column, to know the raw row of every preprocessed row
+        delta['_row_hash'] = hashes[raw['CMPLNT_NUM'].isin(changed_ids).to_numpy()]
+        processed = pu.preprocess_drug_crime(delta, engine)
+        part_hashes.append(processed.pop('_row_hash').to_numpy(dtype=np.uint64))
+        parts.append(processed)
+
+    if len(parts) == 0:
+        raise Exception('An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Drug_Crime dataset!')
+    dataset = pd.concat(parts) if len(parts) > 1 else parts[0]
+    row_hashes = np.concatenate(part_hashes)
+
+    # Same row order and dtypes as preprocessing the whole snapshot
+    order = np.argsort(pd.Index(snapshot_hashes).get_indexer(row_hashes), kind='stable')
+    dataset, row_hashes = dataset.iloc[order], row_hashes[order]
+    dataset.index = dataset.index.astype(raw['CMPLNT_NUM'].dtype)
+    for col in SNAPSHOT_INT_COLUMNS:
+        dataset[SNAPSHOT_INT_COLUMNS[col]] = dataset[SNAPSHOT_INT_COLUMNS[col]].astype(raw[col].dtype)
+
+    changes = {'added': int((~changed_ids.isin(old_id_index)).sum()),
+               'updated': int((changed_ids.isin(old_id_index) & changed_ids.isin(new_ids)).sum()),
+               'deleted': int((~changed_ids.isin(new_ids)).sum()),
+               'unchanged': int(len(new_ids) - changed_ids.isin(new_ids).sum())}
+    meta.update({'snapshot': os.path.basename(filename), 'changes': changes})
+    save_store(dataset, row_hashes, snapshot_hashes, snapshot_ids, meta, store_dir)
+    su.refresh_sample(dataset, os.path.join(store_dir, 'sample'), sample_fraction, row_hashes)
+
+    if return_changes:
+        return dataset, changes
+    return dataset
@@ -1,9 +1,14 @@
 import pandas as pd
 import numpy as np
-import requests
+import concurrent.futures
+import datetime
+import functools
+import io
+import json
+import os
 import re
-from bs4 import BeautifulSoup
 from ast import literal_eval
+from stage_utils import StageError, StageReport, merge_stage_records, run_stage
 
 def replace_column_nan(column, oldnan, newnan = np.nan):
     '''
@@ -50,16 +55,182 @@ def get_time_day(dataset, merge:bool = False):
     
     return pd.DataFrame({'Time of Day': time_day_col})
 
-def get_precinct_info(dataset, merge = False):
+def _column_bytes(column):
+    '''
+    Converts a column of ascii strings to a 2-D uint8 array with one zero padded row per string, so fixed-width strings can be parsed with array operations.
+    Returns None if the column has values that are not ascii strings.
+    '''
+    try:
+        values = np.array(column.tolist(), dtype='S')
+    except (UnicodeEncodeError, TypeError, ValueError):
+        return None
+    width = max(values.dtype.itemsize, 1)
+
+    return values.view(np.uint8).reshape(len(values), width) if len(values) > 0 else np.zeros((0, width), dtype=np.uint8)
+
+def _parse_fixed_width(column, fmt):
+    '''
+    Parses the numbers of fixed-width strings such as `MM/DD/YYYY` with array operations. 
+    fmt is the string layout where `N` is a digit and any other character must match, e.g. `'NN/NN/NNNN'`.
+
+    Returns a tuple of a list with one int64 array per group of digits and a bool array of which rows matched fmt. Values of unmatched rows are undefined.
+    '''
+    chars = _column_bytes(column)
+    if chars is None:
+        return [np.zeros(len(column), dtype=np.int64) for _ in re.findall('N+', fmt)], np.zeros(len(column), dtype=bool)
+
+    width = len(fmt)
+    if chars.shape[1] < width:
+        chars = np.pad(chars, ((0, 0), (0, width - chars.shape[1])))
+    valid = np.ones(len(chars), dtype=bool) if chars.shape[1] == width else chars[:, width] == 0
+    digits = chars[:, :width].astype(np.int64) - ord('0')
+
+    parts = []
+    for match in re.finditer('N+', fmt):
+        part = np.zeros(len(chars), dtype=np.int64)
+        for i in range(match.start(), match.end()):
+            valid &= (0 <= digits[:, i]) & (digits[:, i] <= 9)
+            part = part * 10 + digits[:, i]
+        parts.append(part)
+    for i, char in enumerate(fmt):
+        if char != 'N':
+            valid &= chars[:, i] == ord(char)
+
+    return parts, valid
+
+def parse_date_parts(column):
+    '''
+    Parses `MM/DD/YYYY` date strings with array operations and returns the month, day and year as int64 columns, the same as `split_and_isolate` would.
+    Dates that do not have this exact layout fall back to `split_and_isolate`.
+    '''
+    (month, day, year), valid = _parse_fixed_width(column, 'NN/NN/NNNN')
+    parts = pd.DataFrame({'Month': month, 'Day': day, 'Year': year}, index=column.index)
+
+    if not valid.all():
+        split = split_and_isolate(column[~valid], '/')
+        parts.loc[~valid, 'Month'] = split.str[0].astype('int64').to_numpy()
+        parts.loc[~valid, 'Day'] = split.str[1].astype('int64').to_numpy()
+        parts.loc[~valid, 'Year'] = split.str[-1].astype('int64').to_numpy()
+
+    return parts
+
+# Every datetime.time of a day by its second of the day
+_DAY_TIMES = None
+
+def parse_time_seconds(column):
+    '''
+    Parses `HH:MM:SS` time strings with array operations into the int64 second of the day.
+    Times that do not have this exact layout fall back to `pd.to_datetime`, which raises on invalid times like the original parse.
+    '''
+    (hours, minutes, seconds), valid = _parse_fixed_width(column, 'NN:NN:NN')
+    valid &= (hours < 24) & (minutes < 60) & (seconds < 60)
+    day_seconds = hours * 3600 + minutes * 60 + seconds
+
+    if not valid.all():
+        times = pd.to_datetime(column[~valid], format='%H:%M:%S')
+        day_seconds[~valid] = (times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second).to_numpy()
+
+    return pd.Series(day_seconds, index=column.index)
+
+def seconds_to_time(day_seconds):
+    '''
+    Converts seconds of the day to a column of `datetime.time` objects by looking them up in a table of all 86400 times of a day.
     '''
-    Performs web scraping to get addresses from precinct numbers and applies address information to dataframe.
+    global _DAY_TIMES
+    if _DAY_TIMES is None:
+        _DAY_TIMES = np.array([datetime.time(s // 3600, s // 60 % 60, s % 60) for s in range(86400)], dtype=object)
+
+    return pd.Series(_DAY_TIMES[np.asarray(day_seconds)], index=getattr(day_seconds, 'index', None))
+
+def parse_lat_lon(column):
+    '''
+    Extracts the latitude and longitude of `(lat, lon)` strings into float64 columns with one numeric parse of all strings instead of evaluating every string.
+    Strings that do not hold exactly one pair in parentheses fall back to a regex extraction.
+    '''
+    chars = _column_bytes(column)
+    if chars is not None and len(chars) > 0:
+        lengths = (chars != 0).sum(axis=1)
+        valid = (chars[:, 0] == ord('(')) & (chars[np.arange(len(chars)), np.maximum(lengths - 1, 0)] == ord(')'))
+        valid &= (chars == ord(',')).sum(axis=1) == 1
+        if valid.all():
+            values = np.array(','.join(column.tolist()).replace('(', ' ').replace(')', ' ').split(','), dtype='float64')
+            if len(values) == 2 * len(column):
+                return pd.DataFrame(values.reshape(-1, 2), index=column.index, columns=['Latitude', 'Longitude'])
+
+    lat_lon = column.str.extract(r'^\(\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)$')
+    lat_lon.columns = ['Latitude', 'Longitude']
+
+    return lat_lon.astype('float64')
+
+def get_time_day_vectorized(hours):
+    '''
+    categorizes hours into morning, afternoon, and night the same way as `get_time_day`, by binning the whole hour column at once.
+    '''
+    hours = np.asarray(hours)
+    time_day_col = np.select([(5 <= hours) & (hours < 12), (12 <= hours) & (hours < 18)], ['morning', 'afternoon'], 'night')
+
+    return time_day_col.astype(object)
+
+# Directory of the versioned precinct tables, e.g. data/Precincts/precincts_v1.csv. Read on every call, so it can be pointed at another directory of tables
+PRECINCT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'Precincts')
+PRECINCT_URL = 'https://www.nyc.gov/site/nypd/bureaus/patrol/precincts-landing.page'
+
+# Precincts whose name on the NYPD page has no precinct number in it
+PRECINCT_NAMES = {'Midtown South': 14, 'Midtown North': 18, 'Central Park': 22}
+
+def precinct_table_path(version = None, precinct_dir = None):
+    '''
+    Provides the path of a versioned precinct table.
 
     Parameters: 
-        dataset : pd.DataFrame
-        merge : bool
+        version : int, optional. Defaults to the latest version in precinct_dir.
+        precinct_dir : str, optional. Defaults to PRECINCT_DIR.
+    Returns: 
+        str path of the precinct table CSV
+    '''
+    if precinct_dir is None:
+        precinct_dir = PRECINCT_DIR
+    assert version is None or isinstance(version, int)
+    assert isinstance(precinct_dir, str)
+
+    if version is None:
+        versions = [int(v) for v in re.findall(r'precincts_v(\d+)\.csv', ' '.join(os.listdir(precinct_dir)))]
+        assert len(versions) > 0, f'No precinct table found in {precinct_dir}'
+        version = max(versions)
+
+    return os.path.join(precinct_dir, f'precincts_v{version}.csv')
+
+@functools.lru_cache(maxsize=None)
+def load_precinct_table(path = None):
+    '''
+    Loads the local precinct table once per process. Later calls return the same table.
+    The returned table is shared and must not be modified.
+
+    Parameters: 
+        path : str, optional. Defaults to the latest version in PRECINCT_DIR.
     Returns: 
-        pd.DataFrame drug crime dataframe with modified borough name column
+        pd.DataFrame precinct table indexed by the integer precinct number
     '''
+    if path is None:
+        path = precinct_table_path()
+
+    return pd.read_csv(path, index_col='Precinct', dtype={'Precinct': 'int64', 'Precinct Name': str, 'Phone': str, 'Address': str})
+
+def refresh_precinct_table(source = PRECINCT_URL, precinct_dir = None):
+    '''
+    Scrapes the NYPD precinct page and stores it as the next version of the precinct table.
+    source can be the url of the page, e.g. of a local stand-in server, or the path of a saved html snapshot of the page.
+
+    Parameters: 
+        source : str
+        precinct_dir : str, optional. Defaults to PRECINCT_DIR.
+    Returns: 
+        str path of the new precinct table CSV
+    '''
+    # Only needed to refresh, so preprocessing works without them
+    import requests
+    from bs4 import BeautifulSoup
+
     def digit_extraction(col):
         '''
         use regular expressions to extract only numerical data from column entries in the web scraping process
@@ -67,223 +238,627 @@ def get_precinct_info(dataset, merge = False):
         numbers = re.findall(r'\d+', col)
         if numbers:
             return numbers[0]
+        for name in PRECINCT_NAMES:
+            if name in col:
+                return PRECINCT_NAMES[name]
         return None
 
-    assert isinstance(dataset, pd.DataFrame)
-    assert isinstance(merge, bool)
-
-    precincts = dataset['Precinct'].sort_values()
-    precincts.unique()
-
-    response = requests.get('https://www.nyc.gov/site/nypd/bureaus/patrol/precincts-landing.page')
-    soup = BeautifulSoup(response.text, 'html.parser')
-    table_class = 'rt'
-    table = soup.find('table', {'class': table_class})
+    if precinct_dir is None:
+        precinct_dir = PRECINCT_DIR
+    assert isinstance(source, str) and isinstance(precinct_dir, str)
+
+    if os.path.isfile(source):
+        with open(source) as f:
+            html = f.read()
+    else:
+        html = requests.get(source).text
+    soup = BeautifulSoup(html, 'html.parser')
+    table = soup.find('table', {'class': 'rt'})
+    assert table is not None, f'No precinct table found in {source}'
+
+    precincts_df = pd.read_html(io.StringIO(str(table)))[0]
+    precincts_df['Precinct Name'] = precincts_df['Precinct']
+    precincts_df['Precinct'] = precincts_df['Precinct'].apply(digit_extraction)
+    precincts_df = precincts_df.dropna(subset = 'Precinct')
+    precincts_df['Precinct'] = precincts_df['Precinct'].astype(int)
+    precincts_df = precincts_df.drop_duplicates(subset='Precinct').sort_values('Precinct')
 
-    if table:
-        precincts_df = pd.read_html(str(table))[0]
+    os.makedirs(precinct_dir, exist_ok=True)
+    try:
+        path = precinct_table_path(precinct_dir=precinct_dir)
+        version = int(re.findall(r'(\d+)\.csv', path)[0]) + 1
+    except AssertionError:
+        version = 1
+    path = precinct_table_path(version, precinct_dir)
+    precincts_df[['Precinct', 'Precinct Name', 'Phone', 'Address']].to_csv(path, index=False)
+    load_precinct_table.cache_clear()
 
-    precincts_df.drop('Phone', axis = 1)
+    return path
 
-    precincts_df['Precinct'] = precincts_df['Precinct'].apply(digit_extraction)
-    precincts_df = precincts_df.dropna(subset = 'Precinct')
+def get_precinct_info(dataset, merge = False):
+    '''
+    Gets the addresses of the precinct numbers from the local precinct table and applies address information to dataframe.
+    The table is shipped in data/Precincts/ and can be updated with `refresh_precinct_table`.
 
-    precincts_df.reset_index()
+    Parameters: 
+        dataset : pd.DataFrame
+        merge : bool
+    Returns: 
+        pd.DataFrame drug crime dataframe with the precinct information columns if merge, otherwise the precinct table
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+    assert isinstance(merge, bool)
 
-    precincts_df['Precinct'] = precincts_df['Precinct'].astype(int)
+    precincts_df = load_precinct_table()
 
     if merge:
-        return dataset.reset_index().merge(precincts_df, on = 'Precinct', how='left').set_index('ID')
+        return dataset.join(precincts_df, on = 'Precinct')
     
-    return precincts_df
+    return precincts_df.reset_index()
 
-def clean_missing_boroughs(dataset, validity_threshold = 0.2):
+def clean_missing_boroughs(dataset, validity_threshold = 0.2, precinct_map = None, return_map = False, map_path = None):
     '''
     Dataset by associating missing borough data with ther precinct numbers and dropping remaining unknown boroughs.
     validity_threshold can be used to specify a specific threshold to which a precinct number can be allowed assocated with a borough.
     Lower threshold = more valid precinct numbers
 
+    Within each borough, the precincts are ranked by count and the ones before the first count that drops below validity_threshold of the previous count are associated with the borough.
+    The precinct map is learned in one grouped pass over the dataset. It can be returned, saved to map_path, and reused on later loads through precinct_map instead of learning it again.
+
     Parameters: 
         dataset : pd.DataFrame
         validity_threshold : float
+        precinct_map : dict, optional. Precinct number to borough map to use instead of learning it from the dataset, e.g. from `load_precinct_map`.
+        return_map : bool, optional. Also return the precinct map.
+        map_path : str, optional. Path of a JSON file to save the precinct map to.
     Returns: 
-        pd.DataFrame drug crime dataframe with modified borough name column
+        pd.DataFrame drug crime dataframe with modified borough name column, and the dict precinct map if return_map
     '''
     assert isinstance(dataset, pd.DataFrame)
     assert isinstance(validity_threshold, float)
-    grouped_dataset = dataset.groupby('BORO_NM')
-    
-    precinct_map = {}
-    for borough, group in grouped_dataset:
-        if borough == 'Borough not known':
-            target_indices = list(group.index)
-        else:
-            precinct_counts = group['Precinct'].value_counts()
-            counts = list(precinct_counts.to_dict().values())  # get counts of all precinct in descending order
-            drop_index = 0
-            for i in range(1, len(counts)):
-                if counts[i] / counts[i - 1] < validity_threshold:
-                    drop_index = i
-                    break
-            
-            for index, value in zip(list(range(0, len(counts))), precinct_counts.items()):
-                if index < drop_index:
-                    precinct_map[value[0]] = borough
+    assert precinct_map is None or isinstance(precinct_map, dict)
+    assert isinstance(return_map, bool) and (map_path is None or isinstance(map_path, str))
+
+    known = (dataset['BORO_NM'] != 'Borough not known').to_numpy()
 
-    for target in target_indices:
-        target_precinct = dataset.loc[target, 'Precinct']
-        if target_precinct in precinct_map.keys():
-            dataset.loc[target, 'BORO_NM'] = precinct_map[target_precinct]
+    if precinct_map is None:
+        # Precinct counts per borough in descending order
+        counts = dataset.loc[known].groupby(['BORO_NM', 'Precinct'], observed=True).size().rename('Count').reset_index()
+        counts = counts.sort_values(['BORO_NM', 'Count'], ascending=[True, False], kind='stable')
+        boroughs = counts['BORO_NM']
+
+        # Keep the precincts before the first sharp drop in counts, none if there is no drop
+        drop = (counts['Count'] / counts.groupby(boroughs, observed=True)['Count'].shift()) < validity_threshold
+        keep = drop.groupby(boroughs, observed=True).transform('any') & ~drop.groupby(boroughs, observed=True).cummax()
+
+        # A precinct kept by several boroughs goes to the last one in order
+        mapped = counts[keep].drop_duplicates(subset='Precinct', keep='last')
+        precinct_map = dict(zip(mapped['Precinct'].tolist(), mapped['BORO_NM'].tolist()))
+
+    if map_path is not None:
+        save_precinct_map(precinct_map, map_path)
+
+    unknown = ~known
+    if unknown.any():
+        boroughs = dataset.loc[unknown, 'Precinct'].map(precinct_map)
+        dataset.loc[unknown & dataset['Precinct'].isin(precinct_map.keys()).to_numpy(), 'BORO_NM'] = boroughs.dropna().to_numpy()
 
     dataset = dataset[dataset['BORO_NM'] != 'Borough not known']
 
+    if return_map:
+        return dataset, precinct_map
     return dataset
 
-def preprocess_drug_crime(dataset):
+def save_precinct_map(precinct_map, path):
     '''
-    Takes in drug crime dataset and performs transformations such as renaming columns, dropping duplicates, cleaning missing values.
+    Saves a precinct number to borough map, e.g. the one learned by `clean_missing_boroughs`, as a JSON file.
 
-        Parameters: dataset
-        type: pd.DataFrame
-        rtype: pd.DataFrame
-        Returns: modified drug crime data
+    Parameters: 
+        precinct_map : dict
+        path : str
+    '''
+    assert isinstance(precinct_map, dict) and isinstance(path, str)
 
+    with open(path, 'w') as f:
+        json.dump({str(int(precinct)): borough for precinct, borough in precinct_map.items()}, f, indent=4)
 
+def load_precinct_map(path):
     '''
-    try:
-        # Rename columns
-        new_columns = {'CMPLNT_NUM': 'ID', 
-                    'CMPLNT_FR_DT': 'Date', 
-                    'CMPLNT_FR_TM': 'Time', 
-                    'RPT_DT': 'Reported on:', 
-                    'ADDR_PCT_CD': 'Precinct', 
-                    'OFNS_DESC': 'Description', 
-                    'CRM_ATPT_CPTD_CD': 'Completed?', 
-                    'LAW_CAT_CD': 'Crime Category',
-                    'PD_CD': 'NYC Penal Code',
-                    'PD_DESC': 'Crime'}
-        dataset.rename(columns=new_columns, inplace=True)
-        dataset = dataset.drop_duplicates()
-        # Rearrange columns
-        dataset.drop(columns = ['CMPLNT_TO_TM', 'CMPLNT_TO_DT', 'Latitude', 'Longitude', 'KY_CD'], inplace = True, errors='ignore')
-        dataset.set_index('ID', inplace = True)
-        
-        # Rename and drop NaN of relevant columns
-        clean_cols = {'PARKS_NM': 'Not at a park', 
+    Loads a precinct number to borough map saved by `save_precinct_map`.
+
+    Parameters: 
+        path : str
+    Returns: 
+        dict precinct map with int precinct numbers
+    '''
+    assert isinstance(path, str)
+
+    with open(path) as f:
+        return {int(precinct): borough for precinct, borough in json.load(f).items()}
+
+# Raw Drug_Crime column names and their preprocessed names
+DRUG_CRIME_COLUMNS = {'CMPLNT_NUM': 'ID', 
+                      'CMPLNT_FR_DT': 'Date', 
+                      'CMPLNT_FR_TM': 'Time', 
+                      'RPT_DT': 'Reported on:', 
+                      'ADDR_PCT_CD': 'Precinct', 
+                      'OFNS_DESC': 'Description', 
+                      'CRM_ATPT_CPTD_CD': 'Completed?', 
+                      'LAW_CAT_CD': 'Crime Category',
+                      'PD_CD': 'NYC Penal Code',
+                      'PD_DESC': 'Crime'}
+
+# Raw Drug_Crime columns that are not used
+DRUG_CRIME_DROP_COLUMNS = ['CMPLNT_TO_TM', 'CMPLNT_TO_DT', 'Latitude', 'Longitude', 'KY_CD']
+
+# Drug_Crime columns with `(null)` values and their replacement
+DRUG_CRIME_NULLS = {'PARKS_NM': 'Not at a park', 
                     'LOC_OF_OCCUR_DESC': 'Location not known',
                     'HADEVELOPT': 'Not at a HA dev',
                     'BORO_NM': 'Borough not known',
                     'PREM_TYP_DESC': 'Premise not known'}
-        for col in clean_cols:
-            dataset[col] = replace_column_nan(dataset[col], oldnan='(null)').fillna(clean_cols[col])
-
-        dataset = dataset.drop(dataset[dataset['Time'] == '(null)'].index)    
-        dataset.dropna(inplace=True)
-
-        # Fix crime to be more readable
-        crimes = {'CONTROLLED SUBSTANCE,INTENT TO': 'POSS. OF CONTROLLED SUBSTANCE W/ INTENT TO SELL',
-                'CONTROLLED SUBSTANCE, INTENT T': 'POSS. OF CONTROLLED SUBSTANCE W/ INTENT TO SELL',
-                'CONTROLLED SUBSTANCE, POSSESSI': '7 DEG POSS. OF CONTROLLED',
-                'CONTROLLED SUBSTANCE,POSSESS.': '3, 4, 5 DEG POSS. OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE,POSSESS.-': '1 & 2 DEG POSS. OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE, SALE 5': '5 DEG SALE OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE, SALE 4': '4 DEG SALE OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE,SALE 3': '3 DEG SALE OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE,SALE 2': '2 DEG SALE OF CONTROLLED SUBSTANCE',
-                'CONTROLLED SUBSTANCE,SALE 1': '1 DEG SALE OF CONTROLLED SUBSTANCE',
-                'MARIJUANA, POSSESSION 4 & 5': '4 & 5 DEG POSS. OF MARIJUANA',
-                'MARIJUANA, SALE 4 & 5': '4 & 5 DEG SALE OF MARIJUANA',
-                'MARIJUANA, POSSESSION 1, 2 & 3': '1, 2, 3 DEG POSS. OF MARIJUANA',
-                'MARIJUANA, SALE 1, 2 & 3': '1, 2, 3 DEG SALE OF MARIJUANA',
-                'DRUG PARAPHERNALIA,   POSSESSE': 'POSS. OF PARAPHERNALIA',
-                'POSSESSION HYPODERMIC INSTRUME': 'POSS. OF HYPODERMIC INSTRUMENTS',
-                'SALE SCHOOL GROUNDS 4': 'SALE SCHOOL GROUNDS',
-                'SALE SCHOOL GROUNDS': 'SALE SCHOOL GROUNDS',
-                'SALES OF PRESCRIPTION': 'SALES OF PRESCRIPTION',
-                'UNDER THE INFLUENCE OF DRUGS': 'UNDER THE INFLUENCE OF DRUGS',
-                'DRUG, INJECTION OF': 'INJECTION OF NARCOTICONTROLLED SUBSTANCE',
-                'LOITERING 1ST DEGREE FOR DRUG': '1 DEG LOITERING FOR DRUGS',
-                'USE CHILD TO COMMIT CONT SUB OFF': 'USE CHILD TO COMMIT CONTROLLED SUBSTANCE CRIMES',
-                'POSS METH MANUFACT MATERIAL': 'POSS. OF METH MATERIALS'}
-        dataset = convert_col_values(dataset, columns=['Completed?', 'Crime'],
-                                                    conv_maps=[{'COMPLETED': True, 'ATTEMPTED': False}, crimes])
-        
-        # Parse dates for years and months and set to its own column and convert to int
+
+# Raw PD_DESC crime names and their more readable name
+CRIME_NAMES = {'CONTROLLED SUBSTANCE,INTENT TO': 'POSS. OF CONTROLLED SUBSTANCE W/ INTENT TO SELL',
+               'CONTROLLED SUBSTANCE, INTENT T': 'POSS. OF CONTROLLED SUBSTANCE W/ INTENT TO SELL',
+               'CONTROLLED SUBSTANCE, POSSESSI': '7 DEG POSS. OF CONTROLLED',
+               'CONTROLLED SUBSTANCE,POSSESS.': '3, 4, 5 DEG POSS. OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE,POSSESS.-': '1 & 2 DEG POSS. OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE, SALE 5': '5 DEG SALE OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE, SALE 4': '4 DEG SALE OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE,SALE 3': '3 DEG SALE OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE,SALE 2': '2 DEG SALE OF CONTROLLED SUBSTANCE',
+               'CONTROLLED SUBSTANCE,SALE 1': '1 DEG SALE OF CONTROLLED SUBSTANCE',
+               'MARIJUANA, POSSESSION 4 & 5': '4 & 5 DEG POSS. OF MARIJUANA',
+               'MARIJUANA, SALE 4 & 5': '4 & 5 DEG SALE OF MARIJUANA',
+               'MARIJUANA, POSSESSION 1, 2 & 3': '1, 2, 3 DEG POSS. OF MARIJUANA',
+               'MARIJUANA, SALE 1, 2 & 3': '1, 2, 3 DEG SALE OF MARIJUANA',
+               'DRUG PARAPHERNALIA,   POSSESSE': 'POSS. OF PARAPHERNALIA',
+               'POSSESSION HYPODERMIC INSTRUME': 'POSS. OF HYPODERMIC INSTRUMENTS',
+               'SALE SCHOOL GROUNDS 4': 'SALE SCHOOL GROUNDS',
+               'SALE SCHOOL GROUNDS': 'SALE SCHOOL GROUNDS',
+               'SALES OF PRESCRIPTION': 'SALES OF PRESCRIPTION',
+               'UNDER THE INFLUENCE OF DRUGS': 'UNDER THE INFLUENCE OF DRUGS',
+               'DRUG, INJECTION OF': 'INJECTION OF NARCOTICONTROLLED SUBSTANCE',
+               'LOITERING 1ST DEGREE FOR DRUG': '1 DEG LOITERING FOR DRUGS',
+               'USE CHILD TO COMMIT CONT SUB OFF': 'USE CHILD TO COMMIT CONTROLLED SUBSTANCE CRIMES',
+               'POSS METH MANUFACT MATERIAL': 'POSS. OF METH MATERIALS'}
+
+# dtypes of the raw Drug_Crime columns for chunked reading, the dropped columns included since duplicates are found on the whole raw row. 
+# Integer columns are read as float64 since they may hold NaN, see `stream_drug_crime`.
+DRUG_CRIME_DTYPES = {'CMPLNT_NUM': 'float64',
+                     'ADDR_PCT_CD': 'float64',
+                     'PD_CD': 'float64',
+                     'CMPLNT_FR_DT': str,
+                     'CMPLNT_FR_TM': str,
+                     'RPT_DT': str,
+                     'OFNS_DESC': str,
+                     'PD_DESC': str,
+                     'CRM_ATPT_CPTD_CD': str,
+                     'LAW_CAT_CD': str,
+                     'BORO_NM': str,
+                     'LOC_OF_OCCUR_DESC': str,
+                     'PREM_TYP_DESC': str,
+                     'PARKS_NM': str,
+                     'HADEVELOPT': str,
+                     'Lat_Lon': str,
+                     'CMPLNT_TO_DT': str,
+                     'CMPLNT_TO_TM': str,
+                     'KY_CD': 'float64',
+                     'Latitude': 'float64',
+                     'Longitude': 'float64'}
+
+# Messages of the exceptions raised for invalid datasets
+DRUG_CRIME_INVALID = 'An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Drug_Crime dataset!'
+CENSUS_INVALID = 'An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Census dataset!'
+
+def _fill_nulls(dataset, engine):
+    '''
+    Replaces the `(null)` and missing values of the `DRUG_CRIME_NULLS` columns.
+    '''
+    for col in DRUG_CRIME_NULLS:
+        if engine == 'python':
+            dataset[col] = replace_column_nan(dataset[col], oldnan='(null)').fillna(DRUG_CRIME_NULLS[col])
+        else:
+            dataset[col] = dataset[col].mask(dataset[col] == '(null)').fillna(DRUG_CRIME_NULLS[col])
+    return dataset
+
+def _drop_null_times(dataset, engine):
+    '''
+    Drops the rows without a time by their ID, which also drops other rows that share the ID.
+    '''
+    if engine == 'python':
+        return dataset.drop(dataset[dataset['Time'] == '(null)'].index)
+    return dataset[~dataset.index.isin(dataset.index[(dataset['Time'] == '(null)').to_numpy()])]
+
+def _parse_dates(dataset, engine):
+    '''
+    Parses the dates for the years and months, and the year of the report date.
+    '''
+    if engine == 'python':
         for col, new_col, delim, part in [('Date', 'Year', '/', 2), ('Date', 'Month', '/', 0), ('Reported on:', 'Reported on:', '/', -1)]:
             dataset[new_col] = split_and_isolate(dataset[col], delim, part)
             dataset[new_col] = dataset[new_col].astype('int64')
-            
-        # Convert time to DateTime and parse times for time of day and merge to original dataset
+    else:
+        date_parts = parse_date_parts(dataset['Date'])
+        dataset['Year'] = date_parts['Year']
+        dataset['Month'] = date_parts['Month']
+        dataset['Reported on:'] = parse_date_parts(dataset['Reported on:'])['Year']
+    return dataset
+
+def _parse_times(dataset, engine):
+    '''
+    Converts the times to `datetime.time` and adds the time of day.
+    '''
+    if engine == 'python':
         dataset['Time'] = pd.to_datetime(dataset['Time'], format='%H:%M:%S').dt.time
-        dataset = get_time_day(dataset, merge=True)
+        return get_time_day(dataset, merge=True)
+    day_seconds = parse_time_seconds(dataset['Time'])
+    dataset['Time'] = seconds_to_time(day_seconds)
+    dataset['Time of Day'] = get_time_day_vectorized(day_seconds // 3600)
+    return dataset
 
-        # Convert Lat_Long from string to tuple
+def _parse_lat_lon(dataset, engine):
+    '''
+    Converts the `Lat_Lon` strings to tuples.
+    '''
+    if engine == 'python':
         dataset['Lat_Lon'] = dataset['Lat_Lon'].apply(lambda x: eval(x))
+    else:
+        lat_lon = parse_lat_lon(dataset['Lat_Lon'])
+        dataset['Lat_Lon'] = list(zip(lat_lon['Latitude'].tolist(), lat_lon['Longitude'].tolist()))
+    return dataset
+
+def drug_crime_row_stages(engine = 'python'):
+    '''
+    Provides the named row-local stages of the drug crime preprocessing, see `preprocess_drug_crime_rows`.
+
+        Parameters: engine ('python' or 'vectorized')
+        type: str
+        rtype: list
+        Returns: list of (name, function) tuples where the function takes and returns the dataset
+    '''
+    assert engine in ['python', 'vectorized']
+
+    return [('drop_columns', lambda dataset: dataset.drop(columns = DRUG_CRIME_DROP_COLUMNS, errors='ignore').set_index('ID')),
+            ('fill_nulls', lambda dataset: _fill_nulls(dataset, engine)),
+            ('drop_null_times', lambda dataset: _drop_null_times(dataset, engine)),
+            ('dropna', lambda dataset: dataset.dropna()),
+            # Fix crime to be more readable
+            ('convert_names', lambda dataset: convert_col_values(dataset, columns=['Completed?', 'Crime'],
+                                                                 conv_maps=[{'COMPLETED': True, 'ATTEMPTED': False}, CRIME_NAMES])),
+            ('parse_dates', lambda dataset: _parse_dates(dataset, engine)),
+            ('parse_times', lambda dataset: _parse_times(dataset, engine)),
+            ('parse_lat_lon', lambda dataset: _parse_lat_lon(dataset, engine))]
+
+def preprocess_drug_crime_rows(dataset, engine = 'python', report = None):
+    '''
+    Performs the row-local preprocessing steps of the drug crime dataset, i.e. every step of `preprocess_drug_crime` that only looks at one row at a time.
+    The dataset columns must already be renamed with `DRUG_CRIME_COLUMNS` and duplicates dropped. 
+    Since each row is handled on its own, this can be called on any chunk of the dataset.
+    The `'vectorized'` engine does the same steps with column-wise array operations and gives the same result as the `'python'` engine, only much faster on large datasets.
+    The steps run as the named stages of `drug_crime_row_stages`, a failing stage raises a `StageError` that names it.
+
+        Parameters: dataset, engine ('python' or 'vectorized'), report (`stage_utils.StageReport` or hook to record every stage)
+        type: pd.DataFrame, str, callable
+        rtype: pd.DataFrame
+        Returns: modified drug crime data without the precinct information
+    '''
+    for name, stage in drug_crime_row_stages(engine):
+        dataset = run_stage(name, stage, dataset, report, DRUG_CRIME_INVALID)
+
+    return dataset
+
+def _preprocess_drug_crime_rows_part(dataset, engine, record, profile):
+    '''
+    Runs `preprocess_drug_crime_rows` on a row range in a worker process. With record, it also returns the stage records of the range for the report of the parent.
+    '''
+    if not record:
+        return preprocess_drug_crime_rows(dataset, engine), []
+    report = StageReport(profile=profile)
+    return preprocess_drug_crime_rows(dataset, engine, report), report.stages
+
+def _drop_null_time_ids(dataset):
+    '''
+    Drops the rows without a time by their ID before the dataset is split into row ranges, since rows that share the ID can be in other ranges.
+    '''
+    return dataset[~dataset['ID'].isin(dataset.loc[dataset['Time'] == '(null)', 'ID'])]
+
+def preprocess_drug_crime(dataset, engine = 'python', workers = 1, report = None):
+    '''
+    Takes in drug crime dataset and performs transformations such as renaming columns, dropping duplicates, cleaning missing values.
+    engine selects how the row-local steps are run, see `preprocess_drug_crime_rows`.
+    With more than one worker, the row-local steps run on row ranges of the dataset across a process pool, while dropping duplicates and merging the precinct information run once on the whole dataset. 
+    The result is the same as with one worker.
+    Every step runs as a named stage. A failing stage raises a `StageError` that names it, and a report records the time, rows and size of every stage.
+    With more than one worker, the workers return the records of the row-local stages and they are merged into one record per stage (see `stage_utils.merge_stage_records`).
+
+        Parameters: dataset, engine ('python' or 'vectorized'), workers (number of processes), report (`stage_utils.StageReport` or hook to record every stage)
+        type: pd.DataFrame, str, int, callable
+        rtype: pd.DataFrame
+        Returns: modified drug crime data
+
+
+    '''
+    assert isinstance(workers, int) and workers > 0
+
+    # Rename columns
+    dataset = run_stage('rename', lambda dataset: dataset.rename(columns=DRUG_CRIME_COLUMNS, inplace=True) or dataset, dataset, report, DRUG_CRIME_INVALID)
+    dataset = run_stage('drop_duplicates', lambda dataset: dataset.drop_duplicates(), dataset, report, DRUG_CRIME_INVALID)
+
+    if workers == 1:
+        dataset = preprocess_drug_crime_rows(dataset, engine, report)
+    else:
+        # Rows without a time are dropped by their ID, which can span row ranges, so drop them up front
+        dataset = run_stage('drop_null_time_ids', _drop_null_time_ids, dataset, report, DRUG_CRIME_INVALID)
+
+        def row_steps(dataset):
+            # The lookup tables such as CRIME_NAMES are module constants, so the workers get them from the import instead of with every task
+            bounds = np.linspace(0, len(dataset), workers + 1).astype(int)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(_preprocess_drug_crime_rows_part, 
+                                          [dataset.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])], 
+                                          [engine] * workers, [report is not None] * workers, [getattr(report, 'profile', False)] * workers))
+            if report is not None:
+                for record in merge_stage_records([records for _, records in parts]):
+                    report(record)
+            return pd.concat([part for part, _ in parts])
+        dataset = run_stage('row_steps', row_steps, dataset, report, DRUG_CRIME_INVALID)
+
+    # Convert precinct numbers to the actual discernable precinct centers and details
+    return run_stage('precinct_merge', lambda dataset: get_precinct_info(dataset, merge=True), dataset, report, DRUG_CRIME_INVALID)
+
+def stream_drug_crime(filename, chunksize = 100000, max_memory = None, engine = 'python'):
+    '''
+    Imports and preprocesses the drug crime dataset CSV in chunks, so only one raw chunk and the compact preprocessed rows are in memory at a time.
+    Every chunk is read with the `DRUG_CRIME_DTYPES` dtypes and goes through `preprocess_drug_crime_rows`.
+    The precinct information is merged once on the combined result. The result is the same as `preprocess_drug_crime(du.import_csv_data([filename])['Drug_Crime'])`.
+
+    Only the raw `DRUG_CRIME_DTYPES` columns of the file are read.
+    Duplicates are dropped across chunks by keeping the hash of every row seen so far (8 bytes per row) in a few sorted runs, so no hash is sorted again for every chunk.
+    Same as `drop_duplicates` of the whole dataset, the hash covers all raw columns, so the `DRUG_CRIME_DROP_COLUMNS` are only dropped after it.
+    Integer columns that hold no NaN in the whole file are converted back to int64 at the end, same as `pd.read_csv` would infer them.
+
+    Parameters:
+        filename (str):     File name of the Drug_Crime CSV.
+        chunksize (int):    Optional. Number of rows read per chunk. Defaults to 100000.
+        max_memory (int):   Optional. Memory ceiling in bytes of the preprocessed rows and the row hashes. A `MemoryError` is raised if it is exceeded. Defaults to `None` (no ceiling).
+        engine (str):       Optional. `'python'` (default) or `'vectorized'`, see `preprocess_drug_crime_rows`.
+
+    Returns:
+        pd.DataFrame of the preprocessed drug crime data.
+    '''
+    assert isinstance(filename, str) and '.csv' in filename
+    assert isinstance(chunksize, int) and chunksize > 0
+    assert max_memory is None or isinstance(max_memory, int)
+
+    int_cols = [col for col in DRUG_CRIME_DTYPES if DRUG_CRIME_DTYPES[col] == 'float64' and col not in DRUG_CRIME_DROP_COLUMNS]
+    has_nan = {col: False for col in int_cols}
+    null_time_ids = []
+
+    def read_chunks():
+        reader = pd.read_csv(filename, chunksize=chunksize, dtype=DRUG_CRIME_DTYPES, usecols=lambda col: col in DRUG_CRIME_DTYPES)
+        for chunk in reader:
+            for col in int_cols:
+                has_nan[col] = has_nan[col] or bool(chunk[col].isna().any())
+            chunk = chunk.rename(columns=DRUG_CRIME_COLUMNS)
+            null_time_ids.append(chunk.loc[chunk['Time'] == '(null)', 'ID'])
+            yield chunk
+
+    def drop_duplicates(chunks):
+        # Sorted runs of the hashes seen so far, from the largest to the smallest. Runs of similar size are merged, 
+        # so there are only about log2(chunks) runs and every hash is merged about as many times
+        runs = []
+        for chunk in chunks:
+            hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+            new = ~pd.Series(hashes).duplicated().to_numpy()
+            if len(runs) > 0:
+                # Looking up the hashes in sorted order walks each run once instead of jumping around in it
+                order = np.argsort(hashes)
+                sorted_hashes = hashes[order]
+                seen = np.zeros(len(hashes), dtype=bool)
+                for run in runs:
+                    seen |= run[np.minimum(np.searchsorted(run, sorted_hashes), len(run) - 1)] == sorted_hashes
+                new[order[seen]] = False
+            run = np.sort(hashes[new])
+            # The stable sort merges two sorted runs in linear time
+            while len(runs) > 0 and len(runs[-1]) <= len(run):
+                run = np.sort(np.concatenate([runs.pop(), run]), kind='stable')
+            if len(run) > 0:
+                runs.append(run)
+            yield chunk[new].drop(columns=DRUG_CRIME_DROP_COLUMNS, errors='ignore'), sum(run.nbytes for run in runs)
+
+    processed = []
+    memory = 0
+    try:
+        for chunk, seen_bytes in drop_duplicates(read_chunks()):
+            chunk = preprocess_drug_crime_rows(chunk, engine)
+            processed.append(chunk)
+            memory += chunk.memory_usage(deep=True).sum()
+            if max_memory is not None and memory + seen_bytes > max_memory:
+                raise MemoryError(f'Preprocessed Drug_Crime rows exceeded the memory ceiling of {max_memory} bytes')
+
+        dataset = pd.concat(processed)
+        del processed
+        # Rows without a time are dropped by their ID, which also drops rows of other chunks that share the ID
+        dataset = dataset[~dataset.index.isin(pd.concat(null_time_ids))]
+        for col in int_cols:
+            if has_nan[col]:
+                continue
+            if DRUG_CRIME_COLUMNS[col] == 'ID':
+                dataset.index = dataset.index.astype('int64')
+            else:
+                dataset[DRUG_CRIME_COLUMNS[col]] = dataset[DRUG_CRIME_COLUMNS[col]].astype('int64')
 
         # Convert precinct numbers to the actual discernable precinct centers and details
         dataset = get_precinct_info(dataset, merge=True)
-    except:
-        raise Exception('An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Drug_Crime dataset!')
+    except (MemoryError, StageError):
+        raise
+    except Exception as e:
+        raise Exception(DRUG_CRIME_INVALID) from e
     return dataset
 
-def preprocess_census(datasets:dict):
+# Columns of the preprocessed Drug_Crime dataset stored as categoricals in the compact form
+COMPACT_CATEGORIES = ['Date', 'Description', 'Crime Category', 'Crime', 'BORO_NM', 'LOC_OF_OCCUR_DESC', 'PREM_TYP_DESC', 
+                      'PARKS_NM', 'HADEVELOPT', 'Time of Day', 'Precinct Name', 'Phone', 'Address']
+
+# Numeric columns of the preprocessed Drug_Crime dataset and their dtype in the compact form
+COMPACT_DTYPES = {'Precinct': 'int16',
+                  'NYC Penal Code': 'int16',
+                  'Year': 'int16',
+                  'Month': 'int8',
+                  'Reported on:': 'int16'}
+
+def compact_drug_crime(dataset):
+    '''
+    Converts the preprocessed drug crime dataset to a compact typed form that takes a fraction of the memory.
+    Repeating strings become categoricals, `Time` becomes the int32 second of the day, small numbers become small ints 
+    and the `Lat_Lon` tuples become float32 `Latitude` and `Longitude` columns.
+    The `data_utils` functions accept both forms.
+
+        Parameters: dataset
+        type: pd.DataFrame
+        rtype: pd.DataFrame
+        Returns: compact drug crime data
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    compact = pd.DataFrame(index=dataset.index)
+    for col in dataset.columns:
+        if col in COMPACT_CATEGORIES:
+            compact[col] = dataset[col].astype('category')
+        elif col in COMPACT_DTYPES and not dataset[col].isna().any():
+            compact[col] = dataset[col].astype(COMPACT_DTYPES[col])
+        elif col == 'Time' and dataset[col].dtype == object:
+            compact[col] = np.array([t.hour * 3600 + t.minute * 60 + t.second for t in dataset[col]], dtype=np.int32)
+        elif col == 'Lat_Lon' and dataset[col].dtype == object:
+            lat_lon = np.array(dataset[col].tolist(), dtype=np.float32).reshape(-1, 2)
+            compact['Latitude'] = lat_lon[:, 0]
+            compact['Longitude'] = lat_lon[:, 1]
+        else:
+            compact[col] = dataset[col]
+
+    return compact
+
+def convert_census_race(race, dataset):
+    '''
+    Renames the population columns of one census race dataset with the race, e.g. "Pop_10" -> "All Pop_10", and converts them to int.
+
+    Parameters: race, dataset
+    type: str, pd.DataFrame
+    rtype: pd.DataFrame
+    Returns: census data with GeoID and the renamed columns
+    '''
+    population_col_filter = re.compile('.*_[0-9]+')
+
+    # Rename columns
+    rename_cols = {'Pop Change': f'{race} Pop Change', 'Natural Change': f'{race} Natural Change', 'Net Migration': f'{race} Net Migration'}
+    for name in list(filter(population_col_filter.match, dataset.columns)):
+        rename_cols[name] = race + ' Pop' + name[-3:]
+    dataset.rename(columns=rename_cols, inplace=True)
+    
+    # Fix dtypes
+    for col in rename_cols.values():
+        dataset[col] = dataset[col].str.replace(',', '').astype('int64')
+        
+    merge_keys = ['GeoID'] + list(rename_cols.values())
+    return dataset[merge_keys]
+
+def _census_columns(datasets):
+    '''
+    Provides the geography columns of the census, taken from the first race dataset.
+    '''
+    merged_census = pd.DataFrame()
+    for race in datasets:
+        if merged_census.empty: # If any of the columns does not exist, this will raise an error to be caught to raise an invalid dataset exception
+            for col in ['GeoID', 'GeoType', 'Borough', 'GeoID', 'Name']:
+                merged_census[col] = datasets[race][col]
+    return merged_census
+
+def preprocess_census(datasets:dict, workers = 1, report = None):
     '''
     Preprocesses census data by renaming columns, and merging of columns.
+    `cube_utils.CensusCube` holds the same data as a 3-D array for fast borough and feature slices.
+    With more than one worker, the race datasets are converted in parallel across a process pool.
+    Every step runs as a named stage. A failing stage raises a `StageError` that names it, and a report records the time, rows and size of every stage.
 
-    Parameters: dataset
-    type: pd.DataFrame
+    Parameters: dataset, workers (number of processes), report (`stage_utils.StageReport` or hook to record every stage)
+    type: pd.DataFrame, int, callable
     rtype: pd.DataFrame
     Returns: merged census data
 
 
     ''' 
-    try:
-        population_col_filter = re.compile('.*_[0-9]+')
-        merged_census = pd.DataFrame()
-        for race in datasets:
-            if merged_census.empty: # If any of the columns does not exist, this will raise an error to be caught to raise an invalid dataset exception
-                for col in ['GeoID', 'GeoType', 'Borough', 'GeoID', 'Name']:
-                    merged_census[col] = datasets[race][col]
-            
-            # Rename columns
-            rename_cols = {'Pop Change': f'{race} Pop Change', 'Natural Change': f'{race} Natural Change', 'Net Migration': f'{race} Net Migration'}
-            for name in list(filter(population_col_filter.match, datasets[race].columns)):
-                rename_cols[name] = race + ' Pop' + name[-3:]
-            datasets[race].rename(columns=rename_cols, inplace=True)
-            
-            # Fix dtypes
-            for col in rename_cols.values():
-                datasets[race][col] = datasets[race][col].str.replace(',', '').astype('int64')
-                
-            merge_keys = ['GeoID'] + list(rename_cols.values())
-            merged_census = pd.merge(merged_census, datasets[race][merge_keys], on = "GeoID", how = "left")
-            
-        merged_census.set_index('GeoID', inplace = True)
-    except:
-        raise Exception('An invalid dataset with vital columns missing was provided, please provide a valid (unprocessed) Census dataset!')
+    assert isinstance(workers, int) and workers > 0
+
+    merged_census = run_stage('select_columns', _census_columns, datasets, report, CENSUS_INVALID)
+
+    def convert_races(datasets):
+        if workers == 1:
+            return {race: convert_census_race(race, datasets[race]) for race in datasets}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(datasets))) as executor:
+            return dict(zip(datasets, executor.map(convert_census_race, list(datasets), list(datasets.values()))))
+    converted = run_stage('convert_races', convert_races, datasets, report, CENSUS_INVALID)
+
+    def merge_races(merged_census):
+        # Align all races on GeoID with a single concat
+        merged_census = merged_census.set_index('GeoID')
+        race_census = pd.concat([race.set_index('GeoID') for race in converted.values()], axis = 1)
+        return pd.concat([merged_census, race_census.reindex(merged_census.index)], axis = 1)
+    return run_stage('merge_races', merge_races, merged_census, report, CENSUS_INVALID)
     
-    return merged_census
-    
-def preprocess_datasets(datasets):
+def preprocess_datasets(datasets, engine = 'python', compact = False, workers = 1, districts = False, report = None):
     '''
     Calls both preprocess_drug_crime and preprocess_census
 
-    Parameters: datasets
-    type: pd.DataFrame
+    Parameters: datasets, engine ('python' or 'vectorized', see `preprocess_drug_crime_rows`), compact (convert Drug_Crime with `compact_drug_crime`), workers (number of processes), 
+                districts (add the community district of every complaint with `spatial_utils.assign_districts`), report (`stage_utils.StageReport` or hook to record every stage)
+    type: pd.DataFrame, str, bool, int, bool, callable
     rtype: pd.DataFrame
     Returns: modified drug_crime and census data
     '''
     census_keys = ['All', 'Asian', 'Black', 'Hispanic', 'White']
     new_datasets = {}
     if 'Drug_Crime' in datasets:
-        new_datasets['Drug_Crime'] = preprocess_drug_crime(datasets['Drug_Crime'])
+        new_datasets['Drug_Crime'] = preprocess_drug_crime(datasets['Drug_Crime'], engine, workers, report)
+        if districts:
+            # Only needed for the spatial join, so preprocessing works without shapely
+            import spatial_utils as su
+            new_datasets['Drug_Crime'] = run_stage('assign_districts', lambda dataset: su.assign_districts(dataset, merge=True), new_datasets['Drug_Crime'], report)
+        if compact:
+            new_datasets['Drug_Crime'] = run_stage('compact', compact_drug_crime, new_datasets['Drug_Crime'], report)
 
     census_datasets = {}
     for x in datasets:
         if x in census_keys:
             census_datasets[x] = datasets[x]
 
-    new_datasets['Census'] = preprocess_census(census_datasets)
+    new_datasets['Census'] = preprocess_census(census_datasets, workers, report)
     
     return new_datasets
-        
\ No newline at end of file
+        
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Preprocessing utilities')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = subparsers.add_parser('refresh-precincts', help='Store a new version of the precinct table in data/Precincts/')
+    refresh_parser.add_argument('source', nargs='?', default=PRECINCT_URL, help='Url of the NYPD precinct page or path of a saved html snapshot of it')
+    preprocess_parser = subparsers.add_parser('preprocess', help='Preprocess the datasets in data/ and report the time, rows and size of every stage')
+    preprocess_parser.add_argument('--engine', default='python', choices=['python', 'vectorized'], help='Engine of the row-local Drug_Crime steps')
+    preprocess_parser.add_argument('--workers', type=int, default=1, help='Number of processes')
+    preprocess_parser.add_argument('--report', help='File to write the stage report JSON to')
+    preprocess_parser.add_argument('--profile', action='store_true', help='Profile every stage and keep its top functions in the report')
+    preprocess_parser.add_argument('--max-drop', type=float, help='Warn when a stage drops more than this share of its rows, e.g. 0.5')
+    args = parser.parse_args()
+
+    if args.command == 'refresh-precincts':
+        print(refresh_precinct_table(args.source))
+    elif args.command == 'preprocess':
+        import data_utils as du
+
+        report = StageReport(profile=args.profile, max_drop_fraction=args.max_drop)
+        preprocess_datasets(du.import_csv_data(), args.engine, workers=args.workers, report=report)
+        print(report.to_frame().to_string(index=False))
+        if args.report:
+            report.save(args.report)
@@ -0,0 +1,328 @@
+import pandas as pd
+import numpy as np
+import argparse
+import base64
+import concurrent.futures
+import functools
+import hashlib
+import io
+import json
+import os
+import sys
+import branca.colormap
+import folium
+import shapely
+from matplotlib.figure import Figure
+from shapely.geometry import mapping, shape
+import cache_utils as cu
+import spatial_utils as su
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAP_DIR = os.path.join(ROOT_DIR, 'Map Results')
+PIE_DIR = os.path.join(ROOT_DIR, 'data', 'Race Pie Chart')
+POPULATION_BY_DISTRICT = os.path.join(ROOT_DIR, 'data', 'Population_by_District.xlsx')
+
+# Simplified district geometries and the content hash of every rendered output
+GEOMETRY_CACHE_DIR = os.path.join(cu.CACHE_DIR, 'geometry')
+RENDER_MANIFEST = os.path.join(cu.CACHE_DIR, 'render_manifest.json')
+
+# Geometries are simplified by about 10 m and their coordinates rounded to about 1 m, far below what the maps show at city zoom
+SIMPLIFY_TOLERANCE = 0.0001
+COORDINATE_DECIMALS = 5
+
+# Race columns of Population_by_District.xlsx and their names in the district values, in the order of the pie wedges
+RACE_COLUMNS = {'Hispanic/Latino (of any race)': 'Hispanic',
+                'White non-Hispanic': 'White',
+                'Black non-Hispanic': 'Black',
+                'Asian non-Hispanic': 'Asian',
+                'Some other race, non-Hispanic': 'Other'}
+
+# Borough codes of the community districts, i.e. the first digit of `boro_cd`, and the borough names of the map titles
+BOROUGH_NAMES = {1: 'Manhattan', 2: 'Bronx', 3: 'Brooklyn', 4: 'Queens', 5: 'Staten Island'}
+
+NYC_CENTER = [40.7128, -74.006]
+
+def geometry_key(path = su.COMMUNITY_DISTRICTS, tolerance = SIMPLIFY_TOLERANCE, decimals = COORDINATE_DECIMALS):
+    '''
+    Builds the cache key of the simplified geometries of a GeoJSON file from its content and the simplification parameters.
+    '''
+    assert isinstance(path, str)
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(cu.fingerprint_files([path]).encode())
+    digest.update(json.dumps([tolerance, decimals]).encode())
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def simplified_geojson(path = su.COMMUNITY_DISTRICTS, tolerance = SIMPLIFY_TOLERANCE, decimals = COORDINATE_DECIMALS):
+    '''
+    Simplifies the geometries of a GeoJSON file and rounds their coordinates, once per process and once per file content on disk.
+    The maps embed the simplified geometries, which are a fraction of the size of the full resolution ones.
+
+    Parameters:
+        path (str):         Optional. Path of the GeoJSON file. Defaults to the community districts.
+        tolerance (float):  Optional. Most distance in degrees a simplified outline may move. Defaults to 0.0001 (about 10 m).
+        decimals (int):     Optional. Decimals the coordinates are rounded to. Defaults to 5 (about 1 m).
+
+    Returns:
+        dict of the GeoJSON FeatureCollection with the properties of the original features.
+    '''
+    assert isinstance(path, str) and isinstance(decimals, int)
+
+    cache_file = os.path.join(GEOMETRY_CACHE_DIR, f'{os.path.splitext(os.path.basename(path))[0]}-{geometry_key(path, tolerance, decimals)}.json')
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+
+    with open(path) as f:
+        features = json.load(f)['features']
+    geometries = shapely.simplify([shape(feature['geometry']) for feature in features], tolerance, preserve_topology=True)
+    geometries = [shapely.transform(geometry, lambda coords: np.round(coords, decimals)) for geometry in geometries]
+    geojson = {'type': 'FeatureCollection',
+               'features': [{'type': 'Feature', 'properties': feature['properties'], 'geometry': mapping(geometry)}
+                            for feature, geometry in zip(features, geometries)]}
+    # Tuples of the mapping become lists, same as when the cache file is read
+    geojson = json.loads(json.dumps(geojson))
+
+    os.makedirs(GEOMETRY_CACHE_DIR, exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(geojson, f, separators=(',', ':'))
+    os.replace(cache_file + '.tmp', cache_file)
+    return geojson
+
+def district_values(population_path = POPULATION_BY_DISTRICT, drug_crime = None, path = su.COMMUNITY_DISTRICTS):
+    '''
+    Precomputes the values of every community district that the maps and pie charts show.
+
+    Parameters:
+        population_path (str):      Optional. Path of the population by district spreadsheet. Defaults to `data/Population_by_District.xlsx`.
+        drug_crime (pd.DataFrame):  Optional. Preprocessed Drug_Crime dataset, regular or compact form, to also count the complaints of every district.
+        path (str):                 Optional. Path of the community districts GeoJSON.
+
+    Returns:
+        pd.DataFrame indexed by district with the `Borough` code, the `Latitude` and `Longitude` of its pie chart marker (centroid of its largest part),
+        its `Population`, the population of every race of `RACE_COLUMNS` and, with drug_crime, its `Crimes` and `Crimes per 1000` residents.
+    '''
+    assert isinstance(population_path, str) and isinstance(path, str)
+
+    with open(path) as f:
+        features = json.load(f)['features']
+    districts = pd.Index([int(feature['properties']['boro_cd']) for feature in features], name='District')
+    markers = []
+    for feature in features:
+        geometry = shape(feature['geometry'])
+        largest = max(geometry.geoms, key=lambda part: part.area) if hasattr(geometry, 'geoms') else geometry
+        markers.append((largest.centroid.y, largest.centroid.x))
+
+    values = pd.DataFrame(markers, index=districts, columns=['Latitude', 'Longitude'])
+    values.insert(0, 'Borough', districts // 100)
+    population = pd.read_excel(population_path).set_index('GeoID').rename(columns=RACE_COLUMNS)
+    values['Population'] = population['Total Population'].reindex(districts, fill_value=0)
+    for race in RACE_COLUMNS.values():
+        values[race] = population[race].reindex(districts, fill_value=0)
+
+    if drug_crime is not None:
+        values['Crimes'] = su.district_counts(drug_crime, path=path).reindex(districts, fill_value=0)
+        values['Crimes per 1000'] = (values['Crimes'] / values['Population'].where(values['Population'] > 0) * 1000)
+
+    return values.sort_index()
+
+def _pie_figure(races, size, dpi, title = None):
+    '''
+    Draws the pie chart of the race populations of a district, nothing if it has no population.
+    '''
+    figure = Figure(figsize=(size, size), dpi=dpi)
+    ax = figure.add_subplot()
+    if sum(races.values()) > 0:
+        ax.pie(list(races.values()))
+    else:
+        ax.axis('off')
+    if title is not None:
+        ax.set_title(title)
+    return figure
+
+def render_pie_chart(district, races, filename, size = 10, dpi = 100):
+    '''
+    Renders the race pie chart PNG of a district.
+
+    Parameters:
+        district (int):     District number.
+        races (dict):       Population of every race, in the order of the wedges.
+        filename (str):     File name of the PNG.
+        size (float):       Optional. Width and height in inches. Defaults to 10.
+        dpi (int):          Optional. Pixels per inch. Defaults to 100.
+    '''
+    _pie_figure(races, size, dpi, f'Race Population in District {district}').savefig(filename)
+
+def pie_icon_url(races, pixels = 140):
+    '''
+    Renders the race pie chart of a district as a small transparent PNG data url to use as a map marker icon.
+    '''
+    buffer = io.BytesIO()
+    figure = _pie_figure(races, 1, pixels)
+    figure.subplots_adjust(0, 0, 1, 1)
+    figure.savefig(buffer, format='png', transparent=True)
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+def render_race_map(borough, districts, filename, geometry = {}, icon_size = 70):
+    '''
+    Renders the racial composition map of a borough: the outlines of its districts with the race pie chart of every district as a marker.
+
+    Parameters:
+        borough (int):      Borough code.
+        districts (list):   Dict of every district of the borough with its `District`, `Latitude`, `Longitude` and race populations.
+        filename (str):     File name of the HTML map.
+        geometry (dict):    Optional. Keyword arguments of `simplified_geojson`.
+        icon_size (int):    Optional. Size of the pie chart markers in pixels. Defaults to 70.
+    '''
+    geojson = simplified_geojson(**geometry)
+    features = [feature for feature in geojson['features'] if int(feature['properties']['boro_cd']) // 100 == borough]
+
+    nyc_map = folium.Map(location=NYC_CENTER, zoom_start=10, tiles='cartodbpositron')
+    folium.GeoJson({'type': 'FeatureCollection', 'features': features},
+                   style_function=lambda feature: {'color': 'black', 'fillColor': 'white', 'fillOpacity': 0.7, 'weight': 1}).add_to(nyc_map)
+    for district in districts:
+        races = {race: district[race] for race in RACE_COLUMNS.values()}
+        icon = folium.CustomIcon(pie_icon_url(races, icon_size * 2), icon_size=(icon_size, icon_size))
+        folium.Marker([district['Latitude'], district['Longitude']], icon=icon).add_to(nyc_map)
+    nyc_map.save(filename)
+
+def render_choropleth(values, caption, filename, geometry = {}, colors = ['yellow', 'orange', 'red', 'purple']):
+    '''
+    Renders a map of the community districts colored by a value of every district. Districts without a value are white.
+
+    Parameters:
+        values (dict):      Value of every district number as a string, e.g. `{'101': 78390}`.
+        caption (str):      Caption of the color scale.
+        filename (str):     File name of the HTML map.
+        geometry (dict):    Optional. Keyword arguments of `simplified_geojson`.
+        colors (list):      Optional. Colors of the scale from the lowest to the highest value.
+    '''
+    known = [value for value in values.values() if value is not None]
+    colormap = branca.colormap.LinearColormap(colors, vmin=min(known, default=0), vmax=max(known, default=1), caption=caption)
+
+    def style(feature):
+        value = values.get(feature['properties']['boro_cd'])
+        return {'color': 'black', 'fillColor': colormap(value) if value is not None else 'white', 'fillOpacity': 0.7, 'weight': 1}
+
+    nyc_map = folium.Map(location=NYC_CENTER, zoom_start=10, tiles='cartodbpositron')
+    folium.GeoJson(simplified_geojson(**geometry), style_function=style).add_to(nyc_map)
+    colormap.add_to(nyc_map)
+    nyc_map.save(filename)
+
+def render_tasks(values, map_dir = MAP_DIR, pie_dir = PIE_DIR, geometry = {}):
+    '''
+    Lists the outputs to render from the district values: the pie chart of every district, the racial composition map of every borough,
+    the population map and, if the values have crime counts, the crime per population map.
+
+    Parameters:
+        values (pd.DataFrame):  District values from `district_values`.
+        map_dir (str):          Optional. Directory of the maps. Defaults to `Map Results/`.
+        pie_dir (str):          Optional. Directory of the pie charts. Defaults to `data/Race Pie Chart/`.
+        geometry (dict):        Optional. Keyword arguments of `simplified_geojson`.
+
+    Returns:
+        list of dict of every task, with the `output` file name, the `render` function and its JSON serializable `args`.
+    '''
+    assert isinstance(values, pd.DataFrame)
+
+    races = list(RACE_COLUMNS.values())
+    tasks = []
+    for district, row in values.iterrows():
+        tasks.append({'output': os.path.join(pie_dir, f'district_{district}_pie_chart.png'), 'render': render_pie_chart,
+                      'args': {'district': int(district), 'races': {race: int(row[race]) for race in races}}})
+
+    for borough, name in BOROUGH_NAMES.items():
+        rows = values[values['Borough'] == borough]
+        districts = [{'District': int(district), 'Latitude': float(row['Latitude']), 'Longitude': float(row['Longitude']),
+                      **{race: int(row[race]) for race in races}} for district, row in rows.iterrows()]
+        tasks.append({'output': os.path.join(map_dir, f'Racial Composition Map {name}.html'), 'render': render_race_map,
+                      'args': {'borough': borough, 'districts': districts, 'geometry': geometry}})
+
+    maps = [('Population', 'Population', 'Population Map.html')]
+    if 'Crimes per 1000' in values.columns:
+        maps.append(('Crimes per 1000', 'Drug crimes per 1000 residents', 'Crime Population Map_all.html'))
+    for col, caption, name in maps:
+        column = values[col].where(values['Population'] > 0)
+        tasks.append({'output': os.path.join(map_dir, name), 'render': render_choropleth,
+                      'args': {'values': {str(district): None if pd.isna(value) else float(value) for district, value in column.items()},
+                               'caption': caption, 'geometry': geometry}})
+
+    return tasks
+
+def task_hash(task, geometry_version, code_version):
+    '''
+    Hashes the content a task renders from: its arguments, the geometries it embeds (by their `geometry_key`) and the rendering code (by its `cache_utils.code_version`).
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([task['render'].__name__, task['args']], sort_keys=True).encode())
+    digest.update(geometry_version.encode())
+    digest.update(code_version.encode())
+    return digest.hexdigest()
+
+def _run_task(task):
+    task['render'](filename=task['output'], **task['args'])
+    return task['output']
+
+def render_all(drug_crime = None, map_dir = MAP_DIR, pie_dir = PIE_DIR, workers = 1, force = False, manifest = RENDER_MANIFEST, geometry = {}):
+    '''
+    Renders the district pie charts and maps, skipping every output whose content hash is unchanged since it was last rendered.
+    The district values are computed and the geometries simplified once, and the outputs are rendered across a process pool.
+
+    Parameters:
+        drug_crime (pd.DataFrame):  Optional. Preprocessed Drug_Crime dataset to also render the crime per population map.
+        map_dir (str):              Optional. Directory of the maps. Defaults to `Map Results/`.
+        pie_dir (str):              Optional. Directory of the pie charts. Defaults to `data/Race Pie Chart/`.
+        workers (int):              Optional. Number of processes. Defaults to 1.
+        force (bool):               Optional. Render every output, changed or not. Defaults to `False`.
+        manifest (str):             Optional. File of the content hash of every rendered output. Defaults to `data/.cache/render_manifest.json`.
+        geometry (dict):            Optional. Keyword arguments of `simplified_geojson`.
+
+    Returns:
+        dict of the lists of the `rendered` and `skipped` output file names.
+    '''
+    assert isinstance(workers, int) and workers > 0 and isinstance(force, bool)
+
+    tasks = render_tasks(district_values(drug_crime=drug_crime), map_dir, pie_dir, geometry)
+    # Simplified once here, the workers read it from the geometry cache
+    simplified_geojson(**geometry)
+
+    geometry_version, code_version = geometry_key(**geometry), cu.code_version([sys.modules[__name__]])
+    hashes = {}
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            hashes = json.load(f)
+    pending, skipped = [], []
+    for task in tasks:
+        task['hash'] = task_hash(task, geometry_version, code_version)
+        if force or not os.path.isfile(task['output']) or hashes.get(os.path.abspath(task['output'])) != task['hash']:
+            pending.append(task)
+        else:
+            skipped.append(task['output'])
+
+    os.makedirs(map_dir, exist_ok=True)
+    os.makedirs(pie_dir, exist_ok=True)
+    if workers == 1:
+        rendered = [_run_task(task) for task in pending]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            rendered = list(executor.map(_run_task, pending))
+
+    hashes.update({os.path.abspath(task['output']): task['hash'] for task in pending})
+    os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump(hashes, f, indent=1)
+    os.replace(manifest + '.tmp', manifest)
+
+    return {'rendered': rendered, 'skipped': skipped}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the district pie charts and maps')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes')
+    parser.add_argument('--force', action='store_true', help='Render every output, changed or not')
+    parser.add_argument('--crime', action='store_true', help='Also render the crime per population map from the preprocessed Drug_Crime dataset')
+    args = parser.parse_args()
+
+    drug_crime = cu.load_preprocessed_datasets(engine='vectorized', compact=True)['Drug_Crime'] if args.crime else None
+    result = render_all(drug_crime, workers=args.workers, force=args.force)
+    print(f"Rendered {len(result['rendered'])} outputs, skipped {len(result['skipped'])} unchanged ones")
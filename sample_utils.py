@@ -0,0 +1,461 @@
+'''
+Stratified samples of the preprocessed Drug_Crime dataset and estimates with confidence intervals from them, for quick exploratory analysis.
+
+    import sample_utils as su
+    sample = su.load_sample(fraction=0.05)
+    su.count_time_part(sample, ['hour'])['hour']          # approximate, from 5% of the complaints
+    su.count_time_part(dataset, ['hour'])['hour']         # exact, from the whole dataset
+
+Every query takes either a `StratifiedSample` or the dataset itself, and returns the same frame of `estimate`, `std_error`, `lower` and `upper` for both.
+From the whole dataset the estimate is the exact value and its interval has zero width, so a notebook switches to exact results for final reports by passing the dataset instead.
+'''
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import statistics
+import time
+import cache_utils as cu
+import data_utils as du
+
+# Columns the Drug_Crime dataset is stratified by, every combination of their values is sampled on its own
+SAMPLE_STRATA = ['BORO_NM', 'Year', 'Crime Category']
+
+# Share of the rows of every stratum kept by default
+SAMPLE_FRACTION = 0.05
+
+# Fewest rows kept of a stratum (all of them if it has fewer), so small strata are still estimated with their variance
+MIN_STRATUM_ROWS = 10
+
+# Columns of the estimate frames
+ESTIMATE_COLUMNS = ['estimate', 'std_error', 'lower', 'upper']
+
+def row_keys(dataset, hashes = None, seed = 0):
+    '''
+    Provides the random key of every row of a dataset, uniform in [0, 1). A row gets the same key every time, so samples drawn with the keys are reproducible
+    and a row that is still in a changed dataset keeps its key.
+
+    Parameters:
+        dataset (pd.DataFrame): Dataset to sample.
+        hashes (np.ndarray):    Optional. uint64 hash of every row, e.g. the raw row hashes of `ingest_utils`. If `None` (default), the rows and their index are hashed.
+        seed (int):             Optional. Seed mixed into the keys, a different seed draws an independent sample. Defaults to 0.
+
+    Returns:
+        np.ndarray of the float64 key of every row.
+    '''
+    assert isinstance(dataset, pd.DataFrame) and isinstance(seed, int)
+
+    if hashes is None:
+        hashes = pd.util.hash_pandas_object(dataset, index=True).to_numpy()
+    assert len(hashes) == len(dataset)
+
+    # splitmix64 finalizer, so the keys of similar hashes and seeds are independent
+    with np.errstate(over='ignore'):
+        x = np.asarray(hashes, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+def sample_sizes(population, fraction):
+    '''
+    Provides the number of rows kept of every stratum: the fraction of its rows rounded up, at least `MIN_STRATUM_ROWS` and at most all of them.
+    '''
+    assert 0 < fraction <= 1
+
+    return np.minimum(population, np.maximum(np.ceil(population * fraction).astype(np.int64), MIN_STRATUM_ROWS))
+
+def _reservoir(stratum, keys, sizes):
+    '''
+    Provides the bool mask of the rows with the smallest keys of their stratum, `sizes[h]` rows of stratum h.
+    '''
+    order = np.lexsort((keys, stratum))
+    starts = np.searchsorted(stratum[order], np.arange(len(sizes)))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - starts[stratum[order]]
+
+    return rank < sizes[stratum]
+
+class StratifiedSample:
+    '''
+    Stratified sample of the Drug_Crime dataset, built once with `StratifiedSample.from_dataset` and queried with `count_time_part`, `counts` and `shares`.
+    Every stratum, i.e. combination of the `SAMPLE_STRATA` values such as the felonies of the Bronx in 2019, is a reservoir of its rows with the smallest random keys (see `row_keys`).
+    A sample at a smaller fraction is a subset of the larger one (`at`), so one persisted sample serves every fraction up to its own.
+
+    Attributes:
+        rows (pd.DataFrame):    Sampled rows of the dataset, in their order in the dataset.
+        strata (pd.DataFrame):  One row per stratum with its value of every strata column, its `population` (rows in the dataset) and its `sampled` rows.
+        stratum (np.ndarray):   Stratum (row of strata) of every sampled row.
+        keys (np.ndarray):      Random key of every sampled row.
+        fraction (float):       Share of the rows of every stratum kept.
+    '''
+    def __init__(self, rows, strata, stratum, keys, fraction):
+        assert isinstance(rows, pd.DataFrame) and isinstance(strata, pd.DataFrame)
+        assert len(rows) == len(stratum) == len(keys) and 0 < fraction <= 1
+
+        self.rows = rows
+        self.strata = strata
+        self.stratum = stratum
+        self.keys = keys
+        self.fraction = fraction
+
+    @classmethod
+    def from_dataset(cls, dataset, fraction = SAMPLE_FRACTION, strata = SAMPLE_STRATA, hashes = None, seed = 0):
+        '''
+        Samples the preprocessed Drug_Crime dataset, regular or compact form, in a single pass. Missing values are a stratum value of their own.
+
+        Parameters:
+            dataset (pd.DataFrame): Preprocessed Drug_Crime dataset.
+            fraction (float):       Optional. Share of the rows of every stratum to keep. Defaults to `SAMPLE_FRACTION`.
+            strata (list):          Optional. Columns to stratify by. Defaults to `SAMPLE_STRATA`.
+            hashes (np.ndarray):    Optional. uint64 hash of every row the keys are drawn from, see `row_keys`.
+            seed (int):             Optional. Seed of the keys. Defaults to 0.
+
+        Returns:
+            StratifiedSample of the dataset.
+        '''
+        assert isinstance(dataset, pd.DataFrame) and isinstance(strata, list) and 0 < fraction <= 1
+        assert all(col in dataset.columns for col in strata)
+
+        codes, levels = [], []
+        for col in strata:
+            col_codes, col_levels = pd.factorize(dataset[col], sort=True, use_na_sentinel=False)
+            codes.append(col_codes)
+            levels.append(col_levels)
+        shape = tuple(len(col_levels) for col_levels in levels)
+        cells, stratum = np.unique(np.ravel_multi_index(codes, shape), return_inverse=True)
+        stratum = stratum.ravel()
+        cell_codes = np.unravel_index(cells, shape)
+
+        table = pd.DataFrame({col: col_levels[c] for col, col_levels, c in zip(strata, levels, cell_codes)})
+        table['population'] = np.bincount(stratum, minlength=len(cells))
+        table['sampled'] = sample_sizes(table['population'].to_numpy(), fraction)
+
+        keys = row_keys(dataset, hashes, seed)
+        keep = _reservoir(stratum, keys, table['sampled'].to_numpy())
+
+        return cls(dataset[keep], table, stratum[keep], keys[keep], fraction)
+
+    def at(self, fraction):
+        '''
+        Provides the sample at a smaller fraction, the same as sampling the dataset at that fraction with the same keys.
+
+        Parameters:
+            fraction (float):   Share of the rows of every stratum to keep, at most the fraction of this sample.
+
+        Returns:
+            StratifiedSample
+        '''
+        assert 0 < fraction <= self.fraction
+
+        strata = self.strata.copy()
+        strata['sampled'] = sample_sizes(strata['population'].to_numpy(), fraction)
+        keep = _reservoir(self.stratum, self.keys, strata['sampled'].to_numpy())
+
+        return StratifiedSample(self.rows[keep], strata, self.stratum[keep], self.keys[keep], fraction)
+
+    def weights(self):
+        '''
+        Provides the weight of every sampled row, the number of rows of the dataset it stands for (population over sampled rows of its stratum).
+        '''
+        return (self.strata['population'].to_numpy() / self.strata['sampled'].to_numpy())[self.stratum]
+
+    def save(self, path):
+        '''
+        Writes the sample to a directory of Parquet files. The metadata is written last, so an interrupted write leaves no valid sample behind.
+
+        Parameters:
+            path (str): Directory of the sample. Created if missing.
+        '''
+        assert isinstance(path, str)
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(os.path.join(path, 'sample.json')):
+            os.remove(os.path.join(path, 'sample.json'))
+        rows = self.rows.copy(deep=False)
+        rows['_stratum'] = self.stratum
+        rows['_key'] = self.keys
+        cu.save_datasets({'Sample': rows, 'Strata': self.strata}, path)
+        with open(os.path.join(path, 'sample.json'), 'w') as f:
+            json.dump({'fraction': self.fraction, 'strata': [col for col in self.strata.columns if col not in ['population', 'sampled']],
+                       'rows': len(self.rows), 'population': int(self.strata['population'].sum())}, f)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads a sample written by `save`.
+
+        Parameters:
+            path (str): Directory of the sample.
+
+        Returns:
+            StratifiedSample, or None if there is no sample.
+        '''
+        assert isinstance(path, str)
+
+        if not os.path.isfile(os.path.join(path, 'sample.json')):
+            return None
+
+        with open(os.path.join(path, 'sample.json')) as f:
+            meta = json.load(f)
+        datasets = cu.load_datasets(path)
+        rows = datasets['Sample']
+        stratum = rows.pop('_stratum').to_numpy(dtype=np.int64)
+        keys = rows.pop('_key').to_numpy(dtype=np.float64)
+
+        return cls(rows, datasets['Strata'], stratum, keys, meta['fraction'])
+
+def _source_rows(source, fraction):
+    '''
+    Provides the rows of a query source, the stratum of every row and the population and sampled rows of every stratum.
+    The whole dataset is a single stratum sampled completely, so its estimates are exact.
+    '''
+    if isinstance(source, StratifiedSample):
+        if fraction is not None:
+            source = source.at(fraction)
+        return source.rows, source.stratum, source.strata['population'].to_numpy(), source.strata['sampled'].to_numpy()
+
+    if not isinstance(source, pd.DataFrame):
+        raise Exception('An invalid source was provided, please provide a preprocessed Drug_Crime dataset or a StratifiedSample of it!')
+    return source, np.zeros(len(source), dtype=np.int64), np.array([len(source)]), np.array([len(source)])
+
+def _interval(estimate, variance, confidence, lower_bound = 0, upper_bound = np.inf):
+    '''
+    Provides the estimate frame of estimates and their variances, with the normal confidence interval clipped to the possible values.
+    '''
+    assert 0 < confidence < 1
+
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    std_error = np.sqrt(np.maximum(variance, 0))
+    return pd.DataFrame({'estimate': estimate, 'std_error': std_error,
+                         'lower': np.clip(estimate - z * std_error, lower_bound, upper_bound),
+                         'upper': np.clip(estimate + z * std_error, lower_bound, upper_bound)})
+
+def estimate_totals(table, population, sampled, confidence = 0.95):
+    '''
+    Estimates the number of rows of the dataset in every group from the sampled rows with the stratified estimator, with the variance of sampling without replacement.
+    A stratum sampled completely adds no variance, so the estimates from the whole dataset are exact.
+
+    Parameters:
+        table (np.ndarray):         2-D int array of shape (stratum, group) of the sampled rows of every group.
+        population (np.ndarray):    Rows of the dataset of every stratum.
+        sampled (np.ndarray):       Sampled rows of every stratum.
+        confidence (float):         Optional. Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        pd.DataFrame with a row per group and the `ESTIMATE_COLUMNS`.
+    '''
+    population = population.astype(np.float64)[:, None]
+    sampled = sampled.astype(np.float64)[:, None]
+
+    share = table / np.maximum(sampled, 1)
+    finite = 1 - sampled / np.maximum(population, 1)
+    estimate = (population / np.maximum(sampled, 1) * table).sum(axis=0)
+    variance = (population ** 2 * finite * share * (1 - share) / np.maximum(sampled - 1, 1)).sum(axis=0)
+
+    return _interval(estimate, variance, confidence)
+
+def estimate_shares(table, population, sampled, confidence = 0.95):
+    '''
+    Estimates the share of the rows of the dataset in every group, out of the rows of all groups, with the stratified ratio estimator and its linearized variance.
+
+    Parameters:
+        table (np.ndarray):         2-D int array of shape (stratum, group) of the sampled rows of every group.
+        population (np.ndarray):    Rows of the dataset of every stratum.
+        sampled (np.ndarray):       Sampled rows of every stratum.
+        confidence (float):         Optional. Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        pd.DataFrame with a row per group and the `ESTIMATE_COLUMNS`.
+    '''
+    population = population.astype(np.float64)[:, None]
+    sampled = sampled.astype(np.float64)[:, None]
+    table = table.astype(np.float64)
+    total = table.sum(axis=1, keepdims=True)
+
+    weights = population / np.maximum(sampled, 1)
+    estimate_total = (weights * total).sum()
+    if estimate_total == 0:
+        return _interval(np.zeros(table.shape[1]), np.zeros(table.shape[1]), confidence, upper_bound=1)
+    ratio = (weights * table).sum(axis=0) / estimate_total
+
+    # Residuals d = y - ratio * x of every row, where y is 1 in the group and x is 1 in any group
+    residual_sum = table - ratio * total
+    residual_squares = table * (1 - ratio) ** 2 + (total - table) * ratio ** 2
+    residual_variance = (residual_squares - residual_sum ** 2 / np.maximum(sampled, 1)) / np.maximum(sampled - 1, 1)
+    finite = 1 - sampled / np.maximum(population, 1)
+    variance = (population ** 2 * finite * residual_variance / np.maximum(sampled, 1)).sum(axis=0) / estimate_total ** 2
+
+    return _interval(ratio, variance, confidence, upper_bound=1)
+
+def _group_table(source, by, where, fraction):
+    '''
+    Counts the sampled rows of every group per stratum for `counts` and `shares`. Rows with a missing value in a by column are not counted, same as `groupby`.
+
+    Returns:
+        tuple of the (stratum, group) np.ndarray of counts, the pd.Index of the groups, and the population and sampled rows of every stratum.
+    '''
+    by = [by] if isinstance(by, str) else by
+    assert isinstance(by, list) and isinstance(where, dict)
+
+    rows, stratum, population, sampled = _source_rows(source, fraction)
+    mask = du.where_mask(rows, where)
+    if mask is not None:
+        rows, stratum = rows[mask], stratum[mask]
+
+    if len(by) == 0:
+        return np.bincount(stratum, minlength=len(population))[:, None], pd.Index(['All']), population, sampled
+
+    groups = pd.DataFrame({'_stratum': stratum})
+    for col in by:
+        groups[col] = rows[col].to_numpy()
+    table = groups.groupby(['_stratum'] + by, sort=True).size().unstack(level=0, fill_value=0)
+    table = table.reindex(columns=range(len(population)), fill_value=0)
+
+    return table.to_numpy().T, table.index, population, sampled
+
+def counts(source, by = [], where = {}, fraction = None, confidence = 0.95):
+    '''
+    Estimates the number of complaints grouped by some columns, optionally filtered, the same query as `CountCube.counts` and `dataset[mask].groupby(by).size()`.
+    Only groups with a sampled complaint are estimated.
+
+    Parameters:
+        source (StratifiedSample|pd.DataFrame): Sample to estimate from, or the preprocessed Drug_Crime dataset for exact counts.
+        by (str|list):                          Optional. Column(s) to group by, e.g. `'BORO_NM'` or `['Year', 'Crime Category']`. If empty (default), the total count is estimated.
+        where (dict):                           Optional. Dict of the column as the key and the value, or list of values, to keep as the value, e.g. `{'BORO_NM': 'BRONX', 'Year': [2019, 2020]}`.
+        fraction (float):                       Optional. Share of the rows of every stratum to use, at most the fraction of the sample. Defaults to `None` (the whole sample).
+        confidence (float):                     Optional. Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        pd.DataFrame indexed by the by columns with the `ESTIMATE_COLUMNS`, or pd.Series of them for the total count if by is empty.
+    '''
+    table, groups, population, sampled = _group_table(source, by, where, fraction)
+    result = estimate_totals(table, population, sampled, confidence).set_axis(groups)
+
+    return result.iloc[0] if len(by) == 0 else result
+
+def shares(source, by, where = {}, fraction = None, confidence = 0.95):
+    '''
+    Estimates the share of the complaints of every group, e.g. of every crime type or borough, out of all complaints with a value in the by columns that match the filter.
+
+    Parameters:
+        source (StratifiedSample|pd.DataFrame): Sample to estimate from, or the preprocessed Drug_Crime dataset for exact shares.
+        by (str|list):                          Column(s) to group by, e.g. `'Crime'`.
+        where (dict):                           Optional. Filter of the complaints, same as `counts`.
+        fraction (float):                       Optional. Share of the rows of every stratum to use, at most the fraction of the sample. Defaults to `None` (the whole sample).
+        confidence (float):                     Optional. Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        pd.DataFrame indexed by the by columns with the `ESTIMATE_COLUMNS`.
+    '''
+    assert len(by) > 0
+
+    table, groups, population, sampled = _group_table(source, by, where, fraction)
+    return estimate_shares(table, population, sampled, confidence).set_axis(groups)
+
+def count_time_part(source, times = {'hour': 0, 'minute': 0, 'second': 0}, fraction = None, confidence = 0.95):
+    '''
+    Estimates the counts of the hours, minutes and seconds of the `Time` column, the same as `data_utils.count_time_part`.
+
+    Parameters:
+        source (StratifiedSample|pd.DataFrame): Sample to estimate from, or the preprocessed Drug_Crime dataset for exact counts.
+        times (dict|list|str):                  Optional. The desired parts of the time and their start time, same as `data_utils.count_time_part`.
+        fraction (float):                       Optional. Share of the rows of every stratum to use, at most the fraction of the sample. Defaults to `None` (the whole sample).
+        confidence (float):                     Optional. Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        dict of pd.DataFrame. Keys will be the desired part provided in `times`.
+        Each item has one row per time value, with the first row being the start time set by times, and the `ESTIMATE_COLUMNS`.
+    '''
+    rows, stratum, population, sampled = _source_rows(source, fraction)
+    histograms = du.time_histogram(rows['Time'], times, by=pd.Series(stratum))
+
+    estimates = {}
+    for t, histogram in histograms.items():
+        table = histogram.reindex(range(len(population)), fill_value=0).to_numpy()
+        estimates[t] = estimate_totals(table, population, sampled, confidence).set_axis(histogram.columns)
+
+    return estimates
+
+def sample_path(filenames = [], cache_dir = cu.CACHE_DIR, **params):
+    '''
+    Provides the directory of the persisted sample of the preprocessed Drug_Crime dataset, next to the cached datasets.
+    '''
+    # Kept in a subdirectory so `load_datasets` does not pick it up as a dataset
+    return os.path.join(cu.cache_path(filenames, cache_dir, **params), 'samples', 'Drug_Crime')
+
+def load_sample(filenames = [], fraction = SAMPLE_FRACTION, cache_dir = cu.CACHE_DIR, refresh = False, **params):
+    '''
+    Provides the stratified sample of the preprocessed Drug_Crime dataset, persisted next to the cached datasets.
+    The sample is built once, at `SAMPLE_FRACTION` or the given fraction if it is larger, and smaller fractions are taken from it without loading the dataset.
+
+    Parameters:
+        filenames (list):   Optional. List of CSV file names as strings. If empty (default), all relevant dataset CSVs located in data/ are used.
+        fraction (float):   Optional. Share of the rows of every stratum to keep. Defaults to `SAMPLE_FRACTION`.
+        cache_dir (str):    Optional. Directory of the cache. Defaults to `data/.cache`.
+        refresh (bool):     Optional. Ignore any persisted sample and build it again. Defaults to `False`.
+        params:             Optional. Keyword arguments passed to `preprocess_datasets`.
+
+    Returns:
+        StratifiedSample of the Drug_Crime dataset.
+    '''
+    assert isinstance(filenames, list) and isinstance(cache_dir, str) and isinstance(refresh, bool)
+    assert 0 < fraction <= 1
+
+    path = sample_path(filenames, cache_dir, **params)
+    sample = None if refresh else StratifiedSample.load(path)
+    if sample is None or sample.fraction < fraction:
+        dataset = cu.load_preprocessed_datasets(filenames, cache_dir, **params)['Drug_Crime']
+        sample = StratifiedSample.from_dataset(dataset, max(fraction, SAMPLE_FRACTION))
+        sample.save(path)
+
+    return sample.at(fraction) if fraction < sample.fraction else sample
+
+def refresh_sample(dataset, path, fraction = None, hashes = None):
+    '''
+    Samples a dataset that changed again, e.g. the store of `ingest_utils.ingest_snapshot` after new rows were ingested, and persists the sample.
+    With the same row hashes, rows that stay in the dataset keep their key, so a stratum only changes where rows were added or removed.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset.
+        path (str):             Directory of the sample.
+        fraction (float):       Optional. Share of the rows of every stratum to keep. If `None` (default), the fraction of the persisted sample, and nothing is done if there is none.
+        hashes (np.ndarray):    Optional. uint64 hash of every row the keys are drawn from, see `row_keys`.
+
+    Returns:
+        StratifiedSample of the dataset, or None if there is no sample to refresh.
+    '''
+    assert isinstance(dataset, pd.DataFrame) and isinstance(path, str)
+
+    if fraction is None:
+        if not os.path.isfile(os.path.join(path, 'sample.json')):
+            return None
+        with open(os.path.join(path, 'sample.json')) as f:
+            fraction = json.load(f)['fraction']
+
+    sample = StratifiedSample.from_dataset(dataset, fraction, hashes=hashes)
+    sample.save(path)
+
+    return sample
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quick approximate counts of the Drug_Crime complaints from a stratified sample')
+    parser.add_argument('--fraction', type=float, default=SAMPLE_FRACTION, help='Share of the complaints of every stratum to estimate from')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--exact', action='store_true', help='Count the whole dataset instead, for final reports')
+    parser.add_argument('--refresh', action='store_true', help='Build the persisted sample again')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.exact:
+        source = cu.load_preprocessed_datasets()['Drug_Crime']
+    else:
+        source = load_sample(fraction=args.fraction, refresh=args.refresh)
+    loaded = time.perf_counter()
+
+    pd.set_option('display.float_format', '{:,.4g}'.format)
+    print(count_time_part(source, ['hour'], confidence=args.confidence)['hour'].to_string())
+    print(shares(source, 'Crime', confidence=args.confidence).to_string())
+    print(f'Loaded in {loaded - start:.2f} s, estimated in {time.perf_counter() - loaded:.2f} s')
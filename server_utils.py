@@ -0,0 +1,332 @@
+'''
+Long-lived analysis server that holds the preprocessed datasets in memory and answers `data_utils` queries over a local HTTP API, and its client.
+
+    python server_utils.py serve --port 8143
+
+    import server_utils as sv
+    client = sv.AnalysisClient(port=8143)
+    client.count_time_part('Time', ['hour'], where={'BORO_NM': 'BRONX'})
+
+The datasets are loaded once (from the preprocessing cache of `cache_utils` when it is warm), and every query is answered from memory.
+Results are encoded once and kept in an LRU, so repeated queries, e.g. of a dashboard, are only looked up.
+'''
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import http.server
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import data_utils as du
+from cube_utils import CountCube
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8143
+
+# Number of encoded results kept by the server
+CACHE_SIZE = 1024
+
+def encode_result(result):
+    '''
+    Converts the result of a query to JSON serializable values. DataFrames and Series keep their index, columns and names, see `decode_result`.
+    '''
+    if isinstance(result, pd.DataFrame):
+        return {'__frame__': True, 'index': encode_result(result.index), 'columns': [str(col) for col in result.columns],
+                'data': [[_json_value(value) for value in row] for row in result.itertuples(index=False)]}
+    if isinstance(result, pd.Series):
+        return {'__series__': True, 'index': encode_result(result.index), 'name': result.name,
+                'data': [_json_value(value) for value in result]}
+    if isinstance(result, pd.MultiIndex):
+        return {'__index__': True, 'names': list(result.names), 'data': [[_json_value(value) for value in row] for row in result]}
+    if isinstance(result, pd.Index):
+        return {'__index__': True, 'names': [result.name], 'data': [_json_value(value) for value in result]}
+    if isinstance(result, dict):
+        # Keys are kept with their type, since JSON object keys are always strings
+        return {'__dict__': True, 'items': [[_json_value(key), encode_result(value)] for key, value in result.items()]}
+    return _json_value(result)
+
+def _json_value(value):
+    '''
+    Converts a numpy scalar or missing value to the python value JSON can hold.
+    '''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+def decode_result(result):
+    '''
+    Converts a result encoded by `encode_result` back to the pd.DataFrame, pd.Series or dict it was.
+    '''
+    if isinstance(result, dict) and result.get('__frame__'):
+        return pd.DataFrame(result['data'], index=decode_result(result['index']), columns=result['columns'])
+    if isinstance(result, dict) and result.get('__series__'):
+        return pd.Series(result['data'], index=decode_result(result['index']), name=result['name'])
+    if isinstance(result, dict) and result.get('__index__'):
+        if len(result['names']) > 1:
+            return pd.MultiIndex.from_tuples([tuple(row) for row in result['data']], names=result['names'])
+        return pd.Index(result['data'], name=result['names'][0])
+    if isinstance(result, dict) and result.get('__dict__'):
+        return {key: decode_result(value) for key, value in result['items']}
+    return result
+
+class AnalysisServer:
+    '''
+    Holds the preprocessed datasets and answers queries on them. The datasets are only read, so any number of threads can query at once.
+    Every query is answered by one of the `data_utils` functions (or the count cube for grouped counts) and memoized with an LRU of its encoded result.
+
+    Attributes:
+        datasets (dict):        Preprocessed datasets, `'Drug_Crime'` (regular or compact form) and `'Census'`.
+        cube (CountCube):       Count cube of the Drug_Crime dataset for grouped counts.
+        park_indexes (dict):    Park index from `du.build_park_index` of every (dataset, column) queried by `group_count_parks`.
+        cache_size (int):       Most encoded results kept.
+    '''
+    def __init__(self, datasets, cache_size = CACHE_SIZE):
+        assert isinstance(datasets, dict) and isinstance(cache_size, int)
+
+        self.datasets = datasets
+        self.cache_size = cache_size
+        self.cube = CountCube.from_dataset(datasets['Drug_Crime']) if 'Drug_Crime' in datasets else None
+        # Built once per (dataset, column) from all of its parks, so every filtered `group_count_parks` query reuses it instead of tokenizing again
+        self.park_indexes = {}
+        self.started = time.time()
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._query = functools.lru_cache(maxsize=cache_size)(self._run)
+
+    @property
+    def operations(self):
+        return {'count_time_part': self.count_time_part,
+                'group_count_parks': self.group_count_parks,
+                'filter_by_boro_feature': self.filter_by_boro_feature,
+                'normalize': self.normalize,
+                'counts': self.counts,
+                'info': self.info}
+
+    def _dataset(self, name):
+        if name not in self.datasets:
+            raise KeyError(f'Unknown dataset {name!r}')
+        return self.datasets[name]
+
+    def count_time_part(self, time_col = 'Time', times = {'hour': 0, 'minute': 0, 'second': 0}, where = {}, dataset = 'Drug_Crime'):
+        dataset = self._dataset(dataset)
+        mask = du.where_mask(dataset, where)
+        column = dataset[time_col] if mask is None else dataset[time_col][mask]
+        return du.count_time_part(column, times)
+
+    def group_count_parks(self, parks = 'PARKS_NM', k = 15, exclude = du.PARK_STOP_WORDS, where = {}, dataset = 'Drug_Crime'):
+        dataset = self._dataset(dataset)
+        mask = du.where_mask(dataset, where)
+        column = dataset[parks] if mask is None else dataset[parks][mask]
+        with self._lock:
+            if (id(dataset), parks) not in self.park_indexes:
+                self.park_indexes[(id(dataset), parks)] = du.build_park_index(dataset[parks])
+        return du.group_count_parks(column, k, index=self.park_indexes[(id(dataset), parks)], exclude=exclude)
+
+    def filter_by_boro_feature(self, dataset = 'Census', boro = '', feature = '', rename = True):
+        return du.filter_by_boro_feature(self._dataset(dataset), boro, feature, rename)
+
+    def normalize(self, dataset = 'Census', axis = 'row', boro = '', feature = '', rename = True):
+        return du.normalize(du.filter_by_boro_feature(self._dataset(dataset), boro, feature, rename), axis)
+
+    def counts(self, by = [], where = {}):
+        if self.cube is None:
+            raise KeyError("Unknown dataset 'Drug_Crime'")
+        return self.cube.counts(by, where)
+
+    def info(self):
+        return {'datasets': {name: {'rows': len(dataset), 'columns': [str(col) for col in dataset.columns]} for name, dataset in self.datasets.items()},
+                'uptime_seconds': time.time() - self.started,
+                'queries': self.queries,
+                'cache': self._query.cache_info()._asdict()}
+
+    def _run(self, operation, args):
+        return json.dumps({'result': encode_result(self.operations[operation](**json.loads(args)))}).encode()
+
+    def query(self, operation, args = {}):
+        '''
+        Answers a query, from the LRU if the same query was answered before.
+
+        Parameters:
+            operation (str):    Name of the operation, one of `operations`.
+            args (dict):        Optional. Keyword arguments of the operation, JSON serializable.
+
+        Returns:
+            bytes of the JSON response with the encoded result.
+        '''
+        assert isinstance(operation, str) and isinstance(args, dict)
+
+        if operation not in self.operations:
+            raise KeyError(f'Unknown operation {operation!r}')
+        with self._lock:
+            self.queries += 1
+        if operation == 'info':
+            return self._run(operation, '{}')
+        return self._query(operation, json.dumps(args, sort_keys=True))
+
+    def clear_cache(self):
+        self._query.cache_clear()
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for the connections of many clients at once, the default of 5 resets some of them
+    request_queue_size = 128
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles `POST /<operation>` with the JSON keyword arguments as the body, and `GET /info`.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond(self.path.strip('/'), {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            args = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            return self._send(400, {'error': f'Invalid JSON: {e}'})
+        self._respond(self.path.strip('/'), args)
+
+    def _respond(self, operation, args):
+        if operation not in self.server.analysis.operations:
+            return self._send(404, {'error': f'Unknown operation {operation!r}'})
+        try:
+            body = self.server.analysis.query(operation, args)
+        except (KeyError, TypeError, ValueError, AssertionError) as e:
+            return self._send(400, {'error': f'{type(e).__name__}: {str(e) or "invalid arguments"}'})
+        except Exception as e:
+            return self._send(500, {'error': f'{type(e).__name__}: {e}'})
+        self._send(200, body)
+
+    def _send(self, status, body):
+        body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(datasets, host = DEFAULT_HOST, port = DEFAULT_PORT, cache_size = CACHE_SIZE, background = False):
+    '''
+    Serves queries on the preprocessed datasets over HTTP, one thread per connection.
+
+    Parameters:
+        datasets (dict):        Preprocessed datasets, e.g. from `cache_utils.load_preprocessed_datasets(compact=True)`.
+        host (str):             Optional. Address to listen on. Defaults to `127.0.0.1`, i.e. local clients only.
+        port (int):             Optional. Port to listen on, 0 for any free port. Defaults to 8143.
+        cache_size (int):       Optional. Most encoded results kept. Defaults to 1024.
+        background (bool):      Optional. Serve from a daemon thread and return right away instead of serving forever. Defaults to `False`.
+
+    Returns:
+        http.server.ThreadingHTTPServer, with the `AnalysisServer` as its `analysis` attribute. Call `shutdown()` to stop a background server.
+    '''
+    assert isinstance(host, str) and isinstance(port, int) and isinstance(background, bool)
+
+    server = _Server((host, port), _RequestHandler)
+    server.analysis = AnalysisServer(datasets, cache_size)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    return server
+
+class AnalysisClient:
+    '''
+    Client of the analysis server with the call signatures of the `data_utils` functions.
+    Columns and datasets are given by name instead of as pandas objects, since the data stays in the server, and most queries take an optional `where` filter.
+    The results are the same as calling the `data_utils` function on the server's datasets.
+
+    Attributes:
+        url (str):          Base url of the server.
+        timeout (float):    Seconds to wait for a response.
+    '''
+    def __init__(self, host = DEFAULT_HOST, port = DEFAULT_PORT, timeout = 60):
+        assert isinstance(host, str) and isinstance(port, int)
+
+        self.url = f'http://{host}:{port}'
+        self.timeout = timeout
+
+    def query(self, operation, **args):
+        '''
+        Sends a query to the server.
+
+        Parameters:
+            operation (str):    Name of the operation.
+            args:               Keyword arguments of the operation.
+
+        Returns:
+            the decoded result of the operation.
+        '''
+        request = urllib.request.Request(f'{self.url}/{operation}', data=json.dumps(args).encode(), headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise Exception(f"Query {operation!r} failed: {json.loads(e.read()).get('error')}") from None
+        return decode_result(body['result'])
+
+    def count_time_part(self, time_col = 'Time', times = {'hour': 0, 'minute': 0, 'second': 0}, where = {}):
+        '''
+        Same as `du.count_time_part(dataset[time_col][mask], times)` on the server's Drug_Crime dataset, where the mask keeps the rows matching `where`.
+        '''
+        return self.query('count_time_part', time_col=time_col, times=times, where=where)
+
+    def group_count_parks(self, parks = 'PARKS_NM', k = 15, exclude = du.PARK_STOP_WORDS, where = {}):
+        '''
+        Same as `du.group_count_parks(dataset[parks][mask], k, exclude=exclude)` on the server's Drug_Crime dataset, where the mask keeps the rows matching `where`.
+        '''
+        return self.query('group_count_parks', parks=parks, k=k, exclude=exclude, where=where)
+
+    def filter_by_boro_feature(self, dataset = 'Census', boro = '', feature = '', rename = True):
+        '''
+        Same as `du.filter_by_boro_feature` on the server's dataset of the given name.
+        '''
+        return self.query('filter_by_boro_feature', dataset=dataset, boro=boro, feature=feature, rename=rename)
+
+    def normalize(self, dataset = 'Census', axis = 'row', boro = '', feature = '', rename = True):
+        '''
+        Same as `du.normalize(du.filter_by_boro_feature(dataset, boro, feature, rename), axis)` on the server's dataset of the given name.
+        '''
+        return self.query('normalize', dataset=dataset, axis=axis, boro=boro, feature=feature, rename=rename)
+
+    def counts(self, by = [], where = {}):
+        '''
+        Same as `CountCube.counts(by, where)` of the server's Drug_Crime dataset, i.e. `dataset[mask].groupby(by).size()`.
+        '''
+        return self.query('counts', by=by, where=where)
+
+    def info(self):
+        '''
+        Provides the datasets, uptime, number of queries and LRU statistics of the server.
+        '''
+        return self.query('info')
+
+if __name__ == '__main__':
+    import cache_utils as cu
+
+    parser = argparse.ArgumentParser(description='Analysis server of the preprocessed datasets')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Load the preprocessed datasets once and answer queries on them')
+    serve_parser.add_argument('--host', default=DEFAULT_HOST, help='Address to listen on')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    serve_parser.add_argument('--engine', default='vectorized', choices=['python', 'vectorized'], help='Engine of the row-local Drug_Crime steps on a cache miss')
+    serve_parser.add_argument('--no-compact', action='store_true', help='Hold Drug_Crime in the regular form instead of the compact form')
+    serve_parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help='Most results kept in the LRU')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        datasets = cu.load_preprocessed_datasets(engine=args.engine, compact=not args.no_compact)
+        print(f'Serving on http://{args.host}:{args.port}', flush=True)
+        serve(datasets, args.host, args.port, args.cache_size)
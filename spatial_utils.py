@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy as np
+import functools
+import json
+import os
+import shapely
+from shapely.geometry import shape
+
+CITY_FEATURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'City_Features')
+COMMUNITY_DISTRICTS = os.path.join(CITY_FEATURES_DIR, 'Community_Districts.geojson')
+BOROUGH_BOUNDARIES = os.path.join(CITY_FEATURES_DIR, 'Borough_Boundaries.geojson')
+
+# Borough codes of the City_Features datasets and the borough names used in BORO_NM
+BOROUGH_CODES = {1: 'MANHATTAN', 2: 'BRONX', 3: 'BROOKLYN', 4: 'QUEENS', 5: 'STATEN ISLAND'}
+
+@functools.lru_cache(maxsize=None)
+def load_polygons(path, key):
+    '''
+    Loads the polygons of a GeoJSON file once per process and builds a spatial index (STRtree) over them.
+
+    Parameters:
+        path (str): Path of the GeoJSON file.
+        key (str):  Property of the features that identifies each polygon, e.g. `'boro_cd'`. Must be an integer.
+
+    Returns:
+        tuple of the shapely.STRtree of the polygons and the np.ndarray of their int identifiers.
+    '''
+    assert isinstance(path, str) and isinstance(key, str)
+
+    with open(path) as f:
+        features = json.load(f)['features']
+    polygons = [shape(feature['geometry']) for feature in features]
+    ids = np.array([int(feature['properties'][key]) for feature in features], dtype=np.int64)
+
+    return shapely.STRtree(polygons), ids
+
+def lat_lon_arrays(dataset):
+    '''
+    Provides the latitude and longitude of every row of the Drug_Crime dataset as float64 arrays, from either the `Lat_Lon` tuples or the `Latitude`/`Longitude` columns of the compact form.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    if 'Latitude' in dataset.columns and 'Longitude' in dataset.columns:
+        return dataset['Latitude'].to_numpy(dtype=np.float64), dataset['Longitude'].to_numpy(dtype=np.float64)
+
+    lat_lon = np.array(dataset['Lat_Lon'].tolist(), dtype=np.float64).reshape(-1, 2)
+    return lat_lon[:, 0], lat_lon[:, 1]
+
+@functools.lru_cache(maxsize=None)
+def polygon_grid(path, key, cell_size = 0.005):
+    '''
+    Rasterizes the polygons of a GeoJSON file onto a grid of longitude/latitude cells once per process. 
+    Points in a cell that lies entirely inside one polygon, or outside all polygons, are assigned from the grid without any geometric test.
+
+    Parameters:
+        path (str):         Path of the GeoJSON file.
+        key (str):          Property of the features that identifies each polygon.
+        cell_size (float):  Optional. Width and height of a cell in degrees. Defaults to 0.005 (about 500 m).
+
+    Returns:
+        tuple of the grid origin (lon, lat), the cell size and the 2-D np.ndarray of the polygon position of every cell, 
+        -1 for cells outside all polygons and -2 for cells that need the spatial index.
+    '''
+    tree, ids = load_polygons(path, key)
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(tree.geometries)
+    n_lon, n_lat = int(np.ceil((max_lon - min_lon) / cell_size)), int(np.ceil((max_lat - min_lat) / cell_size))
+
+    cell_lon, cell_lat = np.meshgrid(min_lon + np.arange(n_lon) * cell_size, min_lat + np.arange(n_lat) * cell_size, indexing='ij')
+    cells = shapely.box(cell_lon.ravel(), cell_lat.ravel(), cell_lon.ravel() + cell_size, cell_lat.ravel() + cell_size)
+
+    grid = np.full(len(cells), -1, dtype=np.int64)
+    cell_idx, polygon_idx = tree.query(cells, predicate='intersects')
+    hits = np.bincount(cell_idx, minlength=len(cells))
+    grid[hits > 1] = -2
+
+    # A cell that intersects a single polygon is either inside it or on its edge
+    single = hits[cell_idx] == 1
+    inside = shapely.contains_properly(tree.geometries[polygon_idx[single]], cells[cell_idx[single]])
+    grid[cell_idx[single]] = np.where(inside, polygon_idx[single], -2)
+
+    return (min_lon, min_lat), cell_size, grid.reshape(n_lon, n_lat)
+
+def spatial_join(lat, lon, path, key, batch_size = 1000000):
+    '''
+    Finds the polygon that contains every point, in vectorized batches of points. 
+    Points are looked up in the grid of `polygon_grid` first, and only points in cells on a polygon edge are tested with the spatial index.
+
+    Parameters:
+        lat (np.ndarray):   Latitude of every point.
+        lon (np.ndarray):   Longitude of every point.
+        path (str):         Path of the GeoJSON file of the polygons.
+        key (str):          Property of the features that identifies each polygon.
+        batch_size (int):   Optional. Number of points queried at a time. Defaults to 1000000.
+
+    Returns:
+        np.ndarray of the identifier of the polygon of every point, -1 if no polygon contains it. A point on the boundary of several polygons gets the first one.
+    '''
+    assert len(lat) == len(lon) and isinstance(batch_size, int) and batch_size > 0
+
+    tree, ids = load_polygons(path, key)
+    (min_lon, min_lat), cell_size, grid = polygon_grid(path, key)
+
+    result = np.full(len(lat), -1, dtype=np.int64)
+    for start in range(0, len(lat), batch_size):
+        batch_lat, batch_lon = lat[start:start + batch_size], lon[start:start + batch_size]
+
+        # Grid lookup, points outside the grid or with missing coordinates are outside all polygons
+        i = np.floor((batch_lon - min_lon) / cell_size)
+        j = np.floor((batch_lat - min_lat) / cell_size)
+        on_grid = (0 <= i) & (i < grid.shape[0]) & (0 <= j) & (j < grid.shape[1])
+        positions = np.full(len(batch_lat), -1, dtype=np.int64)
+        positions[on_grid] = grid[i[on_grid].astype(np.int64), j[on_grid].astype(np.int64)]
+
+        # Spatial index for the points on polygon edges
+        edge = np.flatnonzero(positions == -2)
+        positions[edge] = -1
+        point_idx, polygon_idx = tree.query(shapely.points(batch_lon[edge], batch_lat[edge]), predicate='within')
+        first = np.unique(point_idx, return_index=True)[1]
+        positions[edge[point_idx[first]]] = polygon_idx[first]
+
+        result[start:start + batch_size] = np.where(positions >= 0, ids[positions], -1)
+
+    return result
+
+def assign_districts(dataset, path = COMMUNITY_DISTRICTS, merge = False, batch_size = 1000000):
+    '''
+    Assigns the community district (`boro_cd`, e.g. 308) of every complaint from its coordinates.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset, regular or compact form.
+        path (str):             Optional. Path of the community districts GeoJSON. Defaults to `data/City_Features/Community_Districts.geojson`.
+        merge (bool):           Optional. Add the districts as a `District` column of the dataset instead of returning them. Defaults to `False`.
+        batch_size (int):       Optional. Number of points queried at a time.
+
+    Returns:
+        pd.Series of the nullable int district of every row, missing if outside all districts, or the dataset with the `District` column if merge.
+    '''
+    assert isinstance(dataset, pd.DataFrame) and isinstance(merge, bool)
+
+    lat, lon = lat_lon_arrays(dataset)
+    districts = spatial_join(lat, lon, path, 'boro_cd', batch_size)
+    districts = pd.Series(districts, index=dataset.index, name='District').where(districts >= 0).astype('Int16')
+
+    if merge:
+        dataset['District'] = districts
+        return dataset
+
+    return districts
+
+def assign_boroughs(dataset, path = BOROUGH_BOUNDARIES, batch_size = 1000000):
+    '''
+    Assigns the borough of every complaint from its coordinates, named like `BORO_NM`.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset, regular or compact form.
+        path (str):             Optional. Path of the borough boundaries GeoJSON. Defaults to `data/City_Features/Borough_Boundaries.geojson`.
+        batch_size (int):       Optional. Number of points queried at a time.
+
+    Returns:
+        pd.Series of the borough name of every row, NaN if outside all boroughs.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    lat, lon = lat_lon_arrays(dataset)
+    codes = spatial_join(lat, lon, path, 'boro_code', batch_size)
+
+    return pd.Series(codes, index=dataset.index).map(BOROUGH_CODES).rename('Geo Borough')
+
+def district_counts(dataset, by = None, path = COMMUNITY_DISTRICTS):
+    '''
+    Counts the complaints of every community district, optionally per group such as per year.
+    Uses the `District` column if the dataset has one, otherwise assigns the districts first.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset, regular or compact form.
+        by (str|list):          Optional. Column(s) to also group by, e.g. `'Year'`.
+        path (str):             Optional. Path of the community districts GeoJSON.
+
+    Returns:
+        pd.Series of counts indexed by district, or a pd.DataFrame with one row per district and one column per group if by is given. Districts without complaints have a count of 0.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    districts = dataset['District'] if 'District' in dataset.columns else assign_districts(dataset, path)
+    all_districts = pd.Index(np.sort(load_polygons(path, 'boro_cd')[1]), name='District')
+
+    if by is None:
+        return districts.value_counts().reindex(all_districts, fill_value=0).astype('int64')
+
+    by = [by] if isinstance(by, str) else by
+    counts = dataset[by].assign(District=districts.to_numpy()).groupby(['District'] + by, observed=True).size()
+    return counts.unstack(by, fill_value=0).reindex(all_districts, fill_value=0)
+
+def check_boroughs(dataset, path = BOROUGH_BOUNDARIES):
+    '''
+    Cross-checks the `BORO_NM` of every complaint against the borough its coordinates are in, e.g. after `preprocess_utils.clean_missing_boroughs`.
+
+    Parameters:
+        dataset (pd.DataFrame): Preprocessed Drug_Crime dataset, regular or compact form.
+        path (str):             Optional. Path of the borough boundaries GeoJSON.
+
+    Returns:
+        pd.DataFrame crosstab of the counts of `BORO_NM` (rows) against the geometric borough (columns). Complaints outside all boroughs are counted under `'Outside'`.
+    '''
+    assert isinstance(dataset, pd.DataFrame)
+
+    geo_boroughs = assign_boroughs(dataset, path).fillna('Outside')
+    return pd.crosstab(dataset['BORO_NM'].astype(str).to_numpy(), geo_boroughs.to_numpy(), rownames=['BORO_NM'], colnames=['Geo Borough'])
@@ -0,0 +1,178 @@
+import pandas as pd
+import cProfile
+import io
+import json
+import pstats
+import time
+import warnings
+
+class StageError(Exception):
+    '''
+    Raised when a stage of a preprocessing pipeline fails. Names the stage and keeps the original exception as its cause.
+
+    Attributes:
+        stage (str):            Name of the stage that failed.
+        cause (Exception):      Exception raised by the stage.
+    '''
+    def __init__(self, stage, cause, message = 'Preprocessing failed'):
+        self.stage = stage
+        self.cause = cause
+        self.message = message
+        super().__init__(f'{message} (stage {stage!r} failed with {type(cause).__name__}: {cause})')
+
+    def __reduce__(self):
+        # Rebuilt from its own arguments, so a stage that fails in a worker process raises the same StageError in the parent
+        return (StageError, (self.stage, self.cause, self.message))
+
+class StageReport:
+    '''
+    Instrumentation hook that records every stage of a preprocessing run: its wall time, rows in and out, and the change in size of the dataset.
+    Pass it as the `report` of `preprocess_utils.preprocess_datasets` (or `preprocess_drug_crime`, `preprocess_census`), then read `stages` or write it with `save`.
+    Any other callable that takes the record dict of a stage can be used as a hook as well, see `run_stage`.
+
+    Attributes:
+        stages (list):              Record dict of every stage in the order they ran.
+        profile (bool):             Run every stage under cProfile and keep its top functions in the record.
+        max_drop_fraction (float):  Warn when a stage drops more than this share of its rows, `None` to never warn.
+        hooks (list):               More callables called with the record of every stage, e.g. to log it.
+    '''
+    def __init__(self, profile = False, max_drop_fraction = None, hooks = []):
+        assert isinstance(profile, bool) and isinstance(hooks, list)
+        assert max_drop_fraction is None or 0 <= max_drop_fraction <= 1
+
+        self.stages = []
+        self.profile = profile
+        self.max_drop_fraction = max_drop_fraction
+        self.hooks = list(hooks)
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def __call__(self, record):
+        if self.max_drop_fraction is not None and record['rows_dropped'] is not None and record['rows_dropped'] > record['rows_in'] * self.max_drop_fraction:
+            record['flagged'] = True
+            warnings.warn(f"Stage {record['stage']!r} dropped {record['rows_dropped']} of {record['rows_in']} rows")
+        self.stages.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def to_dict(self):
+        '''
+        Provides the report as a JSON serializable dict with the totals of the run and the record of every stage.
+        '''
+        return {'started': self.started,
+                'seconds': sum(record['seconds'] for record in self.stages),
+                'flagged': [record['stage'] for record in self.stages if record.get('flagged')],
+                'stages': self.stages}
+
+    def to_frame(self):
+        '''
+        Provides the stage records as a pd.DataFrame with one row per stage, without the profiles.
+        '''
+        return pd.DataFrame([{key: value for key, value in record.items() if key != 'profile'} for record in self.stages])
+
+    def save(self, path):
+        '''
+        Writes the report as JSON.
+
+        Parameters:
+            path (str): File name of the JSON report.
+        '''
+        assert isinstance(path, str)
+
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def dataset_size(dataset):
+    '''
+    Provides the number of rows and the shallow size in bytes (object columns count their pointers only, which is cheap to compute) of a dataset.
+    The sizes of a dict of DataFrames are summed, but it has no number of rows: its frames are different tables, e.g. one per race, so their rows are not comparable to the ones of the merged frame.
+    '''
+    if isinstance(dataset, pd.DataFrame):
+        return len(dataset), int(dataset.memory_usage(index=True, deep=False).sum())
+    if isinstance(dataset, dict):
+        sizes = [dataset_size(value)[1] for value in dataset.values()]
+        return None, None if any(size is None for size in sizes) else sum(sizes)
+    return None, None
+
+def merge_stage_records(parts):
+    '''
+    Merges the stage records of the parts of a dataset that ran the same stages separately, e.g. the row ranges of the workers of `preprocess_utils.preprocess_drug_crime`.
+    The seconds, rows and bytes of a stage are summed over the parts, so its seconds are the total time of the workers rather than the wall time.
+
+    Parameters:
+        parts (list):   List of the list of stage records of every part.
+
+    Returns:
+        list of one record per stage, in the order the stages ran, with the number of `parts` it was merged from.
+    '''
+    assert isinstance(parts, list)
+
+    merged = {}
+    for records in parts:
+        for record in records:
+            if record['stage'] not in merged:
+                merged[record['stage']] = dict(record, parts=1)
+                continue
+            total = merged[record['stage']]
+            total['parts'] += 1
+            for key in ['seconds', 'rows_in', 'rows_out', 'rows_dropped', 'bytes_in', 'bytes_out', 'memory_delta_bytes']:
+                total[key] = None if total[key] is None or record[key] is None else total[key] + record[key]
+            if 'profile' in record:
+                total['profile'] += record['profile']
+
+    return list(merged.values())
+
+def run_stage(name, stage, dataset, report = None, message = 'Preprocessing failed'):
+    '''
+    Runs one stage of a preprocessing pipeline. Any exception of the stage is raised as a `StageError` that names the stage.
+    With a report, the stage is measured and its record dict is passed to the report: `stage`, `seconds`, `rows_in`, `rows_out`, `rows_dropped`,
+    `bytes_in`, `bytes_out`, `memory_delta_bytes` and, if the report profiles, `profile` with the top functions by cumulative time.
+    The rows are `None` unless the stage takes and returns a single DataFrame, so only those stages are checked for dropped rows.
+    The bytes are shallow (see `dataset_size`): the strings of object columns are not counted, so `memory_delta_bytes` misses the change in size of their values.
+
+    Parameters:
+        name (str):         Name of the stage.
+        stage (callable):   Function that takes the dataset and returns the new dataset.
+        dataset:            Input of the stage, usually a pd.DataFrame.
+        report (callable):  Optional. `StageReport` or any callable hook that takes the record dict of the stage. Defaults to `None` (not measured).
+        message (str):      Optional. Message of the `StageError`.
+
+    Returns:
+        the output of the stage.
+    '''
+    if report is None:
+        try:
+            return stage(dataset)
+        except StageError:
+            raise
+        except Exception as e:
+            raise StageError(name, e, message) from e
+
+    rows_in, bytes_in = dataset_size(dataset)
+    profiler = cProfile.Profile() if getattr(report, 'profile', False) else None
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = stage(dataset)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except StageError:
+        raise
+    except Exception as e:
+        raise StageError(name, e, message) from e
+    seconds = time.perf_counter() - start
+
+    rows_out, bytes_out = dataset_size(result)
+    record = {'stage': name, 'seconds': seconds, 'rows_in': rows_in, 'rows_out': rows_out,
+              'rows_dropped': rows_in - rows_out if rows_in is not None and rows_out is not None else None,
+              'bytes_in': bytes_in, 'bytes_out': bytes_out,
+              'memory_delta_bytes': bytes_out - bytes_in if bytes_in is not None and bytes_out is not None else None}
+    if profiler is not None:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+        record['profile'] = stream.getvalue()
+    report(record)
+
+    return result
@@ -0,0 +1,35 @@
+'''
+Shared fixtures of the regression tests: a small seeded synthetic dataset from `benchmarks/generate.py`, so the tests run offline and without the LFS data.
+'''
+import pytest
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import data_utils as du
+import preprocess_utils as pu
+import generate
+
+# Number of synthetic complaints, enough for every borough, precinct and stage to be exercised
+ROWS = 3000
+
+@pytest.fixture(scope='session')
+def synthetic_paths(tmp_path_factory):
+    '''
+    Writes the synthetic datasets once per test session and makes the preprocessing use their precinct table.
+    '''
+    paths = generate.generate(ROWS, str(tmp_path_factory.mktemp('synthetic')), seed=0)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(pu, 'PRECINCT_DIR', paths['precincts'])
+        pu.load_precinct_table.cache_clear()
+        yield paths
+    pu.load_precinct_table.cache_clear()
+
+@pytest.fixture
+def raw_datasets(synthetic_paths):
+    '''
+    Imports a fresh copy of the raw synthetic datasets, since preprocessing modifies them.
+    '''
+    return du.import_csv_data([synthetic_paths['drug_crime']] + synthetic_paths['census'])
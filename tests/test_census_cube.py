@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+import random
+import data_utils as du
+import preprocess_utils as pu
+from cube_utils import CensusCube, CENSUS_FEATURES
+
+@pytest.fixture(params=[0, 1, 2])
+def census(request, synthetic_paths):
+    '''
+    Imports the census CSVs in a shuffled order, so the race order of the import differs from `CENSUS_RACES`.
+    '''
+    files = list(synthetic_paths['census'])
+    random.Random(request.param).shuffle(files)
+    return lambda: du.import_csv_data(files)
+
+@pytest.mark.parametrize('build', ['from_census', 'from_datasets'])
+def test_cube_filter_matches_frame(census, build):
+    frame = pu.preprocess_census(census())
+    cube = CensusCube.from_census(frame) if build == 'from_census' else CensusCube.from_datasets(census())
+
+    for boro in [''] + list(frame['Borough'].unique()) + ['Nowhere']:
+        for feature in CENSUS_FEATURES:
+            for rename in [True, False]:
+                expected = du.filter_by_boro_feature(frame, boro, feature, rename)
+                pd.testing.assert_frame_equal(du.filter_by_boro_feature(cube, boro, feature, rename), expected, check_dtype=False)
+
+@pytest.mark.parametrize('axis', ['row', 'col'])
+def test_cube_normalize_matches_frame(census, axis):
+    frame = pu.preprocess_census(census())
+    cube = du.normalize(CensusCube.from_census(frame), axis)
+
+    for feature in CENSUS_FEATURES:
+        expected = du.normalize(du.filter_by_boro_feature(frame, '', feature), axis)
+        pd.testing.assert_frame_equal(du.filter_by_boro_feature(cube, '', feature), expected, check_dtype=False)
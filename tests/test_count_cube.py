@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+import data_utils as du
+import preprocess_utils as pu
+from cube_utils import CountCube
+
+QUERIES = [([], {}),
+           ('Year', {}),
+           (['Year', 'BORO_NM'], {}),
+           (['BORO_NM', 'Time of Day'], {'Year': [2019, 2020]}),
+           (['Month', 'Crime Category', 'Precinct'], {'BORO_NM': 'BRONX'}),
+           ('Crime', {'Time of Day': 'night', 'BORO_NM': ['QUEENS', 'Nowhere']})]
+
+@pytest.fixture(scope='module', params=[False, True], ids=['regular', 'compact'])
+def drug_crime(request, synthetic_paths):
+    dataset = pu.preprocess_drug_crime(du.import_csv_data([synthetic_paths['drug_crime']])['Drug_Crime'], 'vectorized')
+    return pu.compact_drug_crime(dataset) if request.param else dataset
+
+def expected_counts(dataset, by, where):
+    mask = du.where_mask(dataset, where)
+    dataset = dataset if mask is None else dataset[mask]
+    if len(by) == 0:
+        return len(dataset)
+    return dataset.groupby(by, observed=True).size()
+
+@pytest.mark.parametrize('by, where', QUERIES)
+def test_counts_match_groupby(drug_crime, by, where, tmp_path):
+    cube = CountCube.from_dataset(drug_crime)
+    cube.save(str(tmp_path / 'cube.parquet'))
+
+    expected = expected_counts(drug_crime, by, where)
+    for counts in [cube.counts(by, where), CountCube.load(str(tmp_path / 'cube.parquet')).counts(by, where)]:
+        if isinstance(expected, int):
+            assert counts == expected
+        else:
+            pd.testing.assert_series_equal(counts, expected, check_names=False, check_index_type=False, check_dtype=False,
+                                           check_categorical=False)
@@ -0,0 +1,35 @@
+import pandas as pd
+import numpy as np
+import pytest
+import ingest_utils as iu
+import preprocess_utils as pu
+
+def next_snapshot(raw, seed = 1):
+    '''
+    Derives a later snapshot from a raw Drug_Crime dataset, with deleted, updated, added and duplicated complaints and complaints that lost their time.
+    '''
+    rng = np.random.default_rng(seed)
+    snapshot = raw.drop(index=rng.choice(raw.index, len(raw) // 50, replace=False))
+    snapshot.loc[rng.choice(snapshot.index, len(snapshot) // 50, replace=False), 'OFNS_DESC'] = 'DANGEROUS DRUGS X'
+    snapshot.loc[rng.choice(snapshot.index, 10, replace=False), 'CMPLNT_FR_TM'] = '(null)'
+    added = raw.sample(len(raw) // 50, random_state=seed).copy()
+    added['CMPLNT_NUM'] += 10 ** 9
+    duplicated = snapshot.sample(10, random_state=seed)
+    return pd.concat([snapshot.iloc[:len(snapshot) // 2], added, duplicated, snapshot.iloc[len(snapshot) // 2:]])
+
+@pytest.mark.parametrize('engine', ['python', 'vectorized'])
+def test_incremental_ingest_matches_full_rebuild(synthetic_paths, tmp_path, engine):
+    first = synthetic_paths['drug_crime']
+    second = str(tmp_path / 'Drug_Crime_second.csv')
+    next_snapshot(pd.read_csv(first)).to_csv(second, index=False)
+    store_dir = str(tmp_path / 'store')
+
+    changes = []
+    for filename in [first, second, second, first]:
+        dataset, change = iu.ingest_snapshot(filename, store_dir, engine, return_changes=True)
+        pd.testing.assert_frame_equal(dataset, pu.preprocess_drug_crime(pd.read_csv(filename), engine))
+        changes.append(change)
+
+    # The later snapshots only preprocess the changed complaints, and a repeated snapshot none
+    assert min(changes[1]['added'], changes[1]['updated'], changes[1]['deleted'], changes[1]['unchanged']) > 0
+    assert changes[2]['added'] == changes[2]['updated'] == changes[2]['deleted'] == 0
@@ -0,0 +1,17 @@
+import pandas as pd
+import preprocess_utils as pu
+
+def test_vectorized_engine_matches_python(raw_datasets):
+    python = pu.preprocess_drug_crime(raw_datasets['Drug_Crime'].copy(), 'python')
+    vectorized = pu.preprocess_drug_crime(raw_datasets['Drug_Crime'].copy(), 'vectorized')
+
+    assert len(python) > 0
+    pd.testing.assert_frame_equal(vectorized, python)
+
+def test_vectorized_engine_matches_python_datasets(raw_datasets):
+    python = pu.preprocess_datasets({name: dataset.copy() for name, dataset in raw_datasets.items()}, engine='python')
+    vectorized = pu.preprocess_datasets(raw_datasets, engine='vectorized')
+
+    assert list(vectorized) == list(python)
+    for name in python:
+        pd.testing.assert_frame_equal(vectorized[name], python[name])
@@ -0,0 +1,12 @@
+import pandas as pd
+import pytest
+import preprocess_utils as pu
+
+@pytest.mark.parametrize('engine', ['python', 'vectorized'])
+def test_workers_match_serial(raw_datasets, engine):
+    serial = pu.preprocess_datasets({name: dataset.copy() for name, dataset in raw_datasets.items()}, engine=engine)
+    parallel = pu.preprocess_datasets(raw_datasets, engine=engine, workers=2)
+
+    assert list(parallel) == list(serial)
+    for name in serial:
+        pd.testing.assert_frame_equal(parallel[name], serial[name])